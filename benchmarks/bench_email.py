@@ -0,0 +1,480 @@
+#!/usr/bin/env python3
+"""
+Email Load Benchmark
+Drives the email and reminder services against an in-process SMTP sink at several scales
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import ssl
+import sys
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Any, Iterator, List, Optional
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "server"))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from bench_pipeline import environment
+from email_service import SMTPEmailService
+from reminder_service import ReminderService
+from smtp_transport import AsyncSMTPPool, SMTPTransport
+from synthetic import InvoiceGenerator
+
+# Synthetic invoices are dated up to this instant, which the reminder run takes as now
+FAKE_NOW = datetime(2025, 1, 1)
+
+class SinkSession(asyncio.Protocol):
+    """One SMTP session with the sink: replies to every command, keeps no message
+
+    Replies to all the commands found in one read go back together after the sink's
+    latency, so a pipelined envelope costs one round trip as it would on a real server.
+    """
+
+    def __init__(self, sink: "SMTPSink"):
+        self.sink = sink
+        self.loop = asyncio.get_running_loop()
+        self.transport: Optional[asyncio.Transport] = None
+        self.buffer = bytearray()
+        self.state = 'command'
+        self.auth_steps = 0
+        self.data_scanned = 0
+        self.recipients = 0
+        self.messages = 0
+        self.tls = False
+        self.closing = False
+        self._replies: List[bytes] = []
+        self._outbox: deque = deque()
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        stats = self.sink.stats
+        stats['connections'] += 1
+        self.sink.open_sessions += 1
+        stats['peak_connections'] = max(stats['peak_connections'], self.sink.open_sessions)
+        if self.sink.max_connections and self.sink.open_sessions > self.sink.max_connections:
+            stats['connections_refused'] += 1
+            self.reply(b'421 Too many connections')
+            self.flush(close=True)
+            return
+        self.reply(b'220 sink ESMTP')
+        self.flush()
+
+    def connection_lost(self, exc: Optional[Exception]):
+        self.sink.open_sessions -= 1
+        self._outbox.clear()
+
+    def reply(self, line: bytes):
+        self._replies.append(line + b'\r\n')
+
+    def flush(self, close: bool = False):
+        """Send the replies gathered so far once the latency has passed, then close if asked"""
+        if not self._replies and not close:
+            return
+        data, self._replies = b''.join(self._replies), []
+        self.closing = self.closing or close
+        if not self.sink.latency:
+            self._write(data, close)
+            return
+        self._outbox.append((self.loop.time() + self.sink.latency, data, close))
+        if len(self._outbox) == 1:
+            self.loop.call_at(self._outbox[0][0], self._drain)
+
+    def _drain(self):
+        now = self.loop.time()
+        while self._outbox and self._outbox[0][0] <= now:
+            _, data, close = self._outbox.popleft()
+            self._write(data, close)
+        if self._outbox:
+            self.loop.call_at(self._outbox[0][0], self._drain)
+
+    def _write(self, data: bytes, close: bool):
+        if self.transport.is_closing():
+            return
+        if data:
+            self.transport.write(data)
+        if close:
+            self.transport.close()
+
+    def data_received(self, data: bytes):
+        if self.closing:
+            return
+        self.buffer += data
+        if self.state == 'tls':
+            # Handshake finished but start_tls has not handed over the new transport yet
+            return
+        while self.buffer and not self.closing:
+            if self.state == 'data':
+                if not self._end_of_data():
+                    break
+                continue
+            end = self.buffer.find(b'\r\n')
+            if end < 0:
+                break
+            line = bytes(self.buffer[:end])
+            del self.buffer[:end + 2]
+            if self.state == 'auth':
+                self._auth_step()
+            elif self._command(line):
+                # STARTTLS: nothing more is read in the clear
+                self.buffer.clear()
+                return
+        self.flush()
+
+    def _end_of_data(self) -> bool:
+        if self.buffer.startswith(b'.\r\n'):
+            end = 0
+        else:
+            end = self.buffer.find(b'\r\n.\r\n', max(self.data_scanned - 4, 0))
+            if end < 0:
+                self.data_scanned = len(self.buffer)
+                return False
+            end += 2
+        self.sink.stats['bytes'] += end
+        del self.buffer[:end + 3]
+        self.data_scanned = 0
+        self.state = 'command'
+        self.messages += 1
+        self.sink.stats['messages'] += 1
+        self.reply(b'250 Queued')
+        return True
+
+    def _auth_step(self):
+        self.auth_steps -= 1
+        if self.auth_steps:
+            self.reply(b'334 UGFzc3dvcmQ6')
+        else:
+            self.state = 'command'
+            self.reply(b'235 Authentication successful')
+
+    def _command(self, line: bytes) -> bool:
+        """Answer one command; True when the session is handed over to TLS"""
+        verb, _, argument = line.partition(b' ')
+        verb = verb.upper()
+        sink = self.sink
+        if verb == b'EHLO':
+            extensions = [b'sink', b'PIPELINING', b'AUTH PLAIN LOGIN', b'8BITMIME']
+            if sink.tls_context is not None and not self.tls:
+                extensions.append(b'STARTTLS')
+            for extension in extensions[:-1]:
+                self.reply(b'250-' + extension)
+            self.reply(b'250 ' + extensions[-1])
+        elif verb == b'HELO':
+            self.reply(b'250 sink')
+        elif verb == b'STARTTLS' and sink.tls_context is not None and not self.tls:
+            self.reply(b'220 Ready to start TLS')
+            self.flush()
+            # The client hello must wait for the handshake rather than be read as a command
+            self.transport.pause_reading()
+            self.state = 'tls'
+            self.loop.create_task(self._start_tls())
+            return True
+        elif verb == b'AUTH':
+            mechanism, _, initial = argument.upper().partition(b' ')
+            if mechanism == b'LOGIN':
+                # Username, unless sent with the command, then password
+                self.auth_steps = 1 if initial else 2
+                self.state = 'auth'
+                self.reply(b'334 UGFzc3dvcmQ6' if initial else b'334 VXNlcm5hbWU6')
+            elif initial:
+                self.reply(b'235 Authentication successful')
+            else:
+                self.auth_steps = 1
+                self.state = 'auth'
+                self.reply(b'334 ')
+        elif verb == b'MAIL':
+            if sink.max_messages and self.messages >= sink.max_messages:
+                sink.stats['connections_limited'] += 1
+                self.reply(b'421 Too many messages on this connection')
+                self.flush(close=True)
+                return False
+            self.recipients = 0
+            self.reply(b'250 OK')
+        elif verb == b'RCPT':
+            draw = sink.rng.random()
+            if draw < sink.failure_rate:
+                sink.stats['temporary_failures'] += 1
+                self.reply(b'451 Try again later')
+            elif draw < sink.failure_rate + sink.reject_rate:
+                sink.stats['rejections'] += 1
+                self.reply(b'550 No such user')
+            else:
+                self.recipients += 1
+                self.reply(b'250 OK')
+        elif verb == b'DATA':
+            if self.recipients:
+                self.state = 'data'
+                self.reply(b'354 End data with <CR><LF>.<CR><LF>')
+            else:
+                self.reply(b'503 No valid recipients')
+        elif verb == b'RSET':
+            self.recipients = 0
+            self.reply(b'250 OK')
+        elif verb == b'NOOP':
+            self.reply(b'250 OK')
+        elif verb == b'QUIT':
+            self.reply(b'221 Bye')
+            self.flush(close=True)
+        else:
+            self.reply(b'500 Command not recognized')
+        return False
+
+    async def _start_tls(self):
+        # Wait for the 220 to leave before the handshake takes over the socket
+        while self._outbox:
+            await asyncio.sleep(self.sink.latency / 2)
+        try:
+            self.transport = await self.loop.start_tls(self.transport, self, self.sink.tls_context,
+                                                       server_side=True)
+        except (OSError, ssl.SSLError):
+            self.transport.abort()
+            return
+        self.tls = True
+        self.state = 'command'
+        self.sink.stats['tls_sessions'] += 1
+        self.data_received(b'')
+
+class SMTPSink:
+    """Local SMTP server that accepts and discards mail, on its own event loop thread
+
+    latency: seconds before each batch of replies is sent
+    failure_rate / reject_rate: share of recipients refused with a 451 or a 550
+    max_messages: messages a session may carry before MAIL is answered 421 and it is closed
+    max_connections: sessions open at once beyond which new ones are greeted 421
+    tls_context: server context that enables STARTTLS
+    """
+
+    def __init__(self, latency: float = 0.0, failure_rate: float = 0.0, reject_rate: float = 0.0,
+                 max_messages: int = 0, max_connections: int = 0,
+                 tls_context: Optional[ssl.SSLContext] = None, seed: int = 42):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.reject_rate = reject_rate
+        self.max_messages = max_messages
+        self.max_connections = max_connections
+        self.tls_context = tls_context
+        self.rng = random.Random(seed)
+        self.open_sessions = 0
+        self.stats = dict.fromkeys(['connections', 'peak_connections', 'connections_refused',
+                                    'connections_limited', 'tls_sessions', 'messages', 'bytes',
+                                    'temporary_failures', 'rejections'], 0)
+        self.host = '127.0.0.1'
+        self.port = 0
+        self.loop = asyncio.new_event_loop()
+        self._server = None
+        self._thread = threading.Thread(target=self.loop.run_forever, name='smtp-sink', daemon=True)
+
+    def start(self) -> "SMTPSink":
+        self._thread.start()
+        self._server = asyncio.run_coroutine_threadsafe(
+            self.loop.create_server(lambda: SinkSession(self), self.host, 0, backlog=1024), self.loop).result()
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    def stop(self):
+        async def shutdown():
+            self._server.close()
+            await self._server.wait_closed()
+        asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result(5)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(5)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+class TimedPool(AsyncSMTPPool):
+    """Connection pool that records how long every send takes, waiting for a session included"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies: List[float] = []
+
+    async def send(self, from_addr, to_addrs, message):
+        start = time.perf_counter()
+        try:
+            return await super().send(from_addr, to_addrs, message)
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    """p50, p90, p99 and max of durations in seconds, as milliseconds"""
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+    last = len(ordered) - 1
+    result = {f"p{point}": round(ordered[round(last * point / 100)] * 1000, 3) for point in (50, 90, 99)}
+    result['max'] = round(ordered[-1] * 1000, 3)
+    return result
+
+def sink_settings(args: argparse.Namespace) -> Dict[str, Any]:
+    return {
+        'latency_ms': args.latency_ms,
+        'failure_rate': args.failure_rate,
+        'reject_rate': args.reject_rate,
+        'max_messages': args.sink_max_messages,
+        'max_connections': args.sink_max_connections,
+        'starttls': bool(args.tls_cert),
+    }
+
+def start_sink(args: argparse.Namespace) -> SMTPSink:
+    tls_context = None
+    if args.tls_cert:
+        tls_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        tls_context.load_cert_chain(args.tls_cert, args.tls_key)
+    return SMTPSink(args.latency_ms / 1000, args.failure_rate, args.reject_rate, args.sink_max_messages,
+                    args.sink_max_connections, tls_context, args.seed).start()
+
+def email_service_for(sink: SMTPSink, args: argparse.Namespace) -> SMTPEmailService:
+    pool = TimedPool(sink.host, sink.port, 'bench', 'bench', max_connections=args.pool_size,
+                     max_messages=args.max_messages, timeout=args.timeout, starttls=bool(args.tls_cert))
+    return SMTPEmailService(SMTPTransport(pool), templates=[])
+
+def run_report(name: str, count: int, sent: int, failed: int, elapsed: float, pool: TimedPool,
+               sink: SMTPSink, args: argparse.Namespace) -> Dict[str, Any]:
+    return {
+        'benchmark': name,
+        'invoices': count,
+        'sent': sent,
+        'failed': failed,
+        'elapsed_ms': round(elapsed * 1000, 3),
+        'messages_per_sec': round(sent / elapsed, 1) if elapsed else None,
+        'pool_size': args.pool_size,
+        'workers': args.workers or args.pool_size * 2,
+        'connections': {
+            'opened': pool.connections_opened,
+            'accepted': sink.stats['connections'],
+            'peak_open': sink.stats['peak_connections'],
+            'refused': sink.stats['connections_refused'],
+            'limited': sink.stats['connections_limited'],
+        },
+        'send_latency_ms': percentiles(pool.latencies),
+        'sink': dict(sink_settings(args), **{key: sink.stats[key] for key in
+                                            ('messages', 'bytes', 'temporary_failures', 'rejections')}),
+    }
+
+def bench_email(generator: InvoiceGenerator, args: argparse.Namespace) -> Dict[str, Any]:
+    """Invoice emails through SMTPEmailService.send_many, timed from submission to result"""
+    invoices = list(generator)
+    submitted: Dict[int, float] = {}
+
+    def messages() -> Iterator[Dict[str, Any]]:
+        # Pulled by send_many as it submits, so the time taken here is the submission time
+        for index, invoice in enumerate(invoices):
+            submitted[index] = time.perf_counter()
+            yield {
+                'id': index,
+                'to_email': invoice['clientEmail'],
+                'subject': f"Invoice {invoice['invoiceNumber']} from {invoice['companyName']}",
+                'body': f"Dear {invoice['clientName']},\n\nPlease find invoice {invoice['invoiceNumber']} "
+                        f"for ${invoice['total']} attached.\n\n{invoice['notes']}\n",
+            }
+
+    sink = start_sink(args)
+    email_service = email_service_for(sink, args)
+    result_latencies = []
+    sent = failed = 0
+    try:
+        start = time.perf_counter()
+        for result in email_service.send_many(messages(), args.workers, None, args.max_retries, args.backoff):
+            result_latencies.append(time.perf_counter() - submitted.pop(result['id']))
+            if result['success']:
+                sent += 1
+            else:
+                failed += 1
+        elapsed = time.perf_counter() - start
+    finally:
+        email_service.close()
+        sink.stop()
+
+    report = run_report('email', len(invoices), sent, failed, elapsed, email_service.transport.pool, sink, args)
+    report['result_latency_ms'] = percentiles(result_latencies)
+    return report
+
+def bench_reminders(generator: InvoiceGenerator, args: argparse.Namespace) -> Dict[str, Any]:
+    """ReminderService.process_overdue_invoices with days overdue counted from a fixed clock"""
+    invoices = list(generator)
+    sink = start_sink(args)
+    email_service = email_service_for(sink, args)
+    reminder_service = ReminderService(email_service, clock=lambda: FAKE_NOW)
+    try:
+        start = time.perf_counter()
+        results = reminder_service.process_overdue_invoices(invoices, args.workers, None,
+                                                            args.max_retries, args.backoff)
+        elapsed = time.perf_counter() - start
+    finally:
+        email_service.close()
+        sink.stop()
+
+    report = run_report('reminders', len(invoices), results['sent'], results['failed'], elapsed,
+                        email_service.transport.pool, sink, args)
+    tiers: Dict[str, int] = {}
+    for detail in results['details']:
+        if detail['status'] == 'sent':
+            tiers[detail['type']] = tiers.get(detail['type'], 0) + 1
+    report.update(skipped=results['skipped'], tiers=tiers, clock=FAKE_NOW.isoformat())
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load-test email and reminder sending against a local SMTP sink, one JSON object per line")
+    parser.add_argument('--scales', default='100,1000,5000', help="Comma separated invoice counts")
+    parser.add_argument('--benchmarks', default='email,reminders', help="Comma separated: email, reminders")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--pool-size', type=int, default=4, help="SMTP sessions the services may open")
+    parser.add_argument('--max-messages', type=int, default=100,
+                        help="Messages a pooled session carries before it is retired")
+    parser.add_argument('--workers', type=int, help="Concurrent sends (default: twice the pool size)")
+    parser.add_argument('--max-retries', type=int, default=3)
+    parser.add_argument('--backoff', type=float, default=0.05,
+                        help="Seconds before the first retry of a temporary failure")
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--latency-ms', type=float, default=0.0,
+                        help="Delay before the sink answers each batch of commands")
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help="Share of recipients the sink refuses with a temporary 451")
+    parser.add_argument('--reject-rate', type=float, default=0.0,
+                        help="Share of recipients the sink refuses with a permanent 550")
+    parser.add_argument('--sink-max-messages', type=int, default=0,
+                        help="Messages per session after which the sink answers 421, 0 for no limit")
+    parser.add_argument('--sink-max-connections', type=int, default=0,
+                        help="Open sessions beyond which the sink greets 421, 0 for no limit")
+    parser.add_argument('--tls-cert', metavar='PATH', help="Certificate that lets the sink offer STARTTLS")
+    parser.add_argument('--tls-key', metavar='PATH', help="Key of --tls-cert")
+    parser.add_argument('--output', metavar='PATH', help="Append results to a file instead of stdout")
+    args = parser.parse_args()
+
+    benchmarks = {'email': bench_email, 'reminders': bench_reminders}
+    names = [name for name in args.benchmarks.split(',') if name]
+    unknown = [name for name in names if name not in benchmarks]
+    if unknown:
+        print(f"Unknown benchmark: {', '.join(unknown)}", file=sys.stderr)
+        sys.exit(1)
+
+    output = open(args.output, 'a') if args.output else sys.stdout
+    os.environ.setdefault('FROM_EMAIL', 'billing@zentura.example')
+
+    def emit(result: Dict[str, Any]):
+        output.write(json.dumps(result) + '\n')
+        output.flush()
+
+    emit(environment())
+    for count in (int(scale) for scale in args.scales.split(',') if scale):
+        for name in names:
+            generator = InvoiceGenerator(count, seed=args.seed, start_date=FAKE_NOW.replace(tzinfo=timezone.utc))
+            emit(benchmarks[name](generator, args))
+
+    if args.output:
+        output.close()
+
+if __name__ == "__main__":
+    main()
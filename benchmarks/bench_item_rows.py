@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Item Row Benchmark
+Renders invoices with growing item counts to check that item-row generation scales linearly
+"""
+
+import argparse
+import json
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "server"))
+
+from template_processor import InvoiceTemplateProcessor
+
+ITEM_COLUMNS = [('Item', 'item_name'), ('Description', 'item_description'), ('Rate', 'item_rate'),
+                ('Qty', 'item_quantity'), ('Amount', 'item_amount')]
+
+def write_item_row_template(template_path: Path):
+    """Write a small invoice template whose items table has an {{item_...}} template row"""
+    from docx import Document
+    from docx.shared import Pt
+
+    doc = Document()
+    title = doc.add_paragraph().add_run("INVOICE {{invoice_number}}")
+    title.font.size = Pt(18)
+    title.font.bold = True
+    doc.add_paragraph("{{company_name}}, {{company_address}}")
+    doc.add_paragraph("Bill To: {{client_name}} <{{client_email}}>")
+
+    items_table = doc.add_table(rows=1, cols=len(ITEM_COLUMNS))
+    items_table.style = 'Table Grid'
+    for cell, (heading, _) in zip(items_table.rows[0].cells, ITEM_COLUMNS):
+        cell.text = heading
+        cell.paragraphs[0].runs[0].font.bold = True
+    for cell, (_, code) in zip(items_table.add_row().cells, ITEM_COLUMNS):
+        cell.text = f"{{{{{code}}}}}"
+
+    summary_table = doc.add_table(rows=2, cols=2)
+    summary_table.cell(0, 0).text = "Subtotal:"
+    summary_table.cell(0, 1).text = "{{subtotal}}"
+    summary_table.cell(1, 0).text = "Total:"
+    summary_table.cell(1, 1).text = "{{total}}"
+    doc.add_paragraph("{{notes}}")
+    doc.save(str(template_path))
+
+def make_invoice(item_count: int):
+    return {
+        'invoiceNumber': 'INV-BENCH',
+        'clientName': 'Benchmark Client',
+        'subtotal': item_count * 2.5,
+        'total': item_count * 2.5,
+        'items': [
+            {'name': f'Usage {i}', 'description': 'Metered API calls', 'quantity': 1000, 'rate': 0.0025, 'amount': 2.5}
+            for i in range(item_count)
+        ],
+    }
+
+def bench_items(processor: InvoiceTemplateProcessor, template_path: Path, item_count: int, repeats: int):
+    """Best-of-N time to fill the template and save the .docx"""
+    invoice = make_invoice(item_count)
+    best = None
+    with tempfile.TemporaryDirectory() as scratch_dir:
+        output_path = Path(scratch_dir) / 'bench.docx'
+        for _ in range(repeats):
+            start = time.perf_counter()
+            processor.process_document(template_path, invoice, output_path)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+    return {
+        'items': item_count,
+        'total_ms': round(best * 1000, 3),
+        'us_per_item': round(best * 1_000_000 / item_count, 2),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Time item-row generation at increasing invoice sizes")
+    parser.add_argument('--template', metavar='PATH',
+                        help="Template with an items table whose template row uses {{item_...}} codes "
+                             "(default: a generated one)")
+    parser.add_argument('--sizes', default='10,100,1000,10000')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as templates_dir:
+        if args.template:
+            template_path = Path(args.template).resolve()
+        else:
+            template_path = Path(templates_dir) / 'item_rows.docx'
+            write_item_row_template(template_path)
+        processor = InvoiceTemplateProcessor(str(template_path.parent))
+
+        cached_template = processor.template_cache.get(template_path)
+        if not cached_template.item_tables:
+            print(f"Error: {template_path.name} has no {{{{item_...}}}} template row", file=sys.stderr)
+            sys.exit(1)
+
+        for item_count in (int(size) for size in args.sizes.split(',')):
+            print(json.dumps(bench_items(processor, template_path, item_count, args.repeats)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+PDF Backend Benchmark
+Compares per-invoice latency of the docx2pdf and native PDF backends
+"""
+
+import argparse
+import json
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "server"))
+
+from template_processor import InvoiceTemplateProcessor, PDF_RENDERERS, DEFAULT_TEMPLATE
+
+SAMPLE_INVOICE = {
+    'companyName': 'Zentura Works',
+    'companyAddress': '12 Harbour Street, Cape Town',
+    'companyPhone': '+27 21 555 0100',
+    'companyEmail': 'billing@zentura.example',
+    'invoiceNumber': 'INV-1001',
+    'invoiceDate': '2025-05-01',
+    'dueDate': '2025-05-31',
+    'clientName': 'Acme Holdings',
+    'clientEmail': 'accounts@acme.example',
+    'clientAddress': '1 Main Road, Johannesburg',
+    'subtotal': 1250,
+    'vatRate': 15,
+    'vatAmount': 187.5,
+    'total': 1437.5,
+    'notes': 'Payment by EFT, please quote the invoice number.',
+}
+
+def sample_invoice(item_count: int):
+    items = [
+        {'name': f'Service {i}', 'description': 'Monthly retainer', 'quantity': 1, 'rate': 125, 'amount': 125}
+        for i in range(item_count)
+    ]
+    return dict(SAMPLE_INVOICE, items=items)
+
+def bench_backend(backend: str, templates_dir: str, iterations: int, item_count: int):
+    """Time repeated renders of the same invoice; the first render is reported separately as warm-up"""
+    processor = InvoiceTemplateProcessor(templates_dir, renderer=PDF_RENDERERS[backend]())
+    invoice = sample_invoice(item_count)
+
+    start = time.perf_counter()
+    processor.generate_invoice_pdf(invoice, DEFAULT_TEMPLATE)
+    first_ms = (time.perf_counter() - start) * 1000
+
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        pdf_content = processor.generate_invoice_pdf(invoice, DEFAULT_TEMPLATE)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    timings.sort()
+    return {
+        'backend': backend,
+        'items': item_count,
+        'iterations': iterations,
+        'first_ms': round(first_ms, 3),
+        'mean_ms': round(statistics.mean(timings), 3),
+        'p50_ms': round(timings[len(timings) // 2], 3),
+        'p95_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 3),
+        'pdf_bytes': len(pdf_content),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare per-invoice latency of the PDF backends")
+    parser.add_argument('--templates-dir', default=str(Path(__file__).resolve().parent.parent / "templates"))
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--items', type=int, default=10)
+    parser.add_argument('--backend', action='append', choices=sorted(PDF_RENDERERS),
+                        help="Backend to benchmark (repeatable, default: all)")
+    args = parser.parse_args()
+
+    for backend in args.backend or sorted(PDF_RENDERERS):
+        try:
+            result = bench_backend(backend, args.templates_dir, args.iterations, args.items)
+        except Exception as e:
+            # docx2pdf needs a Word engine, which most Linux hosts do not have
+            result = {'backend': backend, 'skipped': str(e)}
+        print(json.dumps(result))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Billing Pipeline Benchmark
+Measures export formats and template rendering on synthetic invoices at several scales
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Any, Callable, List, Optional, Tuple
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "server"))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from accounting_export import AccountingExporter, EXPORT_FORMATS
+from invoice_input import NdjsonInvoiceFile
+from synthetic import InvoiceGenerator
+
+def timed(run: Callable[[], Any]) -> Tuple[Any, float]:
+    start = time.perf_counter()
+    result = run()
+    return result, (time.perf_counter() - start) * 1000
+
+def peak_memory(run: Callable[[], Any]) -> int:
+    """Peak bytes allocated by Python while run executes, over what was live before it"""
+    tracemalloc.start()
+    try:
+        run()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def environment() -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=str(ROOT),
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    try:
+        import numpy
+        numpy_version = numpy.__version__
+    except ImportError:
+        numpy_version = None
+    return {
+        'benchmark': 'environment',
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'numpy': numpy_version,
+    }
+
+def drain_export(exporter: AccountingExporter, invoices, format_type: str) -> Tuple[int, float]:
+    """Stream an export to nowhere, returning its line count and time to the first chunk"""
+    start = time.perf_counter()
+    first_chunk_ms = None
+    lines = 0
+    for chunk in exporter.iter_export(invoices, format_type):
+        if first_chunk_ms is None:
+            first_chunk_ms = (time.perf_counter() - start) * 1000
+        lines += chunk.count('\n')
+    return lines, first_chunk_ms or 0.0
+
+def bench_exports(generator: InvoiceGenerator, formats: List[str], measure_memory: bool) -> List[Dict[str, Any]]:
+    invoices, generate_ms = timed(lambda: list(generator))
+    exporter = AccountingExporter()
+
+    with tempfile.TemporaryDirectory() as scratch_dir:
+        ndjson_path = Path(scratch_dir) / 'invoices.ndjson'
+        with open(ndjson_path, 'w') as f:
+            _, write_ms = timed(lambda: f.writelines(json.dumps(invoice) + '\n' for invoice in invoices))
+
+        results = []
+        for format_type in formats:
+            (lines, first_chunk_ms), export_ms = timed(lambda: drain_export(exporter, invoices, format_type))
+            with NdjsonInvoiceFile(str(ndjson_path)) as input_file:
+                _, file_export_ms = timed(lambda: drain_export(exporter, input_file, format_type))
+
+            # Rows exclude the header line
+            rows = max(lines - 1, 0)
+            result = {
+                'benchmark': 'export',
+                'format': format_type,
+                'invoices': generator.count,
+                'rows': rows,
+                'rows_per_sec': round(rows / (export_ms / 1000)) if export_ms else None,
+                'invoices_per_sec': round(generator.count / (export_ms / 1000)) if export_ms else None,
+                'stages': {
+                    'generate_ms': round(generate_ms, 3),
+                    'write_ndjson_ms': round(write_ms, 3),
+                    'first_chunk_ms': round(first_chunk_ms, 3),
+                    'export_ms': round(export_ms, 3),
+                    'ndjson_file_export_ms': round(file_export_ms, 3),
+                },
+            }
+            if measure_memory:
+                result['peak_bytes'] = peak_memory(lambda: drain_export(exporter, invoices, format_type))
+            results.append(result)
+        return results
+
+def bench_template(item_count: int, templates_dir: Optional[str], backend: str,
+                   measure_memory: bool) -> Dict[str, Any]:
+    from template_processor import InvoiceTemplateProcessor, PDF_RENDERERS, DEFAULT_TEMPLATE
+    from bench_item_rows import write_item_row_template
+
+    invoice = next(iter(InvoiceGenerator(count=1, min_items=item_count, max_items=item_count)))
+
+    with tempfile.TemporaryDirectory() as scratch_dir:
+        if templates_dir is None:
+            # The shipped template has no {{item_...}} row, so its fill cost would not grow with items
+            templates_dir = scratch_dir
+            write_item_row_template(Path(scratch_dir) / DEFAULT_TEMPLATE)
+        processor = InvoiceTemplateProcessor(templates_dir, renderer=PDF_RENDERERS[backend]())
+        template_path = processor.resolve_template(DEFAULT_TEMPLATE)
+
+        output_path = Path(scratch_dir) / 'bench.docx'
+        _, load_ms = timed(lambda: processor.template_cache.get(template_path))
+        _, fill_ms = timed(lambda: processor.process_document(template_path, invoice, output_path))
+        pdf_content, pdf_ms = timed(lambda: processor.generate_invoice_pdf(invoice, DEFAULT_TEMPLATE))
+
+        result = {
+            'benchmark': 'template',
+            'backend': backend,
+            'items': item_count,
+            'rows_per_sec': round(item_count / (pdf_ms / 1000)) if pdf_ms else None,
+            'pdf_bytes': len(pdf_content),
+            'stages': {
+                'template_load_ms': round(load_ms, 3),
+                'docx_fill_ms': round(fill_ms, 3),
+                'pdf_ms': round(pdf_ms, 3),
+            },
+        }
+        if measure_memory:
+            result['peak_bytes'] = peak_memory(lambda: processor.generate_invoice_pdf(invoice, DEFAULT_TEMPLATE))
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark exports and template rendering on synthetic invoices, one JSON object per line")
+    parser.add_argument('--scales', default='1000,10000,100000',
+                        help="Comma separated invoice counts for the export benchmark")
+    parser.add_argument('--formats', help="Comma separated export formats (default: all)")
+    parser.add_argument('--min-items', type=int, default=1)
+    parser.add_argument('--max-items', type=int, default=10)
+    parser.add_argument('--text-size', type=int, default=40)
+    parser.add_argument('--date-spread-days', type=int, default=365)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--template-items', default='10,100,1000',
+                        help="Comma separated item counts for the template benchmark, empty to skip it")
+    parser.add_argument('--templates-dir',
+                        help="Directory holding the template to fill (default: a generated template "
+                             "whose items table has an {{item_...}} row)")
+    parser.add_argument('--backend', default='native', help="PDF backend for the template benchmark")
+    parser.add_argument('--no-memory', action='store_true',
+                        help="Skip the extra traced run that measures peak memory")
+    parser.add_argument('--output', metavar='PATH', help="Append results to a file instead of stdout")
+    args = parser.parse_args()
+
+    output = open(args.output, 'a') if args.output else sys.stdout
+    formats = args.formats.split(',') if args.formats else list(EXPORT_FORMATS)
+
+    def emit(result: Dict[str, Any]):
+        output.write(json.dumps(result) + '\n')
+        output.flush()
+
+    emit(environment())
+    for count in (int(scale) for scale in args.scales.split(',') if scale):
+        generator = InvoiceGenerator(count, args.min_items, args.max_items, args.text_size,
+                                     args.date_spread_days, seed=args.seed)
+        for result in bench_exports(generator, formats, not args.no_memory):
+            emit(result)
+
+    for item_count in (int(size) for size in args.template_items.split(',') if size):
+        try:
+            emit(bench_template(item_count, args.templates_dir, args.backend, not args.no_memory))
+        except Exception as e:
+            # Template rendering needs python-docx, and docx2pdf a Word engine
+            emit({'benchmark': 'template', 'backend': args.backend, 'items': item_count, 'skipped': str(e)})
+
+    if args.output:
+        output.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Synthetic Invoices
+Deterministic invoice generator for benchmarks, shaped like the invoices table and the template data
+"""
+
+import argparse
+import json
+import random
+import string
+import sys
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Any, Iterator, Optional, TextIO
+
+STATUSES = ['pending', 'paid', 'overdue', 'draft']
+
+CITIES = [('Cape Town', 'South Africa'), ('Johannesburg', 'South Africa'), ('London', 'United Kingdom'),
+          ('Berlin', 'Germany'), ('Austin', 'United States'), ('Nairobi', 'Kenya')]
+
+VAT_RATES = ['0', '7.5', '15', '20']
+
+class InvoiceGenerator:
+    """Generates reproducible invoices
+
+    count: invoices to generate
+    min_items / max_items: item fan-out per invoice, drawn uniformly
+    text_size: length of item descriptions and notes, in characters
+    date_spread_days: invoice dates fall this many days before start_date at most
+    clients: number of distinct clients invoices are spread over
+    """
+
+    def __init__(self, count: int = 1000, min_items: int = 1, max_items: int = 10, text_size: int = 40,
+                 date_spread_days: int = 365, clients: int = 200, seed: int = 42,
+                 start_date: Optional[datetime] = None):
+        self.count = count
+        self.min_items = min_items
+        self.max_items = max_items
+        self.text_size = text_size
+        self.date_spread_days = date_spread_days
+        self.clients = clients
+        self.seed = seed
+        self.start_date = start_date or datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+    def _text(self, rng: random.Random, size: int) -> str:
+        words = []
+        length = 0
+        while length < size:
+            word = ''.join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 9)))
+            words.append(word)
+            length += len(word) + 1
+        return ' '.join(words)[:size]
+
+    def _client(self, rng: random.Random, number: int) -> Dict[str, str]:
+        city, country = CITIES[number % len(CITIES)]
+        return {
+            'clientName': f"Client {number:05d} (Pty) Ltd",
+            'clientEmail': f"accounts{number}@client{number}.example",
+            'clientPhone': f"+27 21 555 {number % 10000:04d}",
+            'addressLine1': f"{rng.randint(1, 400)} Main Road",
+            'city': city,
+            'country': country,
+        }
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        rng = random.Random(self.seed)
+        clients = [self._client(rng, number) for number in range(self.clients)]
+
+        for number in range(self.count):
+            items = []
+            subtotal = 0.0
+            for item_number in range(rng.randint(self.min_items, self.max_items)):
+                quantity = rng.randint(1, 20)
+                rate = round(rng.uniform(5, 500), 2)
+                amount = round(quantity * rate, 2)
+                subtotal += amount
+                items.append({
+                    'name': f"Service {item_number + 1}",
+                    'description': self._text(rng, self.text_size),
+                    'quantity': quantity,
+                    'rate': rate,
+                    'amount': amount,
+                })
+
+            vat = rng.choice(VAT_RATES)
+            vat_amount = subtotal * float(vat) / 100
+            invoice_date = self.start_date - timedelta(days=rng.randint(0, self.date_spread_days),
+                                                       seconds=rng.randint(0, 86399))
+            due_date = invoice_date + timedelta(days=rng.choice([7, 14, 30, 60]))
+            updated_at = invoice_date + timedelta(days=rng.randint(0, 10))
+
+            invoice = {
+                'id': number + 1,
+                'invoiceNumber': f"INV-{number + 1:07d}",
+                'companyName': 'Zentura Works',
+                'companyAddress': '12 Harbour Street, Cape Town',
+                'companyPhone': '+27 21 555 0100',
+                'companyEmail': 'billing@zentura.example',
+                'invoiceDate': invoice_date.isoformat().replace('+00:00', 'Z'),
+                'dueDate': due_date.isoformat().replace('+00:00', 'Z'),
+                'updatedAt': updated_at.isoformat().replace('+00:00', 'Z'),
+                'invoiceType': 'standard',
+                'items': items,
+                'subtotal': f"{subtotal:.2f}",
+                'discount': '0',
+                'vat': vat,
+                'vatRate': float(vat),
+                'vatAmount': round(vat_amount, 2),
+                'deposit': '0',
+                'total': f"{subtotal + vat_amount:.2f}",
+                'status': rng.choice(STATUSES),
+                'notes': self._text(rng, self.text_size),
+            }
+            invoice.update(clients[rng.randrange(self.clients)])
+            invoice['clientAddress'] = f"{invoice['addressLine1']}, {invoice['city']}"
+            yield invoice
+
+    def write_ndjson(self, output: TextIO) -> int:
+        """Write the invoices one per line, returning the number of bytes written"""
+        written = 0
+        for invoice in self:
+            line = json.dumps(invoice) + '\n'
+            output.write(line)
+            written += len(line)
+        return written
+
+def main():
+    parser = argparse.ArgumentParser(description="Write synthetic invoices as NDJSON to stdout")
+    parser.add_argument('--count', type=int, default=1000)
+    parser.add_argument('--min-items', type=int, default=1)
+    parser.add_argument('--max-items', type=int, default=10)
+    parser.add_argument('--text-size', type=int, default=40)
+    parser.add_argument('--date-spread-days', type=int, default=365)
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    InvoiceGenerator(args.count, args.min_items, args.max_items, args.text_size,
+                     args.date_spread_days, args.clients, args.seed).write_ndjson(sys.stdout)
+
+if __name__ == "__main__":
+    main()
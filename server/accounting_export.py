@@ -4,228 +4,760 @@ Accounting Software Export Module
 Exports invoice data to various accounting software formats
 """
 
+import argparse
 import json
+import os
 import sys
 import csv
+import tempfile
+import zipfile
 from io import StringIO
 from datetime import datetime
-from typing import Dict, List, Any, Optional
+from functools import lru_cache
+from operator import attrgetter
+from typing import Dict, List, Any, Optional, Iterable, Iterator, TextIO, BinaryIO, Tuple, Union, Callable
 import xml.etree.ElementTree as ET
 
-class AccountingExporter:
-    def __init__(self):
-        self.supported_formats = [
-            'quickbooks_iif',
-            'xero_csv', 
-            'sage_csv',
-            'freshbooks_csv',
-            'wave_csv',
-            'generic_csv'
-        ]
-    
-    def export_to_quickbooks_iif(self, invoices: List[Dict[str, Any]]) -> str:
-        """Export invoices to QuickBooks IIF format"""
-        iif_content = []
-        iif_content.append("!HDR\tPROD\tVER\tREL\tIIFVER\tDATE\tTIME\tACCNT")
-        iif_content.append("HDR\tQuickBooks Pro\t2023\tRelease\t1\t" + 
-                          datetime.now().strftime("%m/%d/%Y") + "\t" +
-                          datetime.now().strftime("%H:%M:%S") + "\tN")
+from invoice_columns import InvoiceColumns, SUMMARY_GROUPS, format_cents
+from export_state import ExportState, ExportDelta
+from invoice_input import NdjsonInvoiceFile, RawJson, iter_ndjson
+
+# Buffered output is handed on once it reaches this many characters
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+# Exports bound for an archive are held in memory up to this size, then spill to disk
+ARCHIVE_SPOOL_SIZE = 8 * 1024 * 1024
+
+# Invoices are gathered into column blocks of this many rows for bulk arithmetic
+COLUMN_BLOCK_SIZE = 4096
+
+SUMMARY_FIELDNAMES = [
+    'Group', 'Key', 'Invoices', 'Subtotal', 'Tax', 'Total'
+]
+
+
+@lru_cache(maxsize=4096)
+def parse_iso_date(value: str) -> datetime:
+    """Parse an ISO-8601 timestamp as sent by the API (trailing Z allowed)"""
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+@lru_cache(maxsize=8192)
+def format_date(value: datetime, pattern: str) -> str:
+    """strftime, cached per (date, pattern) since exports repeat the same few dates"""
+    return value.strftime(pattern)
+
+class NormalizedInvoice:
+    """An invoice parsed once for export: dates as datetimes, money as floats, items decoded on first use
+    
+    Text fields keep their original representation so exported values match the input exactly.
+    """
+    
+    __slots__ = (
+        'invoice_number', 'client_name', 'client_email', 'address_line1', 'city', 'country',
+        'invoice_date', 'due_date', 'subtotal', 'total', 'discount', 'vat', 'vat_rate',
+        '_tax_amount', 'status', 'status_title', 'notes', '_items', '_items_json', '_items_raw'
+    )
+    
+    def __init__(self, invoice: Dict[str, Any]):
+        self.invoice_number = invoice['invoiceNumber']
+        self.client_name = invoice['clientName']
+        self.client_email = invoice['clientEmail']
+        self.address_line1 = invoice['addressLine1']
+        self.city = invoice['city']
+        self.country = invoice['country']
         
-        iif_content.append("!TRNS\tTRNSTYPE\tDATE\tACCNT\tNAME\tCLASS\tAMOUNT\tDOCNUM\tMEMO\tCLEAR\tTOPRINT\tNAMEADDR1\tNAMEADDR2\tNAMEADDR3\tNAMEADDR4\tNAMEADDR5\tDUEDATE\tTERMS\tPAID\tSHIPDATE")
+        self.invoice_date = parse_iso_date(invoice['invoiceDate'])
+        self.due_date = parse_iso_date(invoice['dueDate'])
         
-        for invoice in invoices:
-            # Transaction header
-            date_str = datetime.fromisoformat(invoice['invoiceDate'].replace('Z', '+00:00')).strftime("%m/%d/%Y")
-            due_date_str = datetime.fromisoformat(invoice['dueDate'].replace('Z', '+00:00')).strftime("%m/%d/%Y")
-            
-            iif_content.append(f"TRNS\tINVOICE\t{date_str}\tAccounts Receivable\t{invoice['clientName']}\t\t{invoice['total']}\t{invoice['invoiceNumber']}\t\tN\tY\t{invoice['addressLine1']}\t{invoice['city']}\t{invoice['country']}\t\t\t{due_date_str}\tNet 30\tN\t")
-            
-            # Items
-            items = json.loads(invoice['items']) if isinstance(invoice['items'], str) else invoice['items']
-            for item in items:
-                iif_content.append(f"SPL\t{date_str}\tSales\t{invoice['clientName']}\t\t-{item['amount']}\t{invoice['invoiceNumber']}\t{item['name']}: {item.get('description', '')}\tN\tY")
+        self.subtotal = invoice['subtotal']
+        self.total = invoice['total']
+        self.discount = invoice.get('discount', '0')
+        self.vat = invoice.get('vat')
+        self.vat_rate = float(self.vat) if self.vat else 0.0
+        # Filled in lazily, or for a whole block at once by InvoiceColumns
+        self._tax_amount = None
         
-        iif_content.append("ENDTRNS")
-        return "\n".join(iif_content)
-    
-    def export_to_xero_csv(self, invoices: List[Dict[str, Any]]) -> str:
-        """Export invoices to Xero CSV format"""
-        output = StringIO()
-        fieldnames = [
-            'ContactName', 'EmailAddress', 'POAddressLine1', 'POCity', 'POCountry',
-            'InvoiceNumber', 'InvoiceDate', 'DueDate', 'Total', 'Status',
-            'Description', 'Quantity', 'UnitAmount', 'AccountCode', 'TaxType'
-        ]
+        self.status = invoice['status']
+        self.status_title = self.status.title()
+        self.notes = invoice.get('notes', '')
         
-        writer = csv.DictWriter(output, fieldnames=fieldnames)
-        writer.writeheader()
+        # Items arrive as an undecoded array from NDJSON files, a JSON string, or already decoded
+        items = invoice['items']
+        self._items_raw = None
+        if isinstance(items, RawJson):
+            self._items = None
+            self._items_json = None
+            self._items_raw = items
+        elif isinstance(items, str):
+            self._items = None
+            self._items_json = items
+        else:
+            self._items = items
+            self._items_json = None
+    
+    @property
+    def tax_amount(self) -> float:
+        if self._tax_amount is None:
+            self._tax_amount = self.vat_rate / 100 * float(self.subtotal) if self.vat else 0
+        return self._tax_amount
+    
+    @tax_amount.setter
+    def tax_amount(self, value: float):
+        self._tax_amount = value
+    
+    @property
+    def items(self) -> List[Dict[str, Any]]:
+        if self._items is None:
+            self._items = json.loads(self._items_raw if self._items_raw is not None else self._items_json)
+        return self._items
+    
+    @property
+    def items_json(self) -> str:
+        if self._items_json is None:
+            self._items_json = json.dumps(self.items)
+        return self._items_json
+
+def normalize_invoice(invoice) -> NormalizedInvoice:
+    """Normalize a raw invoice dict, passing already-normalized records through"""
+    if isinstance(invoice, NormalizedInvoice):
+        return invoice
+    return NormalizedInvoice(invoice)
+
+def parse_formats(value: Union[str, List[str]]) -> List[str]:
+    """Split a comma separated format list, dropping duplicates but keeping order"""
+    names = value.split(',') if isinstance(value, str) else value
+    return list(dict.fromkeys(name.strip() for name in names if name.strip()))
+
+def export_filename(format_type: str) -> str:
+    """Archive member name for an export format"""
+    extension = 'iif' if format_type.endswith('_iif') else 'csv'
+    return f"export_{format_type}.{extension}"
+
+class CountingIterator:
+    """Passes items through while counting them"""
+    
+    def __init__(self, items: Iterable[Any]):
+        self.items = iter(items)
+        self.count = 0
+    
+    def __iter__(self):
+        return self
+    
+    def __next__(self):
+        item = next(self.items)
+        self.count += 1
+        return item
+
+class ExportSink:
+    """Renders one export invoice by invoice, handing output on in bounded chunks"""
+    
+    # Whether the sink needs column blocks, which cost a little extra to build
+    uses_columns = False
+    
+    def __init__(self, chunk_size: int):
+        self.chunk_size = chunk_size
+        self.buffer = StringIO()
+        self.chunks: List[str] = []
+    
+    def add_columns(self, columns: InvoiceColumns):
+        """Receive a column block ahead of its invoices; row oriented sinks ignore it"""
+    
+    def add(self, invoice: NormalizedInvoice):
+        raise NotImplementedError
+    
+    def finish(self):
+        self._flush(force=True)
+    
+    def take_chunks(self) -> List[str]:
+        """Return the chunks completed since the last call"""
+        chunks, self.chunks = self.chunks, []
+        return chunks
+    
+    def _flush(self, force: bool = False):
+        size = self.buffer.tell()
+        if size >= self.chunk_size or (force and size):
+            self.chunks.append(self.buffer.getvalue())
+            self.buffer.seek(0)
+            self.buffer.truncate()
+
+class CsvExportSink(ExportSink):
+    """CSV export with a header row and one or more rows per invoice"""
+    
+    def __init__(self, headers: List[str], rows: Callable[[NormalizedInvoice], Iterable[Tuple[Any, ...]]],
+                 chunk_size: int):
+        super().__init__(chunk_size)
+        self.rows = rows
+        self.writer = csv.writer(self.buffer)
+        self.writer.writerow(headers)
+    
+    def add(self, invoice: NormalizedInvoice):
+        self.writer.writerows(self.rows(invoice))
+        self._flush()
+
+class LineExportSink(ExportSink):
+    """Newline separated export with no trailing newline, as IIF files are written"""
+    
+    def __init__(self, header_lines: Iterable[str], lines: Callable[[NormalizedInvoice], Iterable[str]],
+                 footer_lines: Iterable[str], chunk_size: int):
+        super().__init__(chunk_size)
+        self.lines = lines
+        self.footer_lines = footer_lines
+        self.first_line = True
+        self._write_lines(header_lines)
+    
+    def _write_lines(self, lines: Iterable[str]):
+        for line in lines:
+            if not self.first_line:
+                self.buffer.write('\n')
+            self.buffer.write(line)
+            self.first_line = False
+    
+    def add(self, invoice: NormalizedInvoice):
+        self._write_lines(self.lines(invoice))
+        self._flush()
+    
+    def finish(self):
+        self._write_lines(self.footer_lines)
+        super().finish()
+
+class SummaryExportSink(ExportSink):
+    """Totals by client, status and invoice month, written once every invoice has been seen"""
+    
+    uses_columns = True
+    
+    def __init__(self, chunk_size: int, group_by: Iterable[str] = SUMMARY_GROUPS):
+        super().__init__(chunk_size)
+        self.group_by = list(group_by)
+        self.columns = InvoiceColumns()
+    
+    def add_columns(self, columns: InvoiceColumns):
+        self.columns.extend_columns(columns)
+    
+    def add(self, invoice: NormalizedInvoice):
+        pass
+    
+    def finish(self):
+        writer = csv.writer(self.buffer)
+        writer.writerow(SUMMARY_FIELDNAMES)
         
-        for invoice in invoices:
-            items = json.loads(invoice['items']) if isinstance(invoice['items'], str) else invoice['items']
+        groups = [(group_by, self.columns.group_totals(group_by)) for group_by in self.group_by]
+        groups.append(('all', [dict(self.columns.totals(), label='total')]))
+        for group_by, totals in groups:
+            for group in totals:
+                writer.writerow([
+                    group_by, group['label'], group['count'],
+                    format_cents(group['subtotal_cents']),
+                    format_cents(group['tax_cents']),
+                    format_cents(group['total_cents']),
+                ])
+                self._flush()
+        super().finish()
+
+class ExportColumn:
+    """One CSV column: its header and the function that computes its value
+    
+    Invoice columns are called with the normalized invoice, once per invoice even in
+    per-item formats. Item columns (per_item=True) are called with the invoice, the
+    current item and its position.
+    """
+    
+    def __init__(self, header: str, value: Callable[..., Any], per_item: bool = False):
+        self.header = header
+        self.value = value
+        self.per_item = per_item
+
+def constant(value: Any) -> Callable[[NormalizedInvoice], Any]:
+    """Column function that ignores the invoice"""
+    return lambda invoice: value
+
+class CsvExportFormat:
+    """A CSV export format whose columns are combined once into one row-building function
+    
+    The function returns a tuple per row for csv.writer, so no per-row dict is built.
+    Invoice columns of a per-item format, such as formatted dates, are computed once for
+    all the invoice's rows.
+    """
+    
+    def __init__(self, name: str, columns: List[ExportColumn], per_item: bool = False):
+        self.name = name
+        self.columns = list(columns)
+        self.per_item = per_item
+        self.headers = [column.header for column in self.columns]
+        self.rows = self._compile()
+    
+    def _compile(self) -> Callable[[NormalizedInvoice], List[Tuple[Any, ...]]]:
+        invoice_values = [column.value for column in self.columns if not column.per_item]
+        if not self.per_item:
+            if len(invoice_values) != len(self.columns):
+                raise ValueError(f"{self.name} has item columns but is not a per-item format")
             
-            for item in items:
-                row = {
-                    'ContactName': invoice['clientName'],
-                    'EmailAddress': invoice['clientEmail'],
-                    'POAddressLine1': invoice['addressLine1'],
-                    'POCity': invoice['city'],
-                    'POCountry': invoice['country'],
-                    'InvoiceNumber': invoice['invoiceNumber'],
-                    'InvoiceDate': datetime.fromisoformat(invoice['invoiceDate'].replace('Z', '+00:00')).strftime("%d/%m/%Y"),
-                    'DueDate': datetime.fromisoformat(invoice['dueDate'].replace('Z', '+00:00')).strftime("%d/%m/%Y"),
-                    'Total': invoice['total'],
-                    'Status': invoice['status'].upper(),
-                    'Description': f"{item['name']}: {item.get('description', '')}",
-                    'Quantity': item['quantity'],
-                    'UnitAmount': item['rate'],
-                    'AccountCode': '200',  # Sales account
-                    'TaxType': 'GST'
-                }
-                writer.writerow(row)
-        
-        return output.getvalue()
-    
-    def export_to_sage_csv(self, invoices: List[Dict[str, Any]]) -> str:
-        """Export invoices to Sage CSV format"""
-        output = StringIO()
-        fieldnames = [
-            'Customer', 'Invoice_No', 'Date', 'Due_Date', 'Reference',
-            'Description', 'Net_Amount', 'Tax_Amount', 'Total_Amount',
-            'Status', 'Currency'
-        ]
-        
-        writer = csv.DictWriter(output, fieldnames=fieldnames)
-        writer.writeheader()
+            def rows(invoice: NormalizedInvoice) -> List[Tuple[Any, ...]]:
+                return [tuple([value(invoice) for value in invoice_values])]
+            return rows
         
-        for invoice in invoices:
-            vat_amount = float(invoice.get('vat', 0)) / 100 * float(invoice['subtotal']) if invoice.get('vat') else 0
-            
-            row = {
-                'Customer': invoice['clientName'],
-                'Invoice_No': invoice['invoiceNumber'],
-                'Date': datetime.fromisoformat(invoice['invoiceDate'].replace('Z', '+00:00')).strftime("%d/%m/%Y"),
-                'Due_Date': datetime.fromisoformat(invoice['dueDate'].replace('Z', '+00:00')).strftime("%d/%m/%Y"),
-                'Reference': invoice['invoiceNumber'],
-                'Description': f"Invoice for {invoice['clientName']}",
-                'Net_Amount': invoice['subtotal'],
-                'Tax_Amount': f"{vat_amount:.2f}",
-                'Total_Amount': invoice['total'],
-                'Status': invoice['status'].title(),
-                'Currency': 'USD'
-            }
-            writer.writerow(row)
+        # Item cells are written over a row pre-filled with the invoice cells
+        invoice_positions = [position for position, column in enumerate(self.columns) if not column.per_item]
+        item_cells = [(position, column.value) for position, column in enumerate(self.columns)
+                      if column.per_item]
+        width = len(self.columns)
         
-        return output.getvalue()
+        def rows(invoice: NormalizedInvoice) -> List[Tuple[Any, ...]]:
+            base = [None] * width
+            for position, value in zip(invoice_positions, invoice_values):
+                base[position] = value(invoice)
+            result = []
+            for index, item in enumerate(invoice.items):
+                row = base.copy()
+                for position, value in item_cells:
+                    row[position] = value(invoice, item, index)
+                result.append(tuple(row))
+            return result
+        return rows
     
-    def export_to_wave_csv(self, invoices: List[Dict[str, Any]]) -> str:
-        """Export invoices to Wave CSV format"""
-        output = StringIO()
-        fieldnames = [
-            'Customer name', 'Customer email', 'Invoice number', 'Invoice date',
-            'Due date', 'Product/Service', 'Description', 'Quantity', 'Rate',
-            'Amount', 'Tax name', 'Tax rate', 'Invoice total', 'Invoice status'
-        ]
+    def with_layout(self, layout: List[Dict[str, Any]]) -> "CsvExportFormat":
+        """The same format with columns selected, renamed, reordered or fixed to constant values
         
-        writer = csv.DictWriter(output, fieldnames=fieldnames)
-        writer.writeheader()
+        Each layout entry is either {"column": <existing header>, "header": <new header>} or
+        {"header": <header>, "value": <constant>}; the header of a column entry is optional.
+        """
+        by_header = {column.header: column for column in self.columns}
+        columns = []
+        for entry in layout:
+            if 'value' in entry:
+                columns.append(ExportColumn(str(entry.get('header', '')), constant(entry['value'])))
+                continue
+            column = by_header.get(entry.get('column'))
+            if column is None:
+                raise ValueError(f"Unknown column for {self.name}: {entry.get('column')}")
+            columns.append(ExportColumn(str(entry.get('header', column.header)), column.value, column.per_item))
+        return CsvExportFormat(self.name, columns, self.per_item)
+    
+    def create_sink(self, chunk_size: int) -> ExportSink:
+        return CsvExportSink(self.headers, self.rows, chunk_size)
+
+def quickbooks_iif_header_lines() -> Iterator[str]:
+    """Yield the header lines of a QuickBooks IIF export"""
+    yield "!HDR\tPROD\tVER\tREL\tIIFVER\tDATE\tTIME\tACCNT"
+    yield ("HDR\tQuickBooks Pro\t2023\tRelease\t1\t" + 
+           datetime.now().strftime("%m/%d/%Y") + "\t" +
+           datetime.now().strftime("%H:%M:%S") + "\tN")
+    
+    yield "!TRNS\tTRNSTYPE\tDATE\tACCNT\tNAME\tCLASS\tAMOUNT\tDOCNUM\tMEMO\tCLEAR\tTOPRINT\tNAMEADDR1\tNAMEADDR2\tNAMEADDR3\tNAMEADDR4\tNAMEADDR5\tDUEDATE\tTERMS\tPAID\tSHIPDATE"
+
+def quickbooks_iif_lines(invoice: NormalizedInvoice) -> Iterator[str]:
+    """Yield the QuickBooks IIF transaction lines of one invoice"""
+    # Transaction header
+    date_str = format_date(invoice.invoice_date, "%m/%d/%Y")
+    due_date_str = format_date(invoice.due_date, "%m/%d/%Y")
+    
+    yield f"TRNS\tINVOICE\t{date_str}\tAccounts Receivable\t{invoice.client_name}\t\t{invoice.total}\t{invoice.invoice_number}\t\tN\tY\t{invoice.address_line1}\t{invoice.city}\t{invoice.country}\t\t\t{due_date_str}\tNet 30\tN\t"
+    
+    # Items
+    for item in invoice.items:
+        yield f"SPL\t{date_str}\tSales\t{invoice.client_name}\t\t-{item['amount']}\t{invoice.invoice_number}\t{item['name']}: {item.get('description', '')}\tN\tY"
+
+class IifExportFormat:
+    """QuickBooks IIF, written line by line with a fixed layout"""
+    
+    def __init__(self, name: str):
+        self.name = name
+    
+    def with_layout(self, layout: List[Dict[str, Any]]) -> "IifExportFormat":
+        raise ValueError(f"{self.name} does not support column layouts")
+    
+    def create_sink(self, chunk_size: int) -> ExportSink:
+        return LineExportSink(quickbooks_iif_header_lines(), quickbooks_iif_lines, ["ENDTRNS"], chunk_size)
+
+class SummaryExportFormat:
+    """Group totals, see SummaryExportSink"""
+    
+    def __init__(self, name: str):
+        self.name = name
+    
+    def with_layout(self, layout: List[Dict[str, Any]]) -> "SummaryExportFormat":
+        raise ValueError(f"{self.name} does not support column layouts")
+    
+    def create_sink(self, chunk_size: int) -> ExportSink:
+        return SummaryExportSink(chunk_size)
+
+# Export formats by name, in the order they are offered
+EXPORT_FORMATS: Dict[str, Any] = {}
+
+def register_export_format(export_format: Any) -> Any:
+    """Add a format to the registry, replacing any format of the same name"""
+    EXPORT_FORMATS[export_format.name] = export_format
+    return export_format
+
+register_export_format(IifExportFormat('quickbooks_iif'))
+
+def invoice_date_as(date_format: str) -> Callable[[NormalizedInvoice], str]:
+    return lambda invoice: format_date(invoice.invoice_date, date_format)
+
+def due_date_as(date_format: str) -> Callable[[NormalizedInvoice], str]:
+    return lambda invoice: format_date(invoice.due_date, date_format)
+
+def item_field(name: str) -> Callable[[NormalizedInvoice, Dict[str, Any], int], Any]:
+    return lambda invoice, item, index: item[name]
+
+def item_description(invoice: NormalizedInvoice, item: Dict[str, Any], index: int) -> Any:
+    return item.get('description', '')
+
+def vat_tax_name(invoice: NormalizedInvoice) -> str:
+    return 'VAT' if invoice.vat_rate > 0 else ''
+
+register_export_format(CsvExportFormat('xero_csv', per_item=True, columns=[
+    ExportColumn('ContactName', attrgetter('client_name')),
+    ExportColumn('EmailAddress', attrgetter('client_email')),
+    ExportColumn('POAddressLine1', attrgetter('address_line1')),
+    ExportColumn('POCity', attrgetter('city')),
+    ExportColumn('POCountry', attrgetter('country')),
+    ExportColumn('InvoiceNumber', attrgetter('invoice_number')),
+    ExportColumn('InvoiceDate', invoice_date_as("%d/%m/%Y")),
+    ExportColumn('DueDate', due_date_as("%d/%m/%Y")),
+    ExportColumn('Total', attrgetter('total')),
+    ExportColumn('Status', lambda invoice: invoice.status.upper()),
+    ExportColumn('Description', lambda invoice, item, index: f"{item['name']}: {item.get('description', '')}",
+                 per_item=True),
+    ExportColumn('Quantity', item_field('quantity'), per_item=True),
+    ExportColumn('UnitAmount', item_field('rate'), per_item=True),
+    ExportColumn('AccountCode', constant('200')),  # Sales account
+    ExportColumn('TaxType', constant('GST')),
+]))
+
+register_export_format(CsvExportFormat('sage_csv', columns=[
+    ExportColumn('Customer', attrgetter('client_name')),
+    ExportColumn('Invoice_No', attrgetter('invoice_number')),
+    ExportColumn('Date', invoice_date_as("%d/%m/%Y")),
+    ExportColumn('Due_Date', due_date_as("%d/%m/%Y")),
+    ExportColumn('Reference', attrgetter('invoice_number')),
+    ExportColumn('Description', lambda invoice: f"Invoice for {invoice.client_name}"),
+    ExportColumn('Net_Amount', attrgetter('subtotal')),
+    ExportColumn('Tax_Amount', lambda invoice: f"{invoice.tax_amount:.2f}"),
+    ExportColumn('Total_Amount', attrgetter('total')),
+    ExportColumn('Status', attrgetter('status_title')),
+    ExportColumn('Currency', constant('USD')),
+]))
+
+register_export_format(CsvExportFormat('freshbooks_csv', per_item=True, columns=[
+    ExportColumn('Client Name', attrgetter('client_name')),
+    ExportColumn('Email', attrgetter('client_email')),
+    ExportColumn('Invoice #', attrgetter('invoice_number')),
+    ExportColumn('Date Issued', invoice_date_as("%Y-%m-%d")),
+    ExportColumn('Due Date', due_date_as("%Y-%m-%d")),
+    ExportColumn('Invoice Status', attrgetter('status_title')),
+    ExportColumn('Item Name', item_field('name'), per_item=True),
+    ExportColumn('Item Description', item_description, per_item=True),
+    ExportColumn('Rate', lambda invoice, item, index: f"{float(item['rate']):.2f}", per_item=True),
+    ExportColumn('Quantity', item_field('quantity'), per_item=True),
+    ExportColumn('Line Subtotal', lambda invoice, item, index: f"{float(item['amount']):.2f}", per_item=True),
+    ExportColumn('Tax 1 Type', vat_tax_name),
+    ExportColumn('Tax 1 Percent', lambda invoice: f"{invoice.vat_rate:g}" if invoice.vat_rate > 0 else ''),
+    ExportColumn('Tax 1 Amount',
+                 lambda invoice, item, index: f"{float(item['amount']) * (invoice.vat_rate / 100):.2f}",
+                 per_item=True),
+    ExportColumn('Line Total',
+                 lambda invoice, item, index: f"{float(item['amount']) * (1 + invoice.vat_rate / 100):.2f}",
+                 per_item=True),
+    ExportColumn('Invoice Total', attrgetter('total')),
+    ExportColumn('Currency', constant('USD')),
+]))
+
+register_export_format(CsvExportFormat('wave_csv', per_item=True, columns=[
+    ExportColumn('Customer name', attrgetter('client_name')),
+    ExportColumn('Customer email', attrgetter('client_email')),
+    ExportColumn('Invoice number', attrgetter('invoice_number')),
+    ExportColumn('Invoice date', invoice_date_as("%Y-%m-%d")),
+    ExportColumn('Due date', due_date_as("%Y-%m-%d")),
+    ExportColumn('Product/Service', item_field('name'), per_item=True),
+    ExportColumn('Description', item_description, per_item=True),
+    ExportColumn('Quantity', item_field('quantity'), per_item=True),
+    ExportColumn('Rate', lambda invoice, item, index: f"{item['rate']:.2f}", per_item=True),
+    ExportColumn('Amount', lambda invoice, item, index: f"{item['amount']:.2f}", per_item=True),
+    ExportColumn('Tax name', vat_tax_name),
+    ExportColumn('Tax rate', lambda invoice: f"{invoice.vat}%" if invoice.vat else ''),
+    # Only show total on first item
+    ExportColumn('Invoice total', lambda invoice, item, index: invoice.total if index == 0 else '', per_item=True),
+    ExportColumn('Invoice status', attrgetter('status_title')),
+]))
+
+register_export_format(CsvExportFormat('generic_csv', columns=[
+    ExportColumn('Invoice Number', attrgetter('invoice_number')),
+    ExportColumn('Client Name', attrgetter('client_name')),
+    ExportColumn('Client Email', attrgetter('client_email')),
+    ExportColumn('Invoice Date', invoice_date_as("%Y-%m-%d")),
+    ExportColumn('Due Date', due_date_as("%Y-%m-%d")),
+    ExportColumn('Subtotal', attrgetter('subtotal')),
+    ExportColumn('Discount', attrgetter('discount')),
+    ExportColumn('Tax Rate', lambda invoice: f"{invoice.vat if invoice.vat is not None else '0'}%"),
+    ExportColumn('Tax Amount', lambda invoice: f"{invoice.tax_amount:.2f}"),
+    ExportColumn('Total', attrgetter('total')),
+    ExportColumn('Status', attrgetter('status_title')),
+    ExportColumn('Notes', attrgetter('notes')),
+    ExportColumn('Items JSON', attrgetter('items_json')),
+]))
+
+register_export_format(SummaryExportFormat('summary_csv'))
+
+class AccountingExporter:
+    def __init__(self, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 layouts: Optional[Dict[str, List[Dict[str, Any]]]] = None):
+        # Tenant layouts are compiled here, once, so rows cost the same as the default layout
+        self.formats = dict(EXPORT_FORMATS)
+        for format_type, layout in (layouts or {}).items():
+            if format_type not in self.formats:
+                raise ValueError(f"Unsupported format: {format_type}")
+            self.formats[format_type] = self.formats[format_type].with_layout(layout)
         
-        for invoice in invoices:
-            items = json.loads(invoice['items']) if isinstance(invoice['items'], str) else invoice['items']
-            
-            for i, item in enumerate(items):
-                row = {
-                    'Customer name': invoice['clientName'],
-                    'Customer email': invoice['clientEmail'],
-                    'Invoice number': invoice['invoiceNumber'],
-                    'Invoice date': datetime.fromisoformat(invoice['invoiceDate'].replace('Z', '+00:00')).strftime("%Y-%m-%d"),
-                    'Due date': datetime.fromisoformat(invoice['dueDate'].replace('Z', '+00:00')).strftime("%Y-%m-%d"),
-                    'Product/Service': item['name'],
-                    'Description': item.get('description', ''),
-                    'Quantity': item['quantity'],
-                    'Rate': f"{item['rate']:.2f}",
-                    'Amount': f"{item['amount']:.2f}",
-                    'Tax name': 'VAT' if invoice.get('vat') and float(invoice['vat']) > 0 else '',
-                    'Tax rate': f"{invoice.get('vat', 0)}%" if invoice.get('vat') else '',
-                    'Invoice total': invoice['total'] if i == 0 else '',  # Only show total on first item
-                    'Invoice status': invoice['status'].title()
-                }
-                writer.writerow(row)
-        
-        return output.getvalue()
-    
-    def export_to_generic_csv(self, invoices: List[Dict[str, Any]]) -> str:
+        self.supported_formats = list(self.formats)
+        self.chunk_size = chunk_size
+    
+    def export_to_quickbooks_iif(self, invoices: Iterable[Dict[str, Any]]) -> str:
+        """Export invoices to QuickBooks IIF format"""
+        return ''.join(self.iter_export(invoices, 'quickbooks_iif'))
+    
+    def export_to_xero_csv(self, invoices: Iterable[Dict[str, Any]]) -> str:
+        """Export invoices to Xero CSV format"""
+        return ''.join(self.iter_export(invoices, 'xero_csv'))
+    
+    def export_to_sage_csv(self, invoices: Iterable[Dict[str, Any]]) -> str:
+        """Export invoices to Sage CSV format"""
+        return ''.join(self.iter_export(invoices, 'sage_csv'))
+    
+    def export_to_freshbooks_csv(self, invoices: Iterable[Dict[str, Any]]) -> str:
+        """Export invoices to FreshBooks CSV format"""
+        return ''.join(self.iter_export(invoices, 'freshbooks_csv'))
+    
+    def export_to_wave_csv(self, invoices: Iterable[Dict[str, Any]]) -> str:
+        """Export invoices to Wave CSV format"""
+        return ''.join(self.iter_export(invoices, 'wave_csv'))
+    
+    def export_to_generic_csv(self, invoices: Iterable[Dict[str, Any]]) -> str:
         """Export invoices to generic CSV format"""
-        output = StringIO()
-        fieldnames = [
-            'Invoice Number', 'Client Name', 'Client Email', 'Invoice Date',
-            'Due Date', 'Subtotal', 'Discount', 'Tax Rate', 'Tax Amount',
-            'Total', 'Status', 'Notes', 'Items JSON'
-        ]
-        
-        writer = csv.DictWriter(output, fieldnames=fieldnames)
-        writer.writeheader()
+        return ''.join(self.iter_export(invoices, 'generic_csv'))
+    
+    def create_sink(self, format_type: str) -> ExportSink:
+        """Build the sink that renders one export format invoice by invoice"""
+        export_format = self.formats.get(format_type)
+        if export_format is None:
+            raise ValueError(f"Unsupported format: {format_type}")
+        return export_format.create_sink(self.chunk_size)
+    
+    def iter_exports(self, invoices: Iterable[Dict[str, Any]],
+                     format_types: List[str]) -> Iterator[Tuple[str, str]]:
+        """Stream several exports from one pass over the invoices as (format, chunk) pairs"""
+        # Formats are validated before any invoice is read
+        sinks = {format_type: self.create_sink(format_type) for format_type in format_types}
+        return self._iter_sink_chunks(invoices, sinks)
+    
+    def _iter_sink_chunks(self, invoices: Iterable[Dict[str, Any]],
+                          sinks: Dict[str, "ExportSink"]) -> Iterator[Tuple[str, str]]:
+        column_sinks = [sink for sink in sinks.values() if sink.uses_columns]
+        for records in self._iter_record_blocks(invoices):
+            if column_sinks:
+                # Tax for the whole block is computed column-wise before the rows are written
+                columns = InvoiceColumns.from_records(records)
+                for record, tax_amount in zip(records, columns.tax_amounts()):
+                    record.tax_amount = tax_amount
+                for sink in column_sinks:
+                    sink.add_columns(columns)
+            
+            for record in records:
+                for format_type, sink in sinks.items():
+                    sink.add(record)
+                    for chunk in sink.take_chunks():
+                        yield format_type, chunk
         
+        for format_type, sink in sinks.items():
+            sink.finish()
+            for chunk in sink.take_chunks():
+                yield format_type, chunk
+    
+    def _iter_record_blocks(self, invoices: Iterable[Dict[str, Any]]) -> Iterator[List[NormalizedInvoice]]:
+        # Every invoice is parsed once, however many formats read from it
+        block = []
         for invoice in invoices:
-            row = {
-                'Invoice Number': invoice['invoiceNumber'],
-                'Client Name': invoice['clientName'],
-                'Client Email': invoice['clientEmail'],
-                'Invoice Date': datetime.fromisoformat(invoice['invoiceDate'].replace('Z', '+00:00')).strftime("%Y-%m-%d"),
-                'Due Date': datetime.fromisoformat(invoice['dueDate'].replace('Z', '+00:00')).strftime("%Y-%m-%d"),
-                'Subtotal': invoice['subtotal'],
-                'Discount': invoice.get('discount', '0'),
-                'Tax Rate': f"{invoice.get('vat', '0')}%",
-                'Tax Amount': f"{float(invoice.get('vat', 0)) / 100 * float(invoice['subtotal']) if invoice.get('vat') else 0:.2f}",
-                'Total': invoice['total'],
-                'Status': invoice['status'].title(),
-                'Notes': invoice.get('notes', ''),
-                'Items JSON': invoice['items'] if isinstance(invoice['items'], str) else json.dumps(invoice['items'])
-            }
-            writer.writerow(row)
+            block.append(normalize_invoice(invoice))
+            if len(block) >= COLUMN_BLOCK_SIZE:
+                yield block
+                block = []
+        if block:
+            yield block
+    
+    def iter_export(self, invoices: Iterable[Dict[str, Any]], format_type: str) -> Iterator[str]:
+        """Stream an export as text chunks of roughly chunk_size characters"""
+        return (chunk for _, chunk in self.iter_exports(invoices, [format_type]))
+    
+    def write_export(self, invoices: Iterable[Dict[str, Any]], format_type: str, output: TextIO) -> int:
+        """Write an export to a stream chunk by chunk, returning the number of characters written"""
+        written = 0
+        for chunk in self.iter_export(invoices, format_type):
+            output.write(chunk)
+            written += len(chunk)
+        return written
+    
+    def iter_delta_export(self, invoices: Iterable[Dict[str, Any]], format_type: str,
+                          delta: ExportDelta) -> Iterator[str]:
+        """Stream only the invoices a delta selects, committing it once the export has been consumed"""
+        return self._commit_after(self.iter_export(delta.select(invoices), format_type), delta)
+    
+    def _commit_after(self, chunks: Iterator[str], delta: ExportDelta) -> Iterator[str]:
+        yield from chunks
+        delta.commit()
+    
+    def write_exports(self, invoices: Iterable[Dict[str, Any]], outputs: Dict[str, TextIO]) -> int:
+        """Write several exports to their own streams in one pass, returning the number of invoices"""
+        counted = CountingIterator(invoices)
+        for format_type, chunk in self.iter_exports(counted, list(outputs)):
+            outputs[format_type].write(chunk)
+        return counted.count
+    
+    def write_export_archive(self, invoices: Iterable[Dict[str, Any]], format_types: List[str],
+                             archive: BinaryIO) -> int:
+        """Write several exports into one zip archive in one pass, returning the number of invoices"""
+        # Each export is spooled separately, spilling to disk once it outgrows memory
+        spools = {
+            format_type: tempfile.SpooledTemporaryFile(max_size=ARCHIVE_SPOOL_SIZE, mode='w+',
+                                                       encoding='utf-8', newline='')
+            for format_type in format_types
+        }
+        try:
+            count = self.write_exports(invoices, spools)
+            with zipfile.ZipFile(archive, 'w', compression=zipfile.ZIP_DEFLATED) as zip_file:
+                for format_type, spool in spools.items():
+                    spool.seek(0)
+                    with zip_file.open(export_filename(format_type), 'w') as member:
+                        for chunk in iter(lambda: spool.read(self.chunk_size), ''):
+                            member.write(chunk.encode('utf-8'))
+        finally:
+            for spool in spools.values():
+                spool.close()
+        return count
+    
+    def export_invoices(self, invoices: Iterable[Dict[str, Any]],
+                        format_type: Union[str, List[str]]) -> Union[str, Dict[str, str]]:
+        """Export invoices to specified format, or to each of a list of formats"""
+        if isinstance(format_type, str):
+            return ''.join(self.iter_export(invoices, format_type))
         
-        return output.getvalue()
+        contents: Dict[str, List[str]] = {fmt: [] for fmt in format_type}
+        for fmt, chunk in self.iter_exports(invoices, format_type):
+            contents[fmt].append(chunk)
+        return {fmt: ''.join(chunks) for fmt, chunks in contents.items()}
+
+def run_incremental_export(exporter: AccountingExporter, invoices: Iterable[Dict[str, Any]],
+                           format_types: List[str], state_path: str, tenant: str,
+                           corrections: bool, raw: bool):
+    """Export the invoices that changed since the last export of this tenant and format"""
+    if len(format_types) != 1:
+        raise ValueError("Incremental export takes a single format")
+    format_type = format_types[0]
     
-    def export_invoices(self, invoices: List[Dict[str, Any]], format_type: str) -> str:
-        """Export invoices to specified format"""
-        if format_type not in self.supported_formats:
-            raise ValueError(f"Unsupported format: {format_type}")
+    with ExportState(state_path) as state:
+        delta = ExportDelta(state, tenant, format_type, corrections)
+        chunks = exporter.iter_delta_export(invoices, format_type, delta)
         
-        if format_type == 'quickbooks_iif':
-            return self.export_to_quickbooks_iif(invoices)
-        elif format_type == 'xero_csv':
-            return self.export_to_xero_csv(invoices)
-        elif format_type == 'sage_csv':
-            return self.export_to_sage_csv(invoices)
-        elif format_type == 'wave_csv':
-            return self.export_to_wave_csv(invoices)
-        elif format_type == 'generic_csv':
-            return self.export_to_generic_csv(invoices)
-        else:
-            return self.export_to_generic_csv(invoices)
+        if raw:
+            for chunk in chunks:
+                sys.stdout.write(chunk)
+            sys.stdout.flush()
+            return
+        
+        result = {
+            "success": True,
+            "content": ''.join(chunks),
+            "format": format_type,
+            "tenant": tenant,
+            "count": delta.new + delta.changed,
+            "delta": delta.stats()
+        }
+        print(json.dumps(result))
 
 def main():
     """Command line interface for accounting export"""
+    parser = argparse.ArgumentParser(description="Export invoices to accounting software formats")
+    parser.add_argument('--ndjson', action='store_true',
+                        help="Read one invoice per line from stdin instead of a single JSON document")
+    parser.add_argument('--input', metavar='PATH',
+                        help="Read invoices from an NDJSON file, memory-mapped, instead of stdin")
+    parser.add_argument('--format', dest='format_type',
+                        help="Export format, or a comma separated list of formats exported in one pass "
+                             "(overrides the format/formats fields of JSON input)")
+    parser.add_argument('--raw', action='store_true',
+                        help="Stream the CSV/IIF body to stdout instead of wrapping it in JSON; "
+                             "several formats are written as a zip archive")
+    parser.add_argument('--state', default=os.getenv('ACCOUNTING_EXPORT_STATE'),
+                        help="SQLite state file; when set only new or changed invoices are exported")
+    parser.add_argument('--tenant',
+                        help="Tenant the export state is kept for (overrides the tenant field of JSON input)")
+    parser.add_argument('--corrections', action='store_true',
+                        help="Precede each changed invoice with a reversal of its previously exported version")
+    parser.add_argument('--layouts', metavar='PATH',
+                        help="JSON file mapping formats to tenant column layouts "
+                             "(overrides the layouts field of JSON input)")
+    args = parser.parse_args()
+    
     try:
-        # Read JSON input from stdin
-        input_data = json.loads(sys.stdin.read())
+        layouts = None
+        if args.layouts:
+            with open(args.layouts) as f:
+                layouts = json.load(f)
+        
+        # Get parameters
+        if args.input:
+            invoices = NdjsonInvoiceFile(args.input)
+            format_types = parse_formats(args.format_type or 'generic_csv')
+            tenant = args.tenant or 'default'
+        elif args.ndjson:
+            invoices = iter_ndjson(sys.stdin)
+            format_types = parse_formats(args.format_type or 'generic_csv')
+            tenant = args.tenant or 'default'
+        else:
+            # Read JSON input from stdin
+            input_data = json.loads(sys.stdin.read())
+            invoices = input_data.get('invoices', [])
+            format_types = parse_formats(args.format_type or input_data.get('formats')
+                                         or input_data.get('format', 'generic_csv'))
+            tenant = args.tenant or str(input_data.get('tenant', 'default'))
+            layouts = layouts or input_data.get('layouts')
         
         # Create exporter
-        exporter = AccountingExporter()
+        exporter = AccountingExporter(layouts=layouts)
         
-        # Get parameters
-        invoices = input_data.get('invoices', [])
-        format_type = input_data.get('format', 'generic_csv')
+        if args.state:
+            run_incremental_export(exporter, invoices, format_types, args.state, tenant,
+                                   args.corrections, args.raw)
+            return
         
-        # Export data
-        exported_content = exporter.export_invoices(invoices, format_type)
+        if args.raw:
+            # Rows go out as they are produced, in bounded chunks
+            if len(format_types) == 1:
+                exporter.write_export(invoices, format_types[0], sys.stdout)
+                sys.stdout.flush()
+            else:
+                exporter.write_export_archive(invoices, format_types, sys.stdout.buffer)
+                sys.stdout.buffer.flush()
+            return
         
-        # Return result
-        result = {
-            "success": True,
-            "content": exported_content,
-            "format": format_type,
-            "count": len(invoices)
-        }
+        invoices = list(invoices)
+        
+        if len(format_types) == 1:
+            # Export data
+            exported_content = exporter.export_invoices(invoices, format_types[0])
+            
+            # Return result
+            result = {
+                "success": True,
+                "content": exported_content,
+                "format": format_types[0],
+                "count": len(invoices)
+            }
+        else:
+            result = {
+                "success": True,
+                "contents": exporter.export_invoices(invoices, format_types),
+                "formats": format_types,
+                "count": len(invoices)
+            }
         
         print(json.dumps(result))
         
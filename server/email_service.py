@@ -5,25 +5,118 @@ Handles sending invoices via SMTP without external dependencies
 """
 
 import smtplib
-import ssl
 import os
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.base import MIMEBase
-from email import encoders
+import argparse
+import asyncio
+import random
+import threading
+import time
+from concurrent.futures import Future, wait, FIRST_COMPLETED
 import json
 import sys
-from typing import Optional
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from message_factory import MessageFactory, load_email_templates, read_email_templates
+from smtp_transport import SMTPTransport, is_connection_error
+
+def temporary_failure_code(error: BaseException) -> Optional[int]:
+    """The 4xx reply code of a failure worth retrying later, if it was one"""
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code if 400 <= error.smtp_code < 500 else None
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in error.recipients.values()]
+        return codes[0] if codes and all(400 <= code < 500 for code in codes) else None
+    return None
+
+def recipient_domain(address: str) -> str:
+    return address.rpartition('@')[2].strip().lower()
+
+# End of the message iterable, distinct from any message it may hold
+_NO_MESSAGE = object()
+
+# Domains tracked before the rate limiter drops those it no longer holds back
+PRUNE_MIN_DOMAINS = 1024
+
+class DomainRateLimiter:
+    """Spaces out messages to each recipient domain, and holds a domain back after it pushes back
+    
+    Each domain may receive `rate` messages per second on average, with bursts of up to
+    `burst` messages. A rate of 0 leaves domains unlimited apart from back-offs.
+    """
+    
+    def __init__(self, rate: float = 0.0, burst: int = 1):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.tolerance = self.interval * max(burst - 1, 0)
+        self._next: Dict[str, float] = {}
+        self._prune_at = PRUNE_MIN_DOMAINS
+        self._lock = threading.Lock()
+    
+    def reserve(self, domain: str) -> float:
+        """Reserve the next slot for a message to domain, returning the seconds until it starts"""
+        with self._lock:
+            now = time.monotonic()
+            if len(self._next) >= self._prune_at:
+                self._prune(now)
+            slot = max(self._next.get(domain, now), now)
+            self._next[domain] = slot + self.interval
+            return max(slot - self.tolerance - now, 0.0)
+    
+    def _prune(self, now: float):
+        # A domain whose next slot has passed is limited no more than one never seen
+        self._next = {domain: slot for domain, slot in self._next.items() if slot > now}
+        self._prune_at = max(2 * len(self._next), PRUNE_MIN_DOMAINS)
+    
+    def wait(self, domain: str):
+        """Block until a message to domain may be sent, reserving its slot"""
+        delay = self.reserve(domain)
+        if delay:
+            time.sleep(delay)
+    
+    def back_off(self, domain: str, delay: float):
+        """Send nothing more to domain for delay seconds"""
+        with self._lock:
+            resume = time.monotonic() + delay + self.tolerance
+            self._next[domain] = max(self._next.get(domain, 0.0), resume)
 
 class SMTPEmailService:
-    def __init__(self):
+    def __init__(self, transport: Optional[SMTPTransport] = None,
+                 templates: Optional[List[Dict[str, Any]]] = None):
         # SMTP Configuration - these can be set via environment variables
         self.smtp_server = os.getenv('SMTP_SERVER', 'smtp.gmail.com')
         self.smtp_port = int(os.getenv('SMTP_PORT', '587'))
         self.smtp_username = os.getenv('SMTP_USERNAME', '')
         self.smtp_password = os.getenv('SMTP_PASSWORD', '')
+        # Single sends answer a waiting request, so by default they fail at once instead of retrying
+        self.send_retries = int(os.getenv('SMTP_SEND_RETRIES', '0'))
         self.from_email = os.getenv('FROM_EMAIL', self.smtp_username)
         
+        # Sessions are opened on first use and kept for later messages
+        self.transport = transport or SMTPTransport.from_env(
+            self.smtp_server, self.smtp_port, self.smtp_username, self.smtp_password)
+        
+        # emailTemplates rows are compiled once, keyed by invoiceType
+        if templates is None:
+            templates = read_email_templates(os.getenv('EMAIL_TEMPLATES'))
+        self.messages = MessageFactory(self.from_email, load_email_templates(templates))
+    
+    def close(self):
+        self.transport.close()
+        
+    def build_message(self, to_email: str, subject: str, body: str, pdf_path: Optional[str] = None) -> bytes:
+        """Build the wire-ready bytes of an invoice email with optional PDF attachment"""
+        return self.messages.compose(to_email, subject, body, pdf_path)
+    
+    def message_content(self, message: Dict[str, Any]) -> bytes:
+        """Bytes of a queued message: prebuilt "content", a "template" with "data", or a subject and body"""
+        content = message.get('content')
+        if content is not None:
+            return content
+        if message.get('template'):
+            return self.messages.render(message['template'], message['to_email'], message.get('data') or {},
+                                        message.get('pdf_path'))
+        return self.build_message(message['to_email'], message['subject'], message['body'],
+                                  message.get('pdf_path'))
+    
     def send_invoice_email(self, to_email: str, subject: str, body: str, 
                           pdf_path: Optional[str] = None) -> bool:
         """
@@ -39,44 +132,102 @@ class SMTPEmailService:
             bool: True if email sent successfully, False otherwise
         """
         try:
-            # Create message container
-            msg = MIMEMultipart()
-            msg['From'] = self.from_email
-            msg['To'] = to_email
-            msg['Subject'] = subject
-            
-            # Add body to email
-            msg.attach(MIMEText(body, 'plain'))
-            
-            # Add PDF attachment if provided
-            if pdf_path and os.path.exists(pdf_path):
-                with open(pdf_path, "rb") as attachment:
-                    part = MIMEBase('application', 'octet-stream')
-                    part.set_payload(attachment.read())
-                
-                encoders.encode_base64(part)
-                part.add_header(
-                    'Content-Disposition',
-                    f'attachment; filename= {os.path.basename(pdf_path)}',
-                )
-                msg.attach(part)
-            
-            # Create SMTP session
-            server = smtplib.SMTP(self.smtp_server, self.smtp_port)
-            server.starttls()  # Enable TLS encryption
-            server.login(self.smtp_username, self.smtp_password)
+            text = self.build_message(to_email, subject, body, pdf_path)
             
-            # Send email
-            text = msg.as_string()
-            server.sendmail(self.from_email, to_email, text)
-            server.quit()
-            
-            return True
+            # Send email over a pooled session
+            result = self.send_message(to_email, text)
+            if not result["success"]:
+                print(f"Error sending email: {result.get('error')}", file=sys.stderr)
+            return result["success"]
             
         except Exception as e:
             print(f"Error sending email: {str(e)}", file=sys.stderr)
             return False
     
+    def send_message(self, to_email: str, content: bytes, max_retries: Optional[int] = None,
+                     backoff: float = 1.0) -> Dict[str, Any]:
+        """Send one wire-ready message through send_many, retrying SMTP_SEND_RETRIES times unless told otherwise"""
+        if max_retries is None:
+            max_retries = self.send_retries
+        return next(self.send_many([{"to_email": to_email, "content": content}], 1, None, max_retries, backoff))
+    
+    async def _send_with_retries(self, message: Dict[str, Any], rate_limiter: DomainRateLimiter,
+                                 max_retries: int, backoff: float) -> Dict[str, Any]:
+        to_email = message.get('to_email', '')
+        result = {"id": message.get('id'), "to_email": to_email, "success": False, "attempts": 0}
+        try:
+            text = self.message_content(message)
+        except Exception as e:
+            result["error"] = str(e)
+            return result
+        
+        domain = recipient_domain(to_email)
+        while True:
+            await asyncio.sleep(rate_limiter.reserve(domain))
+            result["attempts"] += 1
+            try:
+                await self.transport.pool.send(self.from_email, to_email, text)
+                result["success"] = True
+                return result
+            except Exception as e:
+                code = temporary_failure_code(e)
+                if (code is None and not is_connection_error(e)) or result["attempts"] > max_retries:
+                    result["error"] = str(e)
+                    if code is not None:
+                        result["code"] = code
+                    return result
+                
+                # Exponential back-off with jitter; a 4xx also holds back the whole domain
+                delay = backoff * 2 ** (result["attempts"] - 1) * random.uniform(1.0, 1.25)
+                if code is not None:
+                    rate_limiter.back_off(domain, delay)
+                else:
+                    await asyncio.sleep(delay)
+    
+    def send_many(self, messages: Iterable[Dict[str, Any]], workers: Optional[int] = None,
+                  rate_limiter: Optional[DomainRateLimiter] = None, max_retries: int = 3,
+                  backoff: float = 1.0) -> Iterator[Dict[str, Any]]:
+        """Send {"id", "to_email", "subject", "body", "pdf_path"} messages concurrently, yielding results as they finish
+        
+        Up to `workers` sends run at once as coroutines on the transport loop, sharing its
+        connection pool; by default there are two per connection, so each session has its
+        next message ready. Temporary failures (4xx replies, dropped sessions) are retried up
+        to max_retries times with exponential back-off; this is the only retry layer, so
+        "attempts" in each result counts every time the message went out.
+        """
+        workers = max(workers or self.transport.max_connections * 2, 1)
+        rate_limiter = rate_limiter or DomainRateLimiter()
+        message_iter = iter(messages)
+        pending = set()
+        
+        def top_up():
+            while len(pending) < workers:
+                message = next(message_iter, _NO_MESSAGE)
+                if message is _NO_MESSAGE:
+                    return
+                if isinstance(message, dict):
+                    pending.add(self.transport.submit(
+                        self._send_with_retries(message, rate_limiter, max_retries, backoff)))
+                    continue
+                # A null or non-object line still gets its result, and the batch goes on
+                future = Future()
+                future.set_result({"id": None, "success": False, "attempts": 0,
+                                   "error": f"Message must be an object, not {type(message).__name__}"})
+                pending.add(future)
+        
+        try:
+            top_up()
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.remove(future)
+                    yield future.result()
+                top_up()
+        finally:
+            # A caller that stops early cancels the sends still in flight
+            for future in pending:
+                future.cancel()
+    
     def test_connection(self) -> bool:
         """
         Test SMTP connection without sending an email
@@ -85,15 +236,31 @@ class SMTPEmailService:
             bool: True if connection successful, False otherwise
         """
         try:
-            server = smtplib.SMTP(self.smtp_server, self.smtp_port)
-            server.starttls()
-            server.login(self.smtp_username, self.smtp_password)
-            server.quit()
-            return True
+            return self.transport.noop() == 250
         except Exception as e:
             print(f"SMTP connection test failed: {str(e)}", file=sys.stderr)
             return False
 
+def run_batch(email_service: SMTPEmailService, input_stream, output_stream, workers: Optional[int],
+              rate_limiter: DomainRateLimiter, max_retries: int, backoff: float):
+    """Send newline-delimited JSON messages until EOF, writing one JSON result line per message as it finishes"""
+    def write(result: Dict[str, Any]):
+        output_stream.write(json.dumps(result) + "\n")
+        output_stream.flush()
+    
+    def messages():
+        for line in input_stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                write({"id": None, "success": False, "attempts": 0, "error": f"Invalid message: {e}"})
+    
+    for result in email_service.send_many(messages(), workers, rate_limiter, max_retries, backoff):
+        write(result)
+
 def main():
     """
     Main function for command-line usage
@@ -104,22 +271,64 @@ def main():
         "body": "Email body content",
         "pdf_path": "/path/to/invoice.pdf" (optional)
     }
+    Instead of a subject and body, a message may name an emailTemplates "template" by
+    invoiceType and give its placeholder values as "data".
+    With --batch, stdin carries one such message per line, each optionally with an "id".
     """
+    parser = argparse.ArgumentParser(description="Send invoice emails over SMTP")
+    parser.add_argument('--batch', action='store_true',
+                        help="Read one message per line from stdin and write one result per line as each is sent")
+    parser.add_argument('--workers', type=int, help="Concurrent sends (default: twice SMTP_POOL_SIZE)")
+    parser.add_argument('--rate-per-domain', type=float, default=float(os.getenv('SMTP_DOMAIN_RATE', '0')),
+                        help="Messages per second to any one recipient domain, 0 for no limit")
+    parser.add_argument('--burst', type=int, default=int(os.getenv('SMTP_DOMAIN_BURST', '1')),
+                        help="Messages a domain may receive back to back before the rate applies")
+    parser.add_argument('--max-retries', type=int, default=3,
+                        help="Retries of a message after temporary (4xx) failures")
+    parser.add_argument('--backoff', type=float, default=1.0,
+                        help="Seconds before the first retry, doubling for each one after")
+    parser.add_argument('--templates', metavar='PATH',
+                        help="JSON file of emailTemplates rows that messages may name by invoiceType "
+                             "(default: EMAIL_TEMPLATES)")
+    args = parser.parse_args()
+    templates = read_email_templates(args.templates) if args.templates else None
+    
+    if args.batch:
+        email_service = SMTPEmailService(templates=templates)
+        try:
+            run_batch(email_service, sys.stdin, sys.stdout, args.workers,
+                      DomainRateLimiter(args.rate_per_domain, args.burst), args.max_retries, args.backoff)
+        except Exception as e:
+            error_result = {"success": False, "error": str(e)}
+            print(json.dumps(error_result), file=sys.stderr)
+            sys.exit(1)
+        finally:
+            email_service.close()
+        return
+    
     try:
         # Read JSON input from stdin
         input_data = json.loads(sys.stdin.read())
         
         # Create email service instance
-        email_service = SMTPEmailService()
+        email_service = SMTPEmailService(templates=templates)
+        
+        if input_data.get('template'):
+            subject, body = email_service.messages.template(input_data['template']).render(
+                input_data.get('data') or {})
+        else:
+            subject, body = input_data['subject'], input_data['body']
         
         # Send email
         success = email_service.send_invoice_email(
             to_email=input_data['to_email'],
-            subject=input_data['subject'],
-            body=input_data['body'],
+            subject=subject,
+            body=body,
             pdf_path=input_data.get('pdf_path')
         )
         
+        email_service.close()
+        
         # Return result as JSON
         result = {"success": success}
         print(json.dumps(result))
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Incremental Export State
+Remembers what each tenant has already exported in each format so later exports only carry changes
+"""
+
+import copy
+import hashlib
+import json
+import sqlite3
+from datetime import datetime, timezone
+from decimal import Decimal
+from typing import Dict, List, Any, Optional, Iterable, Iterator, Tuple
+
+from invoice_input import RawJson
+
+# Fields that change without the exported content changing
+VOLATILE_FIELDS = ('updatedAt', 'sentAt', 'pdfUrl')
+
+# Money fields negated on a reversing correction row; rates and percentages are left alone
+REVERSED_FIELDS = ('subtotal', 'total', 'deposit')
+
+CORRECTION_SUFFIX = '-CR'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS watermarks (
+    tenant TEXT NOT NULL,
+    format TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    invoice_key TEXT,
+    PRIMARY KEY (tenant, format)
+);
+CREATE TABLE IF NOT EXISTS exported_invoices (
+    tenant TEXT NOT NULL,
+    format TEXT NOT NULL,
+    invoice_key TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    updated_at TEXT,
+    snapshot TEXT NOT NULL,
+    PRIMARY KEY (tenant, format, invoice_key)
+);
+"""
+
+def normalize_timestamp(value: Any) -> Optional[str]:
+    """UTC timestamp in a fixed-width form whose string order is chronological order"""
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        moment = value
+    else:
+        moment = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+def invoice_key(invoice: Dict[str, Any]) -> str:
+    """Stable identity of an invoice: its database id, else its invoice number"""
+    key = invoice.get('id')
+    return str(key if key is not None else invoice['invoiceNumber'])
+
+def materialize(invoice: Dict[str, Any]) -> Dict[str, Any]:
+    """The invoice with any undecoded input fields decoded, as it is hashed and stored"""
+    return {name: value.decode() if isinstance(value, RawJson) else value for name, value in invoice.items()}
+
+def content_hash(invoice: Dict[str, Any]) -> str:
+    """Digest of everything an export could read from the invoice"""
+    content = {name: value for name, value in materialize(invoice).items() if name not in VOLATILE_FIELDS}
+    encoded = json.dumps(content, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.blake2b(encoded.encode('utf-8'), digest_size=16).hexdigest()
+
+def negate_amount(value: Any) -> Any:
+    """Negate a money value, keeping string amounts as strings"""
+    if isinstance(value, str):
+        amount = Decimal(value)
+        return str(-amount) if amount else value
+    return -value if value else value
+
+def reversal_of(invoice: Dict[str, Any]) -> Dict[str, Any]:
+    """A copy of a previously exported invoice with its amounts negated, cancelling it out"""
+    reversal = dict(invoice)
+    reversal['invoiceNumber'] = f"{invoice['invoiceNumber']}{CORRECTION_SUFFIX}"
+    for name in REVERSED_FIELDS:
+        if name in reversal:
+            reversal[name] = negate_amount(reversal[name])
+
+    items = invoice.get('items', [])
+    items = json.loads(items) if isinstance(items, str) else copy.deepcopy(items)
+    for item in items:
+        item['quantity'] = negate_amount(item['quantity'])
+        item['amount'] = negate_amount(item['amount'])
+    reversal['items'] = items
+    return reversal
+
+class ExportState:
+    """SQLite record of exported invoices and a per tenant, per format updatedAt watermark"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def watermark(self, tenant: str, format_type: str) -> Optional[str]:
+        row = self.connection.execute(
+            'SELECT updated_at FROM watermarks WHERE tenant = ? AND format = ?',
+            (tenant, format_type)).fetchone()
+        return row[0] if row else None
+
+    def lookup(self, tenant: str, format_type: str, key: str) -> Optional[Tuple[str, str]]:
+        """Content hash and snapshot of the last exported version of an invoice"""
+        return self.connection.execute(
+            'SELECT content_hash, snapshot FROM exported_invoices '
+            'WHERE tenant = ? AND format = ? AND invoice_key = ?',
+            (tenant, format_type, key)).fetchone()
+
+    def record(self, tenant: str, format_type: str, exported: List[Tuple[str, str, Optional[str], str]],
+               watermark: Optional[Tuple[str, str]]):
+        """Store exported invoices and advance the watermark in one transaction"""
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO exported_invoices '
+                '(tenant, format, invoice_key, content_hash, updated_at, snapshot) VALUES (?, ?, ?, ?, ?, ?)',
+                [(tenant, format_type, key, digest, updated_at, snapshot)
+                 for key, digest, updated_at, snapshot in exported])
+            if watermark is not None:
+                self.connection.execute(
+                    'INSERT INTO watermarks (tenant, format, updated_at, invoice_key) VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT (tenant, format) DO UPDATE SET updated_at = excluded.updated_at, '
+                    'invoice_key = excluded.invoice_key WHERE excluded.updated_at > watermarks.updated_at',
+                    (tenant, format_type) + watermark)
+
+    def reset(self, tenant: str, format_type: str):
+        """Forget everything exported, so the next export is a full one"""
+        with self.connection:
+            self.connection.execute('DELETE FROM watermarks WHERE tenant = ? AND format = ?',
+                                    (tenant, format_type))
+            self.connection.execute('DELETE FROM exported_invoices WHERE tenant = ? AND format = ?',
+                                    (tenant, format_type))
+
+class ExportDelta:
+    """Selects the new and changed invoices of one export, committing them once it has been written
+
+    Invoices stamped before the watermark are skipped without further work. The rest are
+    compared by content hash with their last exported version; unchanged ones are dropped,
+    and with corrections enabled an edited invoice is preceded by a reversal of the old one.
+    """
+
+    def __init__(self, state: ExportState, tenant: str, format_type: str, corrections: bool = False):
+        self.state = state
+        self.tenant = tenant
+        self.format_type = format_type
+        self.corrections = corrections
+        self.since = state.watermark(tenant, format_type)
+
+        self.pending: List[Tuple[str, str, Optional[str], str]] = []
+        self.latest: Optional[Tuple[str, str]] = None
+        self.new = 0
+        self.changed = 0
+        self.unchanged = 0
+
+    def select(self, invoices: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+        for invoice in invoices:
+            updated_at = normalize_timestamp(invoice.get('updatedAt'))
+            key = invoice_key(invoice)
+            if updated_at is not None:
+                if self.latest is None or updated_at > self.latest[0]:
+                    self.latest = (updated_at, key)
+                if self.since is not None and updated_at < self.since:
+                    self.unchanged += 1
+                    continue
+
+            digest = content_hash(invoice)
+            previous = self.state.lookup(self.tenant, self.format_type, key)
+            if previous is not None and previous[0] == digest:
+                self.unchanged += 1
+                continue
+
+            if previous is None:
+                self.new += 1
+            else:
+                self.changed += 1
+                if self.corrections:
+                    yield reversal_of(json.loads(previous[1]))
+
+            self.pending.append((key, digest, updated_at, json.dumps(materialize(invoice), default=str)))
+            yield invoice
+
+    def commit(self):
+        self.state.record(self.tenant, self.format_type, self.pending, self.latest)
+        self.pending = []
+
+    def stats(self) -> Dict[str, int]:
+        return {'new': self.new, 'changed': self.changed, 'unchanged': self.unchanged}
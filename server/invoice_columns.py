@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Columnar Invoice Batches
+Holds a batch of invoices as parallel columns so tax, totals and group summaries are computed in bulk
+"""
+
+from array import array
+from decimal import Decimal, ROUND_HALF_UP
+from functools import lru_cache
+from typing import Dict, List, Any, Iterable, Tuple
+
+# NumPy is optional; without it the same columns are kept in arrays and reduced in Python
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+CENT = Decimal('0.01')
+
+SUMMARY_GROUPS = ('client', 'status', 'month')
+
+@lru_cache(maxsize=65536)
+def _decimal_cents(text: str) -> int:
+    return int((Decimal(text) / CENT).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+def to_cents(value: Any) -> int:
+    """Money value as integer cents, rounding half up on its decimal representation"""
+    if value is None or value == '':
+        return 0
+    return _decimal_cents(str(value))
+
+def to_basis_points(value: Any) -> int:
+    """Percentage rate as integer hundredths of a percent"""
+    return to_cents(value)
+
+def format_cents(cents: int) -> str:
+    """Integer cents as a plain decimal amount with two places"""
+    sign = '-' if cents < 0 else ''
+    cents = abs(cents)
+    return f"{sign}{cents // 100}.{cents % 100:02d}"
+
+class InvoiceColumns:
+    """A batch of normalized invoices stored column by column
+
+    Money is kept twice: as floats that reproduce the per-row export arithmetic exactly, and
+    as integer cents so that summaries add up without floating point drift. Clients and
+    statuses are stored as integer codes into shared category lists, and invoice months as
+    year * 12 + month - 1 ordinals.
+    """
+
+    def __init__(self):
+        self.client_categories: List[str] = []
+        self.status_categories: List[str] = []
+        self._client_codes: Dict[str, int] = {}
+        self._status_codes: Dict[str, int] = {}
+
+        self.client = array('l')
+        self.status = array('l')
+        self.month = array('l')
+        self.has_vat = array('b')
+        self.vat_rate = array('d')
+        self.subtotal = array('d')
+        self.vat_basis_points = array('q')
+        self.subtotal_cents = array('q')
+        self.total_cents = array('q')
+
+    def __len__(self) -> int:
+        return len(self.client)
+
+    @classmethod
+    def from_records(cls, records: Iterable[Any]) -> "InvoiceColumns":
+        columns = cls()
+        columns.extend(records)
+        return columns
+
+    def _code(self, value: str, codes: Dict[str, int], categories: List[str]) -> int:
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(categories)
+            categories.append(value)
+        return code
+
+    def extend(self, records: Iterable[Any]):
+        """Append normalized invoices to the columns"""
+        for record in records:
+            self.client.append(self._code(record.client_name, self._client_codes, self.client_categories))
+            self.status.append(self._code(record.status_title, self._status_codes, self.status_categories))
+            self.month.append(record.invoice_date.year * 12 + record.invoice_date.month - 1)
+            self.has_vat.append(1 if record.vat else 0)
+            self.vat_rate.append(record.vat_rate)
+            self.subtotal.append(float(record.subtotal))
+            self.vat_basis_points.append(to_basis_points(record.vat) if record.vat else 0)
+            self.subtotal_cents.append(to_cents(record.subtotal))
+            self.total_cents.append(to_cents(record.total))
+
+    def extend_columns(self, other: "InvoiceColumns"):
+        """Append another batch, remapping its category codes onto this batch's categories"""
+        client_map = [self._code(name, self._client_codes, self.client_categories)
+                      for name in other.client_categories]
+        status_map = [self._code(name, self._status_codes, self.status_categories)
+                      for name in other.status_categories]
+        self.client.extend(client_map[code] for code in other.client)
+        self.status.extend(status_map[code] for code in other.status)
+        for name in ('month', 'has_vat', 'vat_rate', 'subtotal', 'vat_basis_points',
+                     'subtotal_cents', 'total_cents'):
+            getattr(self, name).extend(getattr(other, name))
+
+    def tax_amounts(self) -> List[float]:
+        """Per-invoice tax as exported: vat_rate / 100 * subtotal, or 0 without a VAT rate"""
+        if np is not None:
+            rate = np.frombuffer(self.vat_rate, dtype=np.float64)
+            subtotal = np.frombuffer(self.subtotal, dtype=np.float64)
+            has_vat = np.frombuffer(self.has_vat, dtype=np.int8).astype(bool)
+            return np.where(has_vat, rate / 100 * subtotal, 0.0).tolist()
+        return [rate / 100 * subtotal if has_vat else 0.0
+                for rate, subtotal, has_vat in zip(self.vat_rate, self.subtotal, self.has_vat)]
+
+    def tax_cents(self) -> List[int]:
+        """Per-invoice tax in cents, rounded half up from the exact product of rate and subtotal"""
+        if np is not None:
+            product = (np.frombuffer(self.vat_basis_points, dtype=np.int64) *
+                       np.frombuffer(self.subtotal_cents, dtype=np.int64))
+            return self._round_half_up(product, 10000).tolist()
+        return [self._round_half_up_int(bp * cents, 10000)
+                for bp, cents in zip(self.vat_basis_points, self.subtotal_cents)]
+
+    @staticmethod
+    def _round_half_up_int(numerator: int, denominator: int) -> int:
+        quotient, remainder = divmod(abs(numerator), denominator)
+        if remainder * 2 >= denominator:
+            quotient += 1
+        return quotient if numerator >= 0 else -quotient
+
+    @staticmethod
+    def _round_half_up(numerator, denominator: int):
+        quotient, remainder = np.divmod(np.abs(numerator), denominator)
+        quotient += remainder * 2 >= denominator
+        return np.where(numerator >= 0, quotient, -quotient)
+
+    def _group_labels(self, group_by: str) -> Tuple[Any, List[str]]:
+        if group_by == 'client':
+            return self.client, self.client_categories
+        if group_by == 'status':
+            return self.status, self.status_categories
+        if group_by == 'month':
+            months = sorted(set(self.month))
+            index = {month: i for i, month in enumerate(months)}
+            codes = array('l', (index[month] for month in self.month))
+            return codes, [f"{month // 12:04d}-{month % 12 + 1:02d}" for month in months]
+        raise ValueError(f"Unsupported summary grouping: {group_by}")
+
+    def group_totals(self, group_by: str) -> List[Dict[str, Any]]:
+        """Invoice count and summed subtotal, tax and total cents per group, ordered by group label"""
+        codes, labels = self._group_labels(group_by)
+        tax_cents = self.tax_cents()
+
+        if np is not None and len(codes):
+            code_array = np.frombuffer(codes, dtype=np.dtype(codes.typecode))
+            counts = np.bincount(code_array, minlength=len(labels)).tolist()
+            sums = []
+            for values in (self.subtotal_cents, tax_cents, self.total_cents):
+                totals = np.zeros(len(labels), dtype=np.int64)
+                np.add.at(totals, code_array, np.asarray(values, dtype=np.int64))
+                sums.append(totals.tolist())
+        else:
+            counts = [0] * len(labels)
+            sums = [[0] * len(labels) for _ in range(3)]
+            for code, subtotal, tax, total in zip(codes, self.subtotal_cents, tax_cents, self.total_cents):
+                counts[code] += 1
+                sums[0][code] += subtotal
+                sums[1][code] += tax
+                sums[2][code] += total
+
+        groups = [
+            {
+                'label': label,
+                'count': counts[code],
+                'subtotal_cents': sums[0][code],
+                'tax_cents': sums[1][code],
+                'total_cents': sums[2][code],
+            }
+            for code, label in enumerate(labels)
+        ]
+        groups.sort(key=lambda group: group['label'])
+        return groups
+
+    def totals(self) -> Dict[str, int]:
+        """Invoice count and summed subtotal, tax and total cents across the batch"""
+        return {
+            'count': len(self),
+            'subtotal_cents': sum(self.subtotal_cents),
+            'tax_cents': sum(self.tax_cents()),
+            'total_cents': sum(self.total_cents),
+        }
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Invoice Input
+Reads invoices one record at a time from NDJSON, either streamed or memory-mapped from a file
+"""
+
+import json
+import mmap
+from array import array
+from typing import Dict, Any, Iterator, Optional, TextIO, Tuple
+
+# Consumed pages are released from a sequential scan in steps of this many bytes
+RELEASE_STEP = 8 * 1024 * 1024
+
+class RawJson(str):
+    """JSON text kept undecoded until a reader asks for its value"""
+
+    def decode(self) -> Any:
+        return json.loads(self)
+
+def iter_ndjson(stream: TextIO) -> Iterator[Dict[str, Any]]:
+    """Yield one invoice per non-empty line of newline-delimited JSON"""
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+def find_items_array(line: bytes) -> Optional[Tuple[int, int]]:
+    """Span of the items array in an encoded invoice, found with byte searches rather than parsing
+
+    Returns None whenever the array cannot be delimited this way (nested arrays, escaped
+    quotes), and the caller then decodes the record in full.
+    """
+    key = line.find(b'"items"')
+    if key == -1:
+        return None
+    start = key + len(b'"items"')
+    while line[start:start + 1] == b' ':
+        start += 1
+    if line[start:start + 1] != b':':
+        return None
+    start += 1
+    while line[start:start + 1] == b' ':
+        start += 1
+    if line[start:start + 1] != b'[':
+        return None
+
+    # The closing bracket is the first one preceded by an even number of quotes
+    end = line.find(b']', start)
+    while end != -1 and line.count(b'"', start, end) % 2:
+        end = line.find(b']', end + 1)
+    if end == -1 or line.find(b'[', start + 1, end) != -1 or line.find(b'\\"', start, end) != -1:
+        return None
+    return start, end + 1
+
+def decode_invoice(line: bytes) -> Dict[str, Any]:
+    """Decode one NDJSON invoice, leaving an items array as RawJson for readers that need it"""
+    span = find_items_array(line)
+    if span is None:
+        return json.loads(line)
+
+    start, end = span
+    try:
+        invoice = json.loads(line[:start] + b'null' + line[end:])
+    except ValueError:
+        invoice = None
+    if not isinstance(invoice, dict) or 'items' not in invoice or invoice['items'] is not None:
+        # The span was not the top-level field; decode the record as written
+        return json.loads(line)
+    invoice['items'] = RawJson(line[start:end].decode('utf-8'))
+    return invoice
+
+class NdjsonInvoiceFile:
+    """An NDJSON invoice file mapped into memory and indexed by record offset
+
+    Iterating yields records as the scan reaches them, so the first invoice is available
+    before the file has been read to the end; the offsets found on the way allow later
+    random access by record number.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._map: Optional[mmap.mmap] = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files cannot be mapped
+            self._map = None
+        self._size = len(self._map) if self._map is not None else 0
+
+        self._starts = array('Q')
+        self._ends = array('Q')
+        self._scanned = 0
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _scan_next(self) -> bool:
+        """Index the next record, returning False at the end of the file"""
+        while self._scanned < self._size:
+            start = self._scanned
+            end = self._map.find(b'\n', start)
+            if end == -1:
+                end = self._size
+            self._scanned = end + 1
+            if end > start and (self._map[start] == 0x7b or self._map[start:end].strip()):
+                self._starts.append(start)
+                self._ends.append(end)
+                return True
+        return False
+
+    def _release(self, upto: int):
+        if hasattr(mmap, 'MADV_DONTNEED') and upto > 0:
+            upto -= upto % mmap.PAGESIZE
+            if upto:
+                self._map.madvise(mmap.MADV_DONTNEED, 0, upto)
+
+    def __len__(self) -> int:
+        while self._scan_next():
+            pass
+        return len(self._starts)
+
+    def __getitem__(self, index: int) -> Dict[str, Any]:
+        if index < 0:
+            index += len(self)
+        while index >= len(self._starts) and self._scan_next():
+            pass
+        if not 0 <= index < len(self._starts):
+            raise IndexError(index)
+        return decode_invoice(self._map[self._starts[index]:self._ends[index]])
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        if self._map is None:
+            return
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            self._map.madvise(mmap.MADV_SEQUENTIAL)
+
+        released = 0
+        index = 0
+        while index < len(self._starts) or self._scan_next():
+            start, end = self._starts[index], self._ends[index]
+            yield decode_invoice(self._map[start:end])
+            index += 1
+
+            # Pages already read are dropped so resident memory stays flat on large files
+            if start - released >= RELEASE_STEP:
+                self._release(start)
+                released = start
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Message Factory
+Compiles email templates once and composes messages straight to wire-ready bytes
+"""
+
+import base64
+import json
+import os
+import re
+import uuid
+from email import quoprimime
+from email.header import Header
+from typing import Dict, List, Any, Iterable, Optional, Tuple
+
+CRLF = '\r\n'
+
+# SMTP forbids longer lines; bodies with one are sent quoted-printable
+MAX_LINE_LENGTH = 998
+
+# emailTemplates rows whose invoiceType is this prefix plus a tier override that reminder tier
+REMINDER_TEMPLATE_PREFIX = 'reminder_'
+
+PLACEHOLDER = re.compile(r'\{([A-Za-z_]\w*)\}|[{}]')
+
+class TemplateFields(dict):
+    """Template values; placeholders without a value are left in the text as written"""
+
+    def __missing__(self, key: str) -> str:
+        return '{' + key + '}'
+
+def to_format_string(template: str) -> str:
+    """A {placeholder} template as a str.format string with CRLF line endings"""
+    template = template.replace('\r\n', '\n').replace('\n', CRLF)
+    return PLACEHOLDER.sub(lambda match: match.group(0) if match.group(1) else match.group(0) * 2, template)
+
+def fix_line_endings(text: str) -> str:
+    """Text with every line ending as CRLF"""
+    if text.count('\n') == text.count(CRLF) and text.count('\r') == text.count(CRLF):
+        return text
+    return text.replace('\r\n', '\n').replace('\r', '\n').replace('\n', CRLF)
+
+def encode_header(value: str) -> str:
+    """A header value safe to write as is, RFC 2047 encoded when it is not plain ASCII"""
+    value = str(value)
+    if '\r' in value or '\n' in value:
+        value = ' '.join(value.splitlines())
+    if value.isascii():
+        return value
+    return Header(value, 'utf-8').encode(linesep=CRLF)
+
+def encode_body(text: str) -> Tuple[bytes, bytes]:
+    """Content-Transfer-Encoding and payload of a CRLF text body"""
+    if text.isascii() and (len(text) <= MAX_LINE_LENGTH or
+                           max(map(len, text.split(CRLF))) <= MAX_LINE_LENGTH):
+        return b'7bit', text.encode('ascii')
+    encoded = quoprimime.body_encode(text.encode('utf-8').decode('latin-1'), eol=CRLF)
+    return b'quoted-printable', encoded.encode('ascii')
+
+class CompiledTemplate:
+    """A subject and body template turned into format strings once, for rendering many times"""
+
+    __slots__ = ('name', '_subject', '_body')
+
+    def __init__(self, subject: str, body: str, name: Optional[str] = None):
+        self.name = name
+        self._subject = to_format_string(subject)
+        self._body = to_format_string(body)
+
+    def render(self, values: Dict[str, Any]) -> Tuple[str, str]:
+        """Subject and CRLF body with the values filled in"""
+        fields = TemplateFields(values)
+        return self._subject.format_map(fields), fix_line_endings(self._body.format_map(fields))
+
+def load_email_templates(rows: Iterable[Dict[str, Any]]) -> Dict[str, CompiledTemplate]:
+    """Compile emailTemplates rows keyed by invoiceType, preferring the default row of each type"""
+    templates: Dict[str, CompiledTemplate] = {}
+    defaults = set()
+    for row in rows:
+        invoice_type = row['invoiceType']
+        if invoice_type in defaults:
+            continue
+        templates[invoice_type] = CompiledTemplate(row['subject'], row['body'], row.get('name'))
+        if row.get('isDefault'):
+            defaults.add(invoice_type)
+    return templates
+
+def read_email_templates(path: Optional[str]) -> List[Dict[str, Any]]:
+    """emailTemplates rows from a JSON file holding a list of them, or none without a path"""
+    if not path:
+        return []
+    with open(path) as f:
+        rows = json.load(f)
+    return rows.get('templates', []) if isinstance(rows, dict) else rows
+
+class MessageFactory:
+    """Composes messages from one sender as bytes ready for SMTP DATA
+
+    Header lines shared by every message are encoded once; a message then costs the
+    rendering of its template, its To and Subject lines and one join. Templates are
+    looked up by invoiceType, so tenant rows from the emailTemplates table replace the
+    built-in ones simply by being loaded over them.
+    """
+
+    def __init__(self, from_email: str, templates: Optional[Dict[str, CompiledTemplate]] = None):
+        self.from_email = from_email
+        self.templates: Dict[str, CompiledTemplate] = dict(templates or {})
+        self._head = (f"From: {encode_header(from_email)}{CRLF}MIME-Version: 1.0{CRLF}").encode('ascii')
+        self._boundary = f"=============={uuid.uuid4().hex}=="
+        self._text_headers = b'Content-Type: text/plain; charset="utf-8"\r\nContent-Transfer-Encoding: '
+        self._multipart_header = (f'Content-Type: multipart/mixed; boundary="{self._boundary}"{CRLF}'
+                                  f'{CRLF}--{self._boundary}{CRLF}').encode('ascii')
+        self._close = f"{CRLF}--{self._boundary}--{CRLF}".encode('ascii')
+
+    def register(self, key: str, subject: str, body: str, replace: bool = False):
+        """Add a built-in template, keeping any override already loaded under the same key"""
+        if replace or key not in self.templates:
+            self.templates[key] = CompiledTemplate(subject, body, key)
+
+    def template(self, key: str) -> CompiledTemplate:
+        try:
+            return self.templates[key]
+        except KeyError:
+            raise ValueError(f"Unknown email template: {key}") from None
+
+    def compose(self, to_email: str, subject: str, body: str, pdf_path: Optional[str] = None) -> bytes:
+        """Wire-ready message with a plain text body and an optional PDF attachment"""
+        transfer_encoding, payload = encode_body(fix_line_endings(body))
+        parts = [
+            self._head,
+            f"To: {encode_header(to_email)}{CRLF}Subject: {encode_header(subject)}{CRLF}".encode('ascii'),
+        ]
+        attachment = self._attachment(pdf_path) if pdf_path and os.path.exists(pdf_path) else None
+        if attachment is not None:
+            parts.append(self._multipart_header)
+        parts += [self._text_headers, transfer_encoding, b'\r\n\r\n', payload]
+        if attachment is not None:
+            parts += [b'\r\n--', self._boundary.encode('ascii'), b'\r\n', attachment, self._close]
+        return b''.join(parts)
+
+    def render(self, key: str, to_email: str, values: Dict[str, Any], pdf_path: Optional[str] = None) -> bytes:
+        """Wire-ready message from a compiled template"""
+        subject, body = self.template(key).render(values)
+        return self.compose(to_email, subject, body, pdf_path)
+
+    def _attachment(self, pdf_path: str) -> bytes:
+        with open(pdf_path, 'rb') as attachment:
+            content = base64.encodebytes(attachment.read()).replace(b'\n', b'\r\n')
+        filename = encode_header(os.path.basename(pdf_path)).replace('"', '')
+        return (f'Content-Type: application/octet-stream{CRLF}'
+                f'Content-Transfer-Encoding: base64{CRLF}'
+                f'Content-Disposition: attachment; filename="{filename}"{CRLF}{CRLF}').encode('ascii') + content
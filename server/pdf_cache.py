@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Rendered PDF Cache
+Content-addressed cache of generated invoice PDFs with an in-memory tier and an optional disk tier
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+class PdfCache:
+    """Two-tier LRU cache of PDF bytes, grouped by template fingerprint
+
+    Entries live under a namespace (the fingerprint of the template they were rendered
+    from), so a changed template can drop all of its stale PDFs at once. Both tiers are
+    bounded by a byte budget and evict least recently used entries first.
+    """
+
+    def __init__(self, memory_budget: int = 64 * 1024 * 1024, disk_dir: Optional[str] = None,
+                 disk_budget: int = 1024 * 1024 * 1024):
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+
+        self._memory: "OrderedDict[Tuple[str, str], bytes]" = OrderedDict()
+        self._memory_bytes = 0
+        self._disk: "OrderedDict[Tuple[str, str], int]" = OrderedDict()
+        self._disk_bytes = 0
+        self._disk_indexed = False
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+        if self.disk_dir:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+
+    @classmethod
+    def from_env(cls) -> "PdfCache":
+        """Build a cache configured by PDF_CACHE_MEMORY_BYTES, PDF_CACHE_DIR and PDF_CACHE_DISK_BYTES"""
+        return cls(
+            memory_budget=int(os.getenv('PDF_CACHE_MEMORY_BYTES', str(64 * 1024 * 1024))),
+            disk_dir=os.getenv('PDF_CACHE_DIR') or None,
+            disk_budget=int(os.getenv('PDF_CACHE_DISK_BYTES', str(1024 * 1024 * 1024))),
+        )
+
+    def _load_disk_index(self):
+        """Index PDFs left on disk by other processes, oldest access first
+
+        Called with the lock held, only once the disk budget has to be enforced, so a
+        process that only reads the cache never walks the directory.
+        """
+        if self._disk_indexed:
+            return
+        self._disk_indexed = True
+        entries = []
+        for namespace_dir in self.disk_dir.iterdir():
+            if not namespace_dir.is_dir():
+                continue
+            for pdf_path in namespace_dir.glob('*.pdf'):
+                entry_key = (namespace_dir.name, pdf_path.stem)
+                if entry_key in self._disk:
+                    continue
+                try:
+                    stat = pdf_path.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, entry_key, stat.st_size))
+
+        # Entries this process already touched are the most recently used
+        touched = list(self._disk.items())
+        self._disk.clear()
+        for _, entry_key, size in sorted(entries):
+            self._disk[entry_key] = size
+            self._disk_bytes += size
+        self._disk.update(touched)
+
+    def _disk_path(self, namespace: str, key: str) -> Path:
+        return self.disk_dir / namespace / f"{key}.pdf"
+
+    def get(self, namespace: str, key: str) -> Optional[bytes]:
+        """Return cached PDF bytes, promoting disk hits into memory"""
+        entry_key = (namespace, key)
+        with self._lock:
+            pdf_content = self._memory.get(entry_key)
+            if pdf_content is not None:
+                self._memory.move_to_end(entry_key)
+                self.hits += 1
+                return pdf_content
+
+            if self.disk_dir is None:
+                self.misses += 1
+                return None
+            if entry_key in self._disk:
+                self._disk.move_to_end(entry_key)
+
+        # The index only knows this process's writes; another process may have stored the entry
+        pdf_path = self._disk_path(namespace, key)
+        try:
+            pdf_content = pdf_path.read_bytes()
+            # Record the access so LRU order survives restarts
+            os.utime(pdf_path)
+        except FileNotFoundError:
+            with self._lock:
+                self._forget_disk(entry_key)
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+            if entry_key not in self._disk:
+                self._disk[entry_key] = len(pdf_content)
+                self._disk_bytes += len(pdf_content)
+            self._store_memory(entry_key, pdf_content)
+        return pdf_content
+
+    def put(self, namespace: str, key: str, pdf_content: bytes):
+        """Store PDF bytes in both tiers"""
+        entry_key = (namespace, key)
+        with self._lock:
+            self._store_memory(entry_key, pdf_content)
+
+        if self.disk_dir is None or len(pdf_content) > self.disk_budget:
+            return
+
+        pdf_path = self._disk_path(namespace, key)
+        pdf_path.parent.mkdir(exist_ok=True)
+
+        # Write then rename so concurrent readers never see a partial file
+        fd, temp_name = tempfile.mkstemp(dir=str(pdf_path.parent), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(pdf_content)
+        os.replace(temp_name, pdf_path)
+
+        with self._lock:
+            self._forget_disk(entry_key)
+            self._disk[entry_key] = len(pdf_content)
+            self._disk_bytes += len(pdf_content)
+            self._load_disk_index()
+            self._evict_disk()
+
+    def invalidate(self, namespace: str):
+        """Drop every entry rendered from a template fingerprint"""
+        with self._lock:
+            for entry_key in [k for k in self._memory if k[0] == namespace]:
+                self._memory_bytes -= len(self._memory.pop(entry_key))
+            for entry_key in [k for k in self._disk if k[0] == namespace]:
+                self._forget_disk(entry_key)
+
+        if self.disk_dir is not None:
+            shutil.rmtree(self.disk_dir / namespace, ignore_errors=True)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'memory_entries': len(self._memory),
+                'memory_bytes': self._memory_bytes,
+                'disk_entries': len(self._disk),
+                'disk_bytes': self._disk_bytes,
+            }
+
+    def _store_memory(self, entry_key: Tuple[str, str], pdf_content: bytes):
+        if len(pdf_content) > self.memory_budget:
+            return
+        previous = self._memory.pop(entry_key, None)
+        if previous is not None:
+            self._memory_bytes -= len(previous)
+        self._memory[entry_key] = pdf_content
+        self._memory_bytes += len(pdf_content)
+        while self._memory_bytes > self.memory_budget:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def _forget_disk(self, entry_key: Tuple[str, str]):
+        size = self._disk.pop(entry_key, None)
+        if size is not None:
+            self._disk_bytes -= size
+
+    def _evict_disk(self):
+        while self._disk_bytes > self.disk_budget and self._disk:
+            (namespace, key), size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            try:
+                self._disk_path(namespace, key).unlink()
+            except FileNotFoundError:
+                pass
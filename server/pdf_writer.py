@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Minimal PDF Writer
+Builds PDF documents in memory using the standard Helvetica fonts, no external dependencies
+"""
+
+import zlib
+from typing import Dict, List, Tuple
+
+# Glyph widths (1/1000 em) for printable ASCII 32..126, from the standard Adobe font metrics
+_HELVETICA_WIDTHS = [
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+    1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+    333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+    556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584
+]
+
+_HELVETICA_BOLD_WIDTHS = [
+    278, 333, 474, 556, 556, 889, 722, 238, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 333, 333, 584, 584, 584, 611,
+    975, 722, 722, 722, 722, 667, 611, 778, 722, 278, 556, 722, 611, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 333, 278, 333, 584, 556,
+    333, 556, 611, 556, 611, 556, 333, 611, 611, 278, 278, 556, 278, 889, 611, 611,
+    611, 611, 389, 556, 333, 611, 556, 778, 556, 556, 500, 389, 280, 389, 584
+]
+
+# Resource name -> (base font, widths)
+FONTS: Dict[str, Tuple[str, List[int]]] = {
+    'F1': ('Helvetica', _HELVETICA_WIDTHS),
+    'F2': ('Helvetica-Bold', _HELVETICA_BOLD_WIDTHS),
+    'F3': ('Helvetica-Oblique', _HELVETICA_WIDTHS),
+}
+
+REGULAR = 'F1'
+BOLD = 'F2'
+ITALIC = 'F3'
+
+# US Letter in points
+PAGE_WIDTH = 612
+PAGE_HEIGHT = 792
+
+def text_width(text: str, font: str, size: float) -> float:
+    """Width of text in points when set in one of the standard fonts"""
+    widths = FONTS[font][1]
+    total = 0
+    for char in text:
+        code = ord(char)
+        total += widths[code - 32] if 32 <= code <= 126 else 556
+    return total * size / 1000
+
+def wrap_text(text: str, font: str, size: float, max_width: float) -> List[str]:
+    """Break text into lines no wider than max_width, splitting on spaces where possible"""
+    lines = []
+    for raw_line in str(text).split('\n'):
+        current = ''
+        for word in raw_line.split(' '):
+            candidate = f"{current} {word}" if current else word
+            if text_width(candidate, font, size) <= max_width:
+                current = candidate
+                continue
+            if current:
+                lines.append(current)
+            # Hard-break words that do not fit on a line of their own
+            while text_width(word, font, size) > max_width and len(word) > 1:
+                cut = len(word)
+                while cut > 1 and text_width(word[:cut], font, size) > max_width:
+                    cut -= 1
+                lines.append(word[:cut])
+                word = word[cut:]
+            current = word
+        lines.append(current)
+    return lines
+
+def _escape(text: str) -> bytes:
+    """Encode text for a PDF string literal in WinAnsiEncoding"""
+    encoded = str(text).encode('cp1252', errors='replace')
+    return encoded.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)')
+
+class PdfPage:
+    """Accumulates drawing operators for a single page"""
+
+    def __init__(self):
+        self._ops: List[bytes] = []
+
+    def text(self, x: float, y: float, text: str, font: str = REGULAR, size: float = 10):
+        """Draw text with its baseline starting at (x, y)"""
+        self._ops.append(b'BT /%s %.2f Tf %.2f %.2f Td (%s) Tj ET' % (
+            font.encode('ascii'), size, x, y, _escape(text)))
+
+    def text_right(self, x: float, y: float, text: str, font: str = REGULAR, size: float = 10):
+        """Draw text so that it ends at x"""
+        self.text(x - text_width(text, font, size), y, text, font, size)
+
+    def text_center(self, x: float, y: float, text: str, font: str = REGULAR, size: float = 10):
+        """Draw text centred on x"""
+        self.text(x - text_width(text, font, size) / 2, y, text, font, size)
+
+    def line(self, x1: float, y1: float, x2: float, y2: float, width: float = 0.5):
+        """Stroke a straight line"""
+        self._ops.append(b'%.2f w %.2f %.2f m %.2f %.2f l S' % (width, x1, y1, x2, y2))
+
+    def fill_rect(self, x: float, y: float, width: float, height: float, gray: float = 0.9):
+        """Fill a rectangle in a shade of gray, restoring black afterwards"""
+        self._ops.append(b'%.2f g %.2f %.2f %.2f %.2f re f 0 g' % (gray, x, y, width, height))
+
+    def content(self) -> bytes:
+        return b'\n'.join(self._ops)
+
+class PdfDocument:
+    """An in-memory PDF built page by page"""
+
+    def __init__(self, width: float = PAGE_WIDTH, height: float = PAGE_HEIGHT):
+        self.width = width
+        self.height = height
+        self.pages: List[PdfPage] = []
+
+    def add_page(self) -> PdfPage:
+        page = PdfPage()
+        self.pages.append(page)
+        return page
+
+    def to_bytes(self) -> bytes:
+        """Serialize the document, including the cross-reference table"""
+        objects: List[bytes] = []
+
+        def add_object(body: bytes) -> int:
+            objects.append(body)
+            return len(objects)
+
+        catalog_id = add_object(b'')
+        pages_id = add_object(b'')
+
+        font_refs = []
+        for resource_name, (base_font, _) in FONTS.items():
+            font_id = add_object(
+                b'<< /Type /Font /Subtype /Type1 /BaseFont /%s /Encoding /WinAnsiEncoding >>' % base_font.encode('ascii'))
+            font_refs.append(b'/%s %d 0 R' % (resource_name.encode('ascii'), font_id))
+        resources = b'<< /Font << ' + b' '.join(font_refs) + b' >> >>'
+
+        page_ids = []
+        for page in self.pages:
+            stream = zlib.compress(page.content())
+            content_id = add_object(
+                b'<< /Length %d /Filter /FlateDecode >>\nstream\n' % len(stream) + stream + b'\nendstream')
+            page_ids.append(add_object(
+                b'<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %.2f %.2f] /Resources %s /Contents %d 0 R >>' % (
+                    pages_id, self.width, self.height, resources, content_id)))
+
+        objects[catalog_id - 1] = b'<< /Type /Catalog /Pages %d 0 R >>' % pages_id
+        objects[pages_id - 1] = b'<< /Type /Pages /Kids [%s] /Count %d >>' % (
+            b' '.join(b'%d 0 R' % page_id for page_id in page_ids), len(page_ids))
+
+        output = bytearray(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+        offsets = []
+        for number, body in enumerate(objects, start=1):
+            offsets.append(len(output))
+            output += b'%d 0 obj\n' % number + body + b'\nendobj\n'
+
+        xref_offset = len(output)
+        output += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+        for offset in offsets:
+            output += b'%010d 00000 n \n' % offset
+        output += b'trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (
+            len(objects) + 1, catalog_id, xref_offset)
+
+        return bytes(output)
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Reminder Ledger
+Records which reminder tier each invoice has been sent so repeated runs do not send it again
+"""
+
+import sqlite3
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS reminder_ledger (
+    invoice_number TEXT NOT NULL,
+    tier TEXT NOT NULL,
+    sent_at TEXT NOT NULL,
+    send_count INTEGER NOT NULL DEFAULT 1,
+    PRIMARY KEY (invoice_number, tier)
+);
+"""
+
+def format_moment(moment: datetime) -> str:
+    """Fixed-width wall-clock timestamp whose string order is chronological order"""
+    return moment.strftime('%Y-%m-%dT%H:%M:%S.%f')
+
+def parse_moment(text: str) -> datetime:
+    return datetime.strptime(text, '%Y-%m-%dT%H:%M:%S.%f')
+
+def parse_resend_intervals(spec: Optional[str]) -> Dict[str, timedelta]:
+    """Parse "urgent=7,final=3" into the days after which each tier may be sent again"""
+    intervals = {}
+    for part in (spec or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        tier, separator, days = part.partition('=')
+        if not separator:
+            raise ValueError(f"Invalid resend interval: {part}")
+        intervals[tier.strip()] = timedelta(days=float(days))
+    return intervals
+
+class ReminderLedger:
+    """SQLite record of the reminders sent per invoice and tier, mirrored in memory
+
+    The whole ledger is read into a dict on open, so checking an invoice costs one dict
+    lookup; sends are written through as they are recorded. A tier is sent once, unless
+    resend_intervals gives it a number of days after which it may be sent again.
+    """
+
+    def __init__(self, path: str, resend_intervals: Optional[Dict[str, timedelta]] = None):
+        self.path = path
+        self.resend_intervals = resend_intervals or {}
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+
+        self._sent: Dict[Tuple[str, str], datetime] = {
+            (invoice_number, tier): parse_moment(sent_at)
+            for invoice_number, tier, sent_at in self.connection.execute(
+                'SELECT invoice_number, tier, sent_at FROM reminder_ledger')
+        }
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self._sent)
+
+    def last_sent(self, invoice_number: str, tier: str) -> Optional[datetime]:
+        return self._sent.get((invoice_number, tier))
+
+    def should_send(self, invoice_number: str, tier: str, now: datetime) -> bool:
+        """Whether the tier has never been sent for the invoice, or its resend interval has passed"""
+        sent_at = self._sent.get((invoice_number, tier))
+        if sent_at is None:
+            return True
+        interval = self.resend_intervals.get(tier)
+        return interval is not None and now - sent_at >= interval
+
+    def record(self, invoice_number: str, tier: str, sent_at: datetime):
+        """Record a sent reminder, committing at once so a crash cannot cause a resend"""
+        with self.connection:
+            self.connection.execute(
+                'INSERT INTO reminder_ledger (invoice_number, tier, sent_at) VALUES (?, ?, ?) '
+                'ON CONFLICT (invoice_number, tier) DO UPDATE SET sent_at = excluded.sent_at, '
+                'send_count = send_count + 1',
+                (invoice_number, tier, format_moment(sent_at)))
+        self._sent[(invoice_number, tier)] = sent_at
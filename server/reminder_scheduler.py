@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+"""
+Reminder Scheduler
+Keeps each open invoice's next reminder transition in a persistent index and wakes only when one is due
+"""
+
+import argparse
+import heapq
+import json
+import os
+import queue
+import sqlite3
+import sys
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, List, Any, Callable, Iterable, Iterator, Optional, TextIO, Tuple
+
+from email_service import DomainRateLimiter
+from export_state import invoice_key, materialize
+from invoice_input import NdjsonInvoiceFile, iter_ndjson
+from reminder_ledger import ReminderLedger, format_moment, parse_moment
+from reminder_service import ReminderService, ReminderTask, send_result
+
+# Longest overdue period searched for tier changes
+TRANSITION_HORIZON_DAYS = 366
+
+# Wait between retries of a reminder that could not be sent
+RETRY_DELAY_SECONDS = 3600.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS reminder_schedule (
+    invoice_key TEXT PRIMARY KEY,
+    next_at TEXT,
+    last_tier TEXT,
+    snapshot TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS reminder_schedule_next_at ON reminder_schedule (next_at);
+"""
+
+def reminder_transitions(get_reminder_type: Callable[[int], str],
+                         horizon: int = TRANSITION_HORIZON_DAYS) -> List[Tuple[int, str]]:
+    """Days overdue at which the reminder tier changes, read off the tier thresholds"""
+    transitions = []
+    previous = None
+    for days_overdue in range(1, horizon + 1):
+        tier = get_reminder_type(days_overdue)
+        if tier != previous:
+            transitions.append((days_overdue, tier))
+            previous = tier
+    return transitions
+
+def due_wall_time(invoice: Dict[str, Any]) -> datetime:
+    """The due date as wall-clock time, compared with the local clock as the reminder service does"""
+    return datetime.fromisoformat(invoice['dueDate'].replace('Z', '+00:00')).replace(tzinfo=None)
+
+class ReminderScheduler:
+    """A min-heap of next reminder transitions, backed by SQLite so it survives restarts
+
+    Each open invoice has at most one entry: the moment its days overdue reach the next
+    tier after the last one it was reminded at. Waking only pops entries that are due, so
+    a day's work is the number of invoices changing tier that day. Upserts and payments
+    replace or remove entries; superseded heap entries are dropped when they surface.
+    """
+
+    def __init__(self, path: str, reminder_service: Optional[ReminderService] = None,
+                 clock: Callable[[], datetime] = datetime.now, retry_delay: float = RETRY_DELAY_SECONDS,
+                 workers: Optional[int] = None, rate_limiter: Optional[DomainRateLimiter] = None,
+                 max_retries: int = 3):
+        self.path = path
+        self.reminder_service = reminder_service or ReminderService()
+        self.clock = clock
+        self.retry_delay = timedelta(seconds=retry_delay)
+        self.workers = workers
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+
+        self.transitions = reminder_transitions(self.reminder_service.get_reminder_type)
+        self._rank = {tier: rank for rank, (_, tier) in enumerate(self.transitions)}
+
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(SCHEMA)
+        self._next: Dict[str, datetime] = {}
+        self._heap: List[Tuple[datetime, str]] = []
+        for key, next_at in self.connection.execute(
+                'SELECT invoice_key, next_at FROM reminder_schedule WHERE next_at IS NOT NULL'):
+            self._next[key] = parse_moment(next_at)
+            self._heap.append((self._next[key], key))
+        heapq.heapify(self._heap)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self._next)
+
+    def next_transition(self, invoice: Dict[str, Any], last_tier: Optional[str]) -> Optional[datetime]:
+        """When the invoice next reaches a tier above last_tier, or None after the last tier"""
+        rank = self._rank.get(last_tier, -1)
+        if rank + 1 >= len(self.transitions):
+            return None
+        days_overdue, _ = self.transitions[rank + 1]
+        # days_overdue counts whole days, so the tier starts that many days after the due time
+        return due_wall_time(invoice) + timedelta(days=days_overdue)
+
+    def _schedule(self, key: str, next_at: Optional[datetime]):
+        if next_at is None:
+            self._next.pop(key, None)
+            return
+        if self._next.get(key) == next_at:
+            return
+        self._next[key] = next_at
+        heapq.heappush(self._heap, (next_at, key))
+
+        # Rebuild once superseded entries outnumber live ones, so frequent updates cannot grow the heap
+        if len(self._heap) > 2 * len(self._next) + 1024:
+            self._heap = [(moment, key) for key, moment in self._next.items()]
+            heapq.heapify(self._heap)
+
+    def _store(self, key: str, next_at: Optional[datetime], last_tier: Optional[str], snapshot: str):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO reminder_schedule (invoice_key, next_at, last_tier, snapshot) '
+            'VALUES (?, ?, ?, ?)',
+            (key, format_moment(next_at) if next_at is not None else None, last_tier, snapshot))
+
+    def upsert(self, invoice: Dict[str, Any], commit: bool = True) -> Optional[datetime]:
+        """Add or update an invoice, returning when its next reminder is due
+
+        Paid invoices are removed. An updated invoice keeps the tier it was last reminded at,
+        so a changed due date only moves the remaining transitions.
+        """
+        key = invoice_key(invoice)
+        if invoice.get('status') == 'paid':
+            self.remove(key, commit)
+            return None
+
+        invoice = materialize(invoice)
+        row = self.connection.execute('SELECT last_tier FROM reminder_schedule WHERE invoice_key = ?',
+                                      (key,)).fetchone()
+        last_tier = row[0] if row else None
+        next_at = self.next_transition(invoice, last_tier)
+        self._store(key, next_at, last_tier, json.dumps(invoice, default=str))
+        if commit:
+            self.connection.commit()
+        self._schedule(key, next_at)
+        return next_at
+
+    def upsert_many(self, invoices: Iterable[Dict[str, Any]]) -> int:
+        """Upsert invoices in one transaction, returning how many were scheduled
+
+        Invoices without a usable due date are reported and left out.
+        """
+        count = 0
+        for invoice in invoices:
+            try:
+                self.upsert(invoice, commit=False)
+            except (KeyError, TypeError, ValueError) as e:
+                print(f"Error scheduling invoice {invoice.get('invoiceNumber', 'Unknown')}: {str(e)}",
+                      file=sys.stderr)
+                continue
+            count += 1
+        self.connection.commit()
+        return count
+
+    def remove(self, key: str, commit: bool = True):
+        """Forget an invoice, as once it is paid or deleted"""
+        self.connection.execute('DELETE FROM reminder_schedule WHERE invoice_key = ?', (key,))
+        if commit:
+            self.connection.commit()
+        self._next.pop(key, None)
+
+    def apply(self, event: Dict[str, Any]):
+        """Apply an {"event": "upsert", "invoice": {...}} or {"event": "paid"|"delete", "id": ...} event"""
+        kind = event.get('event')
+        if kind == 'upsert':
+            self.upsert(event['invoice'])
+        elif kind in ('paid', 'delete'):
+            self.remove(invoice_key(event))
+        else:
+            raise ValueError(f"Unsupported scheduler event: {kind}")
+
+    def next_due(self) -> Optional[datetime]:
+        """The earliest scheduled transition, discarding superseded heap entries"""
+        while self._heap:
+            next_at, key = self._heap[0]
+            if self._next.get(key) == next_at:
+                return next_at
+            heapq.heappop(self._heap)
+        return None
+
+    def _pop_due(self, now: datetime) -> List[str]:
+        keys = []
+        while True:
+            next_at = self.next_due()
+            if next_at is None or next_at > now:
+                return keys
+            _, key = heapq.heappop(self._heap)
+            del self._next[key]
+            keys.append(key)
+
+    def run_due(self) -> Iterator[Dict[str, Any]]:
+        """Send the reminders of every transition now due, yielding one result per invoice"""
+        now = self.clock()
+        keys = self._pop_due(now)
+        if not keys:
+            return
+        final_deadline = (now + timedelta(days=7)).strftime('%B %d, %Y')
+
+        # Each invoice is reminded at the tier it is in now, which skips tiers passed while stopped
+        entries: Dict[str, Tuple[Dict[str, Any], Optional[str], ReminderTask]] = {}
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            placeholders = ','.join('?' * len(batch))
+            rows = self.connection.execute(
+                f'SELECT invoice_key, last_tier, snapshot FROM reminder_schedule '
+                f'WHERE invoice_key IN ({placeholders})', batch).fetchall()
+            for key, last_tier, snapshot in rows:
+                invoice = json.loads(snapshot)
+                try:
+                    task = self.reminder_service.classify(invoice, now, final_deadline)
+                except Exception as e:
+                    self._store(key, None, last_tier, snapshot)
+                    yield {'invoice': invoice.get('invoiceNumber', 'Unknown'), 'status': 'failed',
+                           'reason': str(e)}
+                    continue
+                if task is None or self._rank[task.reminder_type] <= self._rank.get(last_tier, -1):
+                    # Nothing new to say yet; wait for the next tier
+                    next_at = self.next_transition(invoice, last_tier)
+                    self._store(key, next_at, last_tier, snapshot)
+                    self._schedule(key, next_at)
+                    continue
+                ledger = self.reminder_service.ledger
+                if ledger is not None and not ledger.should_send(task.invoice_number, task.reminder_type, now):
+                    # Already sent by another run sharing the ledger; move on to the next tier
+                    last_tier = task.reminder_type
+                    next_at = self.next_transition(invoice, last_tier)
+                    self._store(key, next_at, last_tier, snapshot)
+                    self._schedule(key, next_at)
+                    continue
+                entries[key] = (invoice, last_tier, task)
+        self.connection.commit()
+
+        tasks = [(key, task) for key, (_, _, task) in entries.items()]
+
+        def messages() -> Iterator[Dict[str, Any]]:
+            for key, task in tasks:
+                yield {'id': key, 'to_email': task.to_email, 'content': self.reminder_service.compose(task)}
+
+        email_service = self.reminder_service.email_service
+        for result in email_service.send_many(messages(), self.workers, self.rate_limiter, self.max_retries):
+            key = result['id']
+            invoice, last_tier, task = entries.pop(key)
+            if result['success']:
+                last_tier = task.reminder_type
+                next_at = self.next_transition(invoice, last_tier)
+                if self.reminder_service.ledger is not None:
+                    self.reminder_service.ledger.record(task.invoice_number, last_tier, now)
+            else:
+                next_at = self.clock() + self.retry_delay
+            self._store(key, next_at, last_tier, json.dumps(invoice))
+            self.connection.commit()
+            self._schedule(key, next_at)
+            yield send_result(task, result)
+
+    def serve(self, events: "queue.Queue[Optional[Dict[str, Any]]]", output: TextIO,
+              stop: threading.Event):
+        """Apply events and send due reminders until stop is set, sleeping until the next transition"""
+        def write(result: Dict[str, Any]):
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+
+        events_open = True
+        while not stop.is_set():
+            for result in self.run_due():
+                write(result)
+
+            next_at = self.next_due()
+            timeout = None if next_at is None else max((next_at - self.clock()).total_seconds(), 0.0)
+            if not events_open:
+                stop.wait(timeout)
+                continue
+            try:
+                event = events.get(timeout=timeout)
+            except queue.Empty:
+                continue
+            if event is None:
+                # The event source has closed; keep waking for scheduled transitions
+                events_open = False
+                continue
+            try:
+                self.apply(event)
+            except Exception as e:
+                write({'event': event.get('event') if isinstance(event, dict) else None,
+                       'status': 'failed', 'reason': str(e)})
+
+def read_events(stream: TextIO, events: "queue.Queue[Optional[Dict[str, Any]]]"):
+    """Queue one event per line of stream, then None at end of input"""
+    try:
+        for line in stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                events.put(json.loads(line))
+            except ValueError as e:
+                print(f"Invalid scheduler event: {e}", file=sys.stderr)
+    finally:
+        events.put(None)
+
+def main():
+    """
+    Command line interface for the reminder scheduler
+    Events are read from stdin, one JSON object per line:
+    {"event": "upsert", "invoice": {...}}
+    {"event": "paid", "id": 42}
+    """
+    parser = argparse.ArgumentParser(
+        description="Send reminders as invoices change tier, from a persistent schedule of transitions")
+    parser.add_argument('--state', default=os.getenv('REMINDER_SCHEDULE_STATE', 'reminder_schedule.db'),
+                        help="SQLite file holding the schedule")
+    parser.add_argument('--input', metavar='PATH', help="Upsert every invoice of an NDJSON file before starting")
+    parser.add_argument('--once', action='store_true',
+                        help="Apply the events on stdin, send the reminders due now and exit")
+    parser.add_argument('--workers', type=int, help="Concurrent sends (default: twice SMTP_POOL_SIZE)")
+    parser.add_argument('--rate-per-domain', type=float, default=float(os.getenv('SMTP_DOMAIN_RATE', '0')),
+                        help="Reminders per second to any one recipient domain, 0 for no limit")
+    parser.add_argument('--burst', type=int, default=int(os.getenv('SMTP_DOMAIN_BURST', '1')),
+                        help="Reminders a domain may receive back to back before the rate applies")
+    parser.add_argument('--max-retries', type=int, default=3,
+                        help="Retries of a reminder after temporary (4xx) failures")
+    parser.add_argument('--retry-delay', type=float, default=RETRY_DELAY_SECONDS,
+                        help="Seconds before a reminder that could not be sent is tried again")
+    parser.add_argument('--ledger', default=os.getenv('REMINDER_LEDGER'),
+                        help="SQLite reminder ledger to record sends in, shared with batch reminder runs")
+    args = parser.parse_args()
+
+    scheduler = None
+    ledger = None
+    try:
+        if args.ledger:
+            ledger = ReminderLedger(args.ledger)
+        scheduler = ReminderScheduler(args.state, ReminderService(ledger=ledger),
+                                      retry_delay=args.retry_delay, workers=args.workers,
+                                      rate_limiter=DomainRateLimiter(args.rate_per_domain, args.burst),
+                                      max_retries=args.max_retries)
+        if args.input:
+            with NdjsonInvoiceFile(args.input) as input_file:
+                scheduler.upsert_many(input_file)
+
+        if args.once:
+            for event in iter_ndjson(sys.stdin) if not sys.stdin.isatty() else ():
+                scheduler.apply(event)
+            for result in scheduler.run_due():
+                print(json.dumps(result))
+            return
+
+        events: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue()
+        threading.Thread(target=read_events, args=(sys.stdin, events), daemon=True).start()
+        scheduler.serve(events, sys.stdout, threading.Event())
+
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        error_result = {"success": False, "error": str(e)}
+        print(json.dumps(error_result), file=sys.stderr)
+        sys.exit(1)
+    finally:
+        if scheduler is not None:
+            scheduler.reminder_service.email_service.close()
+            scheduler.close()
+        if ledger is not None:
+            ledger.close()
+
+if __name__ == "__main__":
+    main()
@@ -4,24 +4,47 @@ Automated Reminder Service for Overdue Invoices
 Handles sending reminder emails for overdue invoices
 """
 
+import argparse
 import json
 import sys
-import smtplib
-import ssl
 import os
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
 from datetime import datetime, timedelta
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Callable, Iterable, Iterator, Optional
+
+from email_service import SMTPEmailService, DomainRateLimiter
+from message_factory import REMINDER_TEMPLATE_PREFIX, read_email_templates
+from invoice_input import NdjsonInvoiceFile
+from reminder_ledger import ReminderLedger, parse_resend_intervals
+
+# Reminder tiers in the order they are sent, most overdue first
+SEND_ORDER = ('final', 'urgent', 'gentle')
+
+class ReminderTask:
+    """An overdue invoice reduced to what its reminder needs"""
+    
+    __slots__ = ('invoice_number', 'to_email', 'reminder_type', 'days_overdue', 'email_data')
+    
+    def __init__(self, invoice_number: str, to_email: str, reminder_type: str, days_overdue: int,
+                 email_data: Dict[str, Any]):
+        self.invoice_number = invoice_number
+        self.to_email = to_email
+        self.reminder_type = reminder_type
+        self.days_overdue = days_overdue
+        self.email_data = email_data
 
 class ReminderService:
-    def __init__(self):
-        # SMTP Configuration
-        self.smtp_server = os.getenv('SMTP_SERVER', 'smtp.gmail.com')
-        self.smtp_port = int(os.getenv('SMTP_PORT', '587'))
-        self.smtp_username = os.getenv('SMTP_USERNAME', '')
-        self.smtp_password = os.getenv('SMTP_PASSWORD', '')
-        self.from_email = os.getenv('FROM_EMAIL', self.smtp_username)
+    def __init__(self, email_service: Optional[SMTPEmailService] = None,
+                 ledger: Optional[ReminderLedger] = None,
+                 clock: Callable[[], datetime] = datetime.now):
+        # SMTP sessions are pooled and shared by every reminder sent
+        self.email_service = email_service or SMTPEmailService()
+        self.from_email = self.email_service.from_email
+        
+        # Reminders already sent, when kept, are not sent again
+        self.ledger = ledger
+        
+        # Wall clock that days overdue are counted from; replaceable for replays and benchmarks
+        self.clock = clock
         
         # Reminder templates
         self.reminder_templates = {
@@ -92,6 +115,11 @@ Best regards,
 {company_name}"""
             }
         }
+        
+        # Templates are compiled once; emailTemplates rows typed reminder_<tier> override them
+        for reminder_type, template in self.reminder_templates.items():
+            self.email_service.messages.register(REMINDER_TEMPLATE_PREFIX + reminder_type,
+                                                 template['subject'], template['body'])
     
     def get_reminder_type(self, days_overdue: int) -> str:
         """Determine reminder type based on days overdue"""
@@ -102,62 +130,118 @@ Best regards,
         else:
             return 'final'
     
+    def classify(self, invoice: Dict[str, Any], current_time: datetime, final_deadline: str,
+                 overdue_only: bool = True) -> Optional[ReminderTask]:
+        """Parse an invoice once into the reminder it needs, or None if it needs none"""
+        due_date = datetime.fromisoformat(invoice['dueDate'].replace('Z', '+00:00'))
+        days_overdue = (current_time.replace(tzinfo=due_date.tzinfo) - due_date).days
+        if overdue_only and (days_overdue <= 0 or invoice['status'] == 'paid'):
+            return None
+        
+        email_data = {
+            'client_name': invoice['clientName'],
+            'invoice_number': invoice['invoiceNumber'],
+            'total_amount': invoice['total'],
+            'due_date': due_date.strftime('%B %d, %Y'),
+            'days_overdue': days_overdue,
+            'company_name': invoice.get('companyName', 'Your Company'),
+            'final_deadline': final_deadline
+        }
+        return ReminderTask(invoice['invoiceNumber'], invoice['clientEmail'],
+                            self.get_reminder_type(days_overdue), days_overdue, email_data)
+    
+    def render(self, task: ReminderTask, reminder_type: Optional[str] = None) -> Dict[str, str]:
+        """Subject and body of a reminder"""
+        key = REMINDER_TEMPLATE_PREFIX + (reminder_type or task.reminder_type)
+        subject, body = self.email_service.messages.template(key).render(task.email_data)
+        return {'subject': subject, 'body': body}
+    
+    def compose(self, task: ReminderTask, reminder_type: Optional[str] = None) -> bytes:
+        """Wire-ready reminder message"""
+        key = REMINDER_TEMPLATE_PREFIX + (reminder_type or task.reminder_type)
+        return self.email_service.messages.render(key, task.to_email, task.email_data)
+    
     def send_reminder_email(self, invoice: Dict[str, Any], reminder_type: str = None) -> bool:
         """Send reminder email for overdue invoice"""
         try:
-            # Calculate days overdue
-            due_date = datetime.fromisoformat(invoice['dueDate'].replace('Z', '+00:00'))
-            days_overdue = (datetime.now(due_date.tzinfo) - due_date).days
-            
-            # Auto-determine reminder type if not specified
-            if not reminder_type:
-                reminder_type = self.get_reminder_type(days_overdue)
-            
-            template = self.reminder_templates[reminder_type]
-            
             # Calculate final deadline (7 days from now)
-            final_deadline = (datetime.now() + timedelta(days=7)).strftime('%B %d, %Y')
-            
-            # Prepare email data
-            email_data = {
-                'client_name': invoice['clientName'],
-                'invoice_number': invoice['invoiceNumber'],
-                'total_amount': invoice['total'],
-                'due_date': due_date.strftime('%B %d, %Y'),
-                'days_overdue': days_overdue,
-                'company_name': invoice.get('companyName', 'Your Company'),
-                'final_deadline': final_deadline
-            }
-            
-            # Replace placeholders in subject and body
-            subject = template['subject'].format(**email_data)
-            body = template['body'].format(**email_data)
-            
-            # Create email message
-            msg = MIMEMultipart()
-            msg['From'] = self.from_email
-            msg['To'] = invoice['clientEmail']
-            msg['Subject'] = subject
-            
-            # Add body to email
-            msg.attach(MIMEText(body, 'plain'))
-            
-            # Send email
-            server = smtplib.SMTP(self.smtp_server, self.smtp_port)
-            server.starttls()
-            server.login(self.smtp_username, self.smtp_password)
-            
-            text = msg.as_string()
-            server.sendmail(self.from_email, invoice['clientEmail'], text)
-            server.quit()
-            
+            current_time = self.clock()
+            final_deadline = (current_time + timedelta(days=7)).strftime('%B %d, %Y')
+            task = self.classify(invoice, current_time, final_deadline, overdue_only=False)
+            text = self.compose(task, reminder_type)
+            result = self.email_service.send_message(task.to_email, text)
+            if not result['success']:
+                print(f"Error sending reminder email: {result.get('error')}", file=sys.stderr)
+                return False
+            if self.ledger is not None:
+                self.ledger.record(task.invoice_number, reminder_type or task.reminder_type, current_time)
             return True
             
         except Exception as e:
             print(f"Error sending reminder email: {str(e)}", file=sys.stderr)
             return False
     
-    def process_overdue_invoices(self, invoices: List[Dict[str, Any]]) -> Dict[str, Any]:
+    def iter_reminders(self, invoices: Iterable[Dict[str, Any]], workers: Optional[int] = None,
+                       rate_limiter: Optional[DomainRateLimiter] = None, max_retries: int = 3,
+                       backoff: float = 1.0) -> Iterator[Dict[str, Any]]:
+        """Send reminders for every overdue invoice, yielding one result per invoice as it is known
+        
+        Invoices are classified in a single pass, which yields skips and bad records straight
+        away; reminders the ledger has already recorded are skipped there too, before any
+        message is built. The rest are sent tier by tier, most overdue first, over the shared
+        connection pool with up to `workers` sends in flight.
+        """
+        current_time = self.clock()
+        final_deadline = (current_time + timedelta(days=7)).strftime('%B %d, %Y')
+        tiers: Dict[str, List[ReminderTask]] = {reminder_type: [] for reminder_type in SEND_ORDER}
+        
+        for invoice in invoices:
+            try:
+                task = self.classify(invoice, current_time, final_deadline)
+            except Exception as e:
+                yield {
+                    'invoice': invoice.get('invoiceNumber', 'Unknown'),
+                    'status': 'failed',
+                    'reason': str(e)
+                }
+                continue
+            
+            if task is None:
+                yield {
+                    'invoice': invoice['invoiceNumber'],
+                    'status': 'skipped',
+                    'reason': 'Not overdue or already paid'
+                }
+                continue
+            
+            if self.ledger is not None and not self.ledger.should_send(
+                    task.invoice_number, task.reminder_type, current_time):
+                yield {
+                    'invoice': task.invoice_number,
+                    'status': 'skipped',
+                    'type': task.reminder_type,
+                    'reason': 'Reminder already sent'
+                }
+                continue
+            tiers[task.reminder_type].append(task)
+        
+        tasks = [task for reminder_type in SEND_ORDER for task in tiers[reminder_type]]
+        del tiers
+        
+        # Messages are composed only as the sender takes them, so at most a few are held at once
+        def messages() -> Iterator[Dict[str, Any]]:
+            for index, task in enumerate(tasks):
+                yield {'id': index, 'to_email': task.to_email, 'content': self.compose(task)}
+        
+        for result in self.email_service.send_many(messages(), workers, rate_limiter, max_retries, backoff):
+            task = tasks[result['id']]
+            if result['success'] and self.ledger is not None:
+                self.ledger.record(task.invoice_number, task.reminder_type, current_time)
+            yield send_result(task, result)
+    
+    def process_overdue_invoices(self, invoices: Iterable[Dict[str, Any]], workers: Optional[int] = None,
+                                 rate_limiter: Optional[DomainRateLimiter] = None,
+                                 max_retries: int = 3, backoff: float = 1.0) -> Dict[str, Any]:
         """Process all overdue invoices and send reminders"""
         results = {
             'processed': 0,
@@ -167,68 +251,90 @@ Best regards,
             'details': []
         }
         
-        current_time = datetime.now()
-        
-        for invoice in invoices:
-            try:
-                # Check if invoice is overdue
-                due_date = datetime.fromisoformat(invoice['dueDate'].replace('Z', '+00:00'))
-                days_overdue = (current_time.replace(tzinfo=due_date.tzinfo) - due_date).days
-                
-                if days_overdue <= 0 or invoice['status'] == 'paid':
-                    results['skipped'] += 1
-                    results['details'].append({
-                        'invoice': invoice['invoiceNumber'],
-                        'status': 'skipped',
-                        'reason': 'Not overdue or already paid'
-                    })
-                    continue
-                
-                results['processed'] += 1
-                
-                # Send reminder
-                reminder_type = self.get_reminder_type(days_overdue)
-                success = self.send_reminder_email(invoice, reminder_type)
-                
-                if success:
-                    results['sent'] += 1
-                    results['details'].append({
-                        'invoice': invoice['invoiceNumber'],
-                        'status': 'sent',
-                        'type': reminder_type,
-                        'days_overdue': days_overdue,
-                        'client': invoice['clientName']
-                    })
-                else:
-                    results['failed'] += 1
-                    results['details'].append({
-                        'invoice': invoice['invoiceNumber'],
-                        'status': 'failed',
-                        'reason': 'Email sending failed'
-                    })
-                    
-            except Exception as e:
-                results['failed'] += 1
-                results['details'].append({
-                    'invoice': invoice.get('invoiceNumber', 'Unknown'),
-                    'status': 'failed',
-                    'reason': str(e)
-                })
+        for detail in self.iter_reminders(invoices, workers, rate_limiter, max_retries, backoff):
+            count_result(results, detail)
+            results['details'].append(detail)
         
         return results
 
+def send_result(task: ReminderTask, result: Dict[str, Any]) -> Dict[str, Any]:
+    """Per-invoice detail of a reminder send"""
+    if result['success']:
+        return {
+            'invoice': task.invoice_number,
+            'status': 'sent',
+            'type': task.reminder_type,
+            'days_overdue': task.days_overdue,
+            'client': task.email_data['client_name']
+        }
+    return {
+        'invoice': task.invoice_number,
+        'status': 'failed',
+        'type': task.reminder_type,
+        'reason': 'Email sending failed',
+        'error': result.get('error')
+    }
+
+def count_result(results: Dict[str, Any], detail: Dict[str, Any]):
+    """Add one invoice result to the processed, sent, failed and skipped counters"""
+    status = detail['status']
+    results[status] += 1
+    # Overdue invoices count as processed once a send was attempted
+    if status == 'sent' or (status == 'failed' and 'type' in detail):
+        results['processed'] += 1
+
 def main():
     """Command line interface for reminder service"""
+    parser = argparse.ArgumentParser(description="Send reminder emails for overdue invoices")
+    parser.add_argument('--input', metavar='PATH',
+                        help="Read invoices from an NDJSON file, memory-mapped, instead of a JSON document on stdin")
+    parser.add_argument('--stream', action='store_true',
+                        help="Write one JSON result line per invoice as it is known, then a summary line")
+    parser.add_argument('--workers', type=int, help="Concurrent sends (default: twice SMTP_POOL_SIZE)")
+    parser.add_argument('--rate-per-domain', type=float, default=float(os.getenv('SMTP_DOMAIN_RATE', '0')),
+                        help="Reminders per second to any one recipient domain, 0 for no limit")
+    parser.add_argument('--burst', type=int, default=int(os.getenv('SMTP_DOMAIN_BURST', '1')),
+                        help="Reminders a domain may receive back to back before the rate applies")
+    parser.add_argument('--max-retries', type=int, default=3,
+                        help="Retries of a reminder after temporary (4xx) failures")
+    parser.add_argument('--ledger', default=os.getenv('REMINDER_LEDGER'),
+                        help="SQLite file recording reminders sent, so later runs skip them")
+    parser.add_argument('--resend-days', default=os.getenv('REMINDER_RESEND_DAYS'),
+                        help="Days after which a tier may be sent again, e.g. urgent=7,final=3 (default: never)")
+    parser.add_argument('--templates', metavar='PATH',
+                        help="JSON file of emailTemplates rows; reminder_gentle, reminder_urgent and "
+                             "reminder_final rows replace the built-in reminders (default: EMAIL_TEMPLATES)")
+    args = parser.parse_args()
+    
+    reminder_service = None
+    ledger = None
     try:
-        # Read JSON input from stdin
-        input_data = json.loads(sys.stdin.read())
+        if args.input:
+            invoices = NdjsonInvoiceFile(args.input)
+        else:
+            # Read JSON input from stdin
+            input_data = json.loads(sys.stdin.read())
+            invoices = input_data.get('invoices', [])
+        
+        if args.ledger:
+            ledger = ReminderLedger(args.ledger, parse_resend_intervals(args.resend_days))
         
         # Create reminder service
-        reminder_service = ReminderService()
+        email_service = SMTPEmailService(templates=read_email_templates(args.templates) if args.templates else None)
+        reminder_service = ReminderService(email_service, ledger)
+        rate_limiter = DomainRateLimiter(args.rate_per_domain, args.burst)
         
         # Process reminders
-        invoices = input_data.get('invoices', [])
-        results = reminder_service.process_overdue_invoices(invoices)
+        if args.stream:
+            results = {'processed': 0, 'sent': 0, 'failed': 0, 'skipped': 0}
+            for detail in reminder_service.iter_reminders(invoices, args.workers, rate_limiter,
+                                                          args.max_retries):
+                count_result(results, detail)
+                sys.stdout.write(json.dumps(detail) + "\n")
+                sys.stdout.flush()
+        else:
+            results = reminder_service.process_overdue_invoices(invoices, args.workers, rate_limiter,
+                                                                args.max_retries)
         
         # Return results
         result = {
@@ -247,6 +353,11 @@ def main():
         }
         print(json.dumps(error_result), file=sys.stderr)
         sys.exit(1)
+    finally:
+        if reminder_service is not None:
+            reminder_service.email_service.close()
+        if ledger is not None:
+            ledger.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,467 @@
+#!/usr/bin/env python3
+"""
+SMTP Transport
+Asyncio SMTP client with pooled, pipelined sessions and a blocking facade for the email services
+"""
+
+import asyncio
+import atexit
+import base64
+import concurrent.futures
+import os
+import re
+import smtplib
+import socket
+import ssl
+import threading
+import time
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import Any, AsyncIterator, Coroutine, Dict, List, Optional, Tuple, Union
+
+CRLF = b'\r\n'
+
+# Reply codes meaning the server is closing or throttling this session
+RECONNECT_CODES = (421,)
+
+# Longest reply line accepted, as in smtplib
+MAX_LINE_LENGTH = 8192
+
+LEADING_PERIOD = re.compile(br'(?m)^\.')
+
+LINE_ENDING = re.compile(r'\r\n|\r|\n')
+
+def is_connection_error(error: BaseException) -> bool:
+    """Whether an error leaves the session unusable, as opposed to rejecting one message"""
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code in RECONNECT_CODES
+    if isinstance(error, smtplib.SMTPException):
+        return False
+    # Socket errors and timeouts
+    return isinstance(error, OSError)
+
+def quote_periods(message: bytes) -> bytes:
+    """Message content dot-stuffed and terminated for DATA"""
+    message = LEADING_PERIOD.sub(b'..', message)
+    if not message.endswith(CRLF):
+        message += CRLF
+    return message + b'.' + CRLF
+
+@lru_cache(maxsize=None)
+def starttls_context() -> ssl.SSLContext:
+    """TLS settings matching smtplib.starttls() without a context: encrypted, certificates unchecked
+
+    Built once and shared, since loading a context costs more than the handshake itself.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+class SMTPConnection:
+    """One SMTP session over asyncio streams
+
+    Every reply is awaited with the session timeout; a timed out, cancelled or dropped
+    session is closed and must not be reused. When the server advertises PIPELINING the
+    envelope and DATA command of a message go out in one write.
+    """
+
+    def __init__(self, host: str, port: int, timeout: float = 30.0, local_hostname: Optional[str] = None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.local_hostname = local_hostname or socket.getfqdn()
+        self.features: Dict[str, str] = {}
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.messages_sent = 0
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+
+    @property
+    def connected(self) -> bool:
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def connect(self, username: str = '', password: str = '', starttls: bool = True):
+        """Open the session, upgrade it with STARTTLS and authenticate"""
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, limit=MAX_LINE_LENGTH * 8), self.timeout)
+        try:
+            code, message = await self.read_reply()
+            if code != 220:
+                raise smtplib.SMTPConnectError(code, message)
+            await self.ehlo()
+
+            if starttls:
+                if 'starttls' not in self.features:
+                    raise smtplib.SMTPNotSupportedError("STARTTLS extension not supported by server.")
+                code, message = await self.command(b'STARTTLS')
+                if code != 220:
+                    raise smtplib.SMTPResponseException(code, message)
+                await asyncio.wait_for(
+                    self._writer.start_tls(starttls_context(), server_hostname=self.host), self.timeout)
+                await self.ehlo()
+
+            if username:
+                await self.login(username, password)
+        except BaseException:
+            self.abort()
+            raise
+
+    async def read_reply(self) -> Tuple[int, bytes]:
+        """Read one possibly multiline reply"""
+        lines = []
+        try:
+            async with asyncio.timeout(self.timeout):
+                while True:
+                    line = await self._reader.readline()
+                    if not line:
+                        raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+                    if len(line) > MAX_LINE_LENGTH:
+                        raise smtplib.SMTPResponseException(500, b"Line too long.")
+                    lines.append(line[4:].strip(b' \t\r\n'))
+                    if line[3:4] != b'-':
+                        break
+        except ValueError:
+            self.abort()
+            raise smtplib.SMTPResponseException(500, b"Line too long.")
+        except BaseException:
+            self.abort()
+            raise
+        try:
+            code = int(line[:3])
+        except ValueError:
+            code = -1
+        if code in RECONNECT_CODES:
+            self.abort()
+        return code, b'\n'.join(lines)
+
+    async def write(self, data: bytes):
+        if not self.connected:
+            raise smtplib.SMTPServerDisconnected("please run connect() first")
+        self._writer.write(data)
+        try:
+            async with asyncio.timeout(self.timeout):
+                await self._writer.drain()
+        except BaseException:
+            self.abort()
+            raise
+
+    async def command(self, line: bytes) -> Tuple[int, bytes]:
+        await self.write(line + CRLF)
+        return await self.read_reply()
+
+    async def ehlo(self):
+        """Greet the server and record the extensions it advertises"""
+        code, message = await self.command(b'EHLO ' + self.local_hostname.encode('ascii', 'replace'))
+        self.features = {}
+        if code != 250:
+            code, message = await self.command(b'HELO ' + self.local_hostname.encode('ascii', 'replace'))
+            if code != 250:
+                raise smtplib.SMTPHeloError(code, message)
+            return
+        for line in message.decode('latin-1').split('\n')[1:]:
+            keyword, _, parameters = line.partition(' ')
+            self.features[keyword.lower()] = parameters.strip()
+
+    async def login(self, username: str, password: str):
+        methods = self.features.get('auth', '').upper().split()
+        if 'PLAIN' in methods:
+            token = base64.b64encode(f"\0{username}\0{password}".encode('utf-8'))
+            code, message = await self.command(b'AUTH PLAIN ' + token)
+        elif 'LOGIN' in methods:
+            code, message = await self.command(b'AUTH LOGIN ' + base64.b64encode(username.encode('utf-8')))
+            if code == 334:
+                code, message = await self.command(base64.b64encode(password.encode('utf-8')))
+        elif 'auth' not in self.features:
+            raise smtplib.SMTPNotSupportedError("SMTP AUTH extension not supported by server.")
+        else:
+            raise smtplib.SMTPException("No suitable authentication method found.")
+        if code not in (235, 503):
+            raise smtplib.SMTPAuthenticationError(code, message)
+
+    async def noop(self) -> int:
+        code, _ = await self.command(b'NOOP')
+        return code
+
+    async def rset(self):
+        """Reset a failed transaction so the session can carry the next one"""
+        try:
+            await self.command(b'RSET')
+        except smtplib.SMTPServerDisconnected:
+            pass
+
+    async def _abort_data(self):
+        # The server accepted DATA for an envelope that failed; end it empty before resetting
+        await self.write(b'.' + CRLF)
+        await self.read_reply()
+
+    async def send(self, from_addr: str, to_addrs: Union[str, List[str]], message: bytes) -> Dict[str, Tuple[int, bytes]]:
+        """Send one message, returning the refused recipients as smtplib.sendmail does"""
+        if isinstance(to_addrs, str):
+            to_addrs = [to_addrs]
+        mail = b'MAIL FROM:<' + from_addr.encode('utf-8') + b'>'
+        recipients = [b'RCPT TO:<' + address.encode('utf-8') + b'>' for address in to_addrs]
+
+        if 'pipelining' in self.features:
+            await self.write(CRLF.join([mail] + recipients + [b'DATA']) + CRLF)
+            mail_reply = await self.read_reply()
+            recipient_replies = [await self.read_reply() for _ in recipients]
+            data_reply = await self.read_reply()
+        else:
+            mail_reply = await self.command(mail)
+            recipient_replies = []
+            data_reply = None
+            if mail_reply[0] == 250:
+                recipient_replies = [await self.command(line) for line in recipients]
+                if any(code in (250, 251) for code, _ in recipient_replies):
+                    data_reply = await self.command(b'DATA')
+
+        refused = {address: reply for address, reply in zip(to_addrs, recipient_replies)
+                   if reply[0] not in (250, 251)}
+        if mail_reply[0] != 250 or len(refused) == len(to_addrs) or data_reply[0] != 354:
+            if mail_reply[0] in RECONNECT_CODES:
+                raise smtplib.SMTPSenderRefused(mail_reply[0], mail_reply[1], from_addr)
+            if data_reply is not None and data_reply[0] == 354:
+                await self._abort_data()
+            await self.rset()
+            if mail_reply[0] != 250:
+                raise smtplib.SMTPSenderRefused(mail_reply[0], mail_reply[1], from_addr)
+            if len(refused) == len(to_addrs):
+                raise smtplib.SMTPRecipientsRefused(refused)
+            raise smtplib.SMTPDataError(*data_reply)
+
+        await self.write(quote_periods(message))
+        code, reply = await self.read_reply()
+        if code != 250:
+            if code not in RECONNECT_CODES:
+                await self.rset()
+            raise smtplib.SMTPDataError(code, reply)
+        self.messages_sent += 1
+        self.last_used = time.monotonic()
+        return refused
+
+    def abort(self):
+        """Drop the connection without a goodbye"""
+        if self._writer is not None:
+            self._writer.close()
+
+    async def quit(self):
+        try:
+            if self.connected:
+                await self.command(b'QUIT')
+        except Exception:
+            pass
+        finally:
+            self.abort()
+
+class AsyncSMTPPool:
+    """Keeps authenticated SMTP sessions open and hands them out to concurrent sends
+
+    Sessions idle for longer than health_check_interval are probed with NOOP before reuse,
+    sessions that fail are replaced, and a session is retired after max_messages so that
+    provider per-connection limits are never hit. At most max_connections are open at once;
+    sends beyond that wait for one to be released.
+    """
+
+    def __init__(self, host: str, port: int, username: str = '', password: str = '',
+                 max_connections: int = 4, max_messages: int = 100, health_check_interval: float = 30.0,
+                 max_idle: float = 300.0, timeout: float = 30.0, starttls: bool = True):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.max_connections = max_connections
+        self.max_messages = max_messages
+        self.health_check_interval = health_check_interval
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.starttls = starttls
+        self.local_hostname = socket.getfqdn()
+
+        self._idle: List[SMTPConnection] = []
+        self._open = 0
+        self._closed = False
+        self._condition: Optional[asyncio.Condition] = None
+
+        self.connections_opened = 0
+        self.messages_sent = 0
+
+    @property
+    def condition(self) -> asyncio.Condition:
+        # Created on first use so the pool binds to the loop that runs it
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    async def _connect(self) -> SMTPConnection:
+        connection = SMTPConnection(self.host, self.port, self.timeout, self.local_hostname)
+        await connection.connect(self.username, self.password, self.starttls)
+        self.connections_opened += 1
+        return connection
+
+    async def _healthy(self, connection: SMTPConnection) -> bool:
+        idle = time.monotonic() - connection.last_used
+        if not connection.connected or idle > self.max_idle:
+            return False
+        if idle < self.health_check_interval:
+            return True
+        try:
+            return await connection.noop() == 250
+        except Exception:
+            return False
+
+    async def acquire(self) -> SMTPConnection:
+        """Take an idle healthy session, opening a new one if none is left"""
+        async with self.condition:
+            while True:
+                if self._closed:
+                    raise RuntimeError("SMTP connection pool is closed")
+                if self._idle:
+                    connection = self._idle.pop()
+                    break
+                if self._open < self.max_connections:
+                    self._open += 1
+                    connection = None
+                    break
+                await self.condition.wait()
+
+        try:
+            if connection is not None:
+                if await self._healthy(connection):
+                    return connection
+                await connection.quit()
+            return await self._connect()
+        except BaseException:
+            async with self.condition:
+                self._open -= 1
+                self.condition.notify()
+            raise
+
+    async def release(self, connection: SMTPConnection, discard: bool = False):
+        """Return a session to the pool, closing it if it failed or has reached its message cap"""
+        connection.last_used = time.monotonic()
+        retire = discard or not connection.connected or connection.messages_sent >= self.max_messages
+        async with self.condition:
+            if not retire and not self._closed:
+                self._idle.append(connection)
+                self.condition.notify()
+                return
+            self._open -= 1
+            self.condition.notify()
+        if discard:
+            connection.abort()
+        else:
+            await connection.quit()
+
+    @asynccontextmanager
+    async def connection(self) -> AsyncIterator[SMTPConnection]:
+        connection = await self.acquire()
+        try:
+            yield connection
+        except Exception as e:
+            await self.release(connection, discard=is_connection_error(e))
+            raise
+        except BaseException:
+            # Cancelled mid-conversation: the session state is unknown
+            connection.abort()
+            await asyncio.shield(self.release(connection, discard=True))
+            raise
+        else:
+            await self.release(connection)
+
+    async def send(self, from_addr: str, to_addrs: Union[str, List[str]], message: bytes) -> Dict[str, Tuple[int, bytes]]:
+        """Send one message in a single attempt; a session that failed is discarded, retrying is the caller's"""
+        async with self.connection() as connection:
+            result = await connection.send(from_addr, to_addrs, message)
+            self.messages_sent += 1
+            return result
+
+    async def noop(self) -> int:
+        async with self.connection() as connection:
+            return await connection.noop()
+
+    async def close(self):
+        """Quit every idle session; sessions still in use are closed as they are released"""
+        async with self.condition:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+            self.condition.notify_all()
+        await asyncio.gather(*(connection.quit() for connection in idle))
+
+class SMTPTransport:
+    """Runs an AsyncSMTPPool on its own event loop thread, for callers that block
+
+    submit() schedules a coroutine on that loop and returns a concurrent future, so a
+    caller can keep many sends in flight from one thread; cancelling the future cancels
+    the send and discards its session.
+    """
+
+    def __init__(self, pool: AsyncSMTPPool):
+        self.pool = pool
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name='smtp-transport', daemon=True)
+        self._thread.start()
+        self._closed = False
+        atexit.register(self.close)
+
+    @classmethod
+    def from_env(cls, host: str, port: int, username: str = '', password: str = '') -> "SMTPTransport":
+        """Build a transport limited by SMTP_POOL_SIZE, SMTP_MAX_MESSAGES_PER_CONNECTION and SMTP_HEALTH_CHECK_SECONDS"""
+        return cls(AsyncSMTPPool(
+            host, port, username, password,
+            max_connections=int(os.getenv('SMTP_POOL_SIZE', '4')),
+            max_messages=int(os.getenv('SMTP_MAX_MESSAGES_PER_CONNECTION', '100')),
+            health_check_interval=float(os.getenv('SMTP_HEALTH_CHECK_SECONDS', '30')),
+            timeout=float(os.getenv('SMTP_TIMEOUT_SECONDS', '30')),
+        ))
+
+    @property
+    def max_connections(self) -> int:
+        return self.pool.max_connections
+
+    def submit(self, coroutine: Coroutine[Any, Any, Any]) -> concurrent.futures.Future:
+        """Run a coroutine on the transport loop"""
+        if self._closed:
+            coroutine.close()
+            raise RuntimeError("SMTP transport is closed")
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def send(self, from_addr: str, to_addrs: Union[str, List[str]], message: Union[str, bytes],
+             timeout: Optional[float] = None) -> Dict[str, Tuple[int, bytes]]:
+        """Send one message and wait for the result, cancelling the send after timeout seconds"""
+        if isinstance(message, str):
+            message = LINE_ENDING.sub('\r\n', message).encode('ascii')
+        future = self.submit(self.pool.send(from_addr, to_addrs, message))
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+    def noop(self) -> int:
+        return self.submit(self.pool.noop()).result()
+
+    async def _shutdown(self):
+        # Sends still in flight are cancelled and allowed to unwind before the sessions close
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.pool.close()
+
+    def close(self):
+        """Cancel sends in flight, quit idle sessions and stop the loop; safe to call more than once"""
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result(self.pool.timeout)
+        except Exception:
+            pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
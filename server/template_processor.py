@@ -5,21 +5,662 @@ Processes .docx templates with invoice data and converts to PDF
 """
 
 import os
+import io
 import json
 import sys
+import base64
+import argparse
 import tempfile
+import struct
+import shutil
+import atexit
+import threading
+import socketserver
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, wait, FIRST_COMPLETED
+import copy
+import hashlib
+import bisect
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, Tuple, Iterator, Iterable
 from docx import Document
 from docx.shared import Inches
 from docx.table import Table
-from docx2pdf import convert
+from docx.oxml import OxmlElement
+from docx.oxml.ns import qn
 import re
 
+from pdf_cache import PdfCache
+from pdf_writer import PdfDocument, PAGE_WIDTH, PAGE_HEIGHT, REGULAR, BOLD, ITALIC, wrap_text
+
+try:
+    from docx2pdf import convert
+except ImportError:
+    # Only the docx2pdf backend needs it; the native backend renders without it
+    convert = None
+
+DEFAULT_TEMPLATE = "default_invoice.docx"
+
+PLACEHOLDER_PATTERN = re.compile(r'\{\{(\w+)\}\}')
+
+# Text nodes that make up a paragraph's visible text, in document order
+PARAGRAPH_TEXT_XPATH = './w:r/w:t | ./w:hyperlink/w:r/w:t'
+
+# A compiled text node: (is_placeholder, literal text or variable name) segments
+Segments = Tuple[Tuple[bool, str], ...]
+
+def element_path(root, element) -> Tuple[int, ...]:
+    """Return the child-index path leading from root down to element"""
+    path = []
+    while element is not root:
+        parent = element.getparent()
+        path.append(parent.index(element))
+        element = parent
+    return tuple(reversed(path))
+
+def resolve_element_path(root, path: Tuple[int, ...]):
+    """Follow a child-index path from root back to an element"""
+    element = root
+    for index in path:
+        element = element[index]
+    return element
+
+def compile_paragraph(p) -> List[Tuple[Any, Segments]]:
+    """Tokenize a paragraph's text nodes once into literal/placeholder segments
+    
+    Returns only the <w:t> nodes a substitution touches. A placeholder split across
+    runs is rendered into the node where it starts; the nodes holding the rest of it
+    keep only their literal text. Paragraphs without placeholders compile to [].
+    """
+    nodes = p.xpath(PARAGRAPH_TEXT_XPATH)
+    texts = [node.text or '' for node in nodes]
+    full_text = ''.join(texts)
+    if '{{' not in full_text:
+        return []
+    matches = list(PLACEHOLDER_PATTERN.finditer(full_text))
+    if not matches:
+        return []
+    
+    starts = []
+    offset = 0
+    for text in texts:
+        starts.append(offset)
+        offset += len(text)
+    
+    def node_at(position):
+        return bisect.bisect_right(starts, position) - 1
+    
+    segments: List[List[Tuple[bool, str]]] = [[] for _ in nodes]
+    
+    def add_literal(begin, end):
+        while begin < end:
+            index = node_at(begin)
+            node_end = min(end, starts[index] + len(texts[index]))
+            segments[index].append((False, full_text[begin:node_end]))
+            begin = node_end
+    
+    touched = set()
+    position = 0
+    for match in matches:
+        add_literal(position, match.start())
+        first = node_at(match.start())
+        segments[first].append((True, match.group(1)))
+        touched.update(range(first, node_at(match.end() - 1) + 1))
+        position = match.end()
+    add_literal(position, len(full_text))
+    
+    return [(nodes[index], tuple(segments[index])) for index in sorted(touched)]
+
+def render_segments(segments: Segments, data: Dict[str, Any]) -> str:
+    """Join compiled segments, leaving unknown placeholders as they were"""
+    return ''.join(
+        str(data.get(value, f"{{{{{value}}}}}")) if is_placeholder else value
+        for is_placeholder, value in segments
+    )
+
+def write_text_node(t, text: str):
+    """Set a <w:t> node's text, turning newlines and tabs into <w:br/> and <w:tab/> like python-docx does"""
+    if '\n' not in text and '\t' not in text:
+        t.text = text
+        if text != text.strip():
+            t.set(qn('xml:space'), 'preserve')
+        return
+    
+    pieces = re.split(r'(\n|\t)', text)
+    t.text = pieces[0]
+    t.set(qn('xml:space'), 'preserve')
+    anchor = t
+    for piece in pieces[1:]:
+        if piece == '\n':
+            element = OxmlElement('w:br')
+        elif piece == '\t':
+            element = OxmlElement('w:tab')
+        elif piece:
+            element = OxmlElement('w:t')
+            element.text = piece
+            element.set(qn('xml:space'), 'preserve')
+        else:
+            continue
+        anchor.addnext(element)
+        anchor = element
+
+class ItemRowTemplate:
+    """An items-table template row compiled once and cloned for every invoice item"""
+    
+    def __init__(self, tr):
+        self.tr = tr
+        # (child-index path of a <w:t> node inside the row, compiled segments)
+        self.compiled: List[Tuple[Tuple[int, ...], Segments]] = [
+            (element_path(tr, t), segments)
+            for p in tr.iter(qn('w:p'))
+            for t, segments in compile_paragraph(p)
+        ]
+    
+    def render(self, data: Dict[str, Any]):
+        """Return a new <w:tr> with the item data substituted, keeping the template row's formatting"""
+        tr = copy.deepcopy(self.tr)
+        targets = [(resolve_element_path(tr, path), segments) for path, segments in self.compiled]
+        for t, segments in targets:
+            write_text_node(t, render_segments(segments, data))
+        return tr
+
+class CachedTemplate:
+    """A parsed .docx template plus an index of where its placeholders live"""
+    
+    def __init__(self, document, stamp: Tuple[int, int]):
+        self.document = document
+        self.stamp = stamp
+        self.lock = threading.Lock()
+        
+        # (part, [(child-index path of a <w:t> node, compiled segments)]) for nodes holding placeholders
+        self.text_index: List[Tuple[Any, List[Tuple[Tuple[int, ...], Segments]]]] = []
+        # (top-level table index, item template row index, compiled template row)
+        self.item_tables: List[Tuple[int, int, ItemRowTemplate]] = []
+        
+        self._build_index()
+    
+    def _build_index(self):
+        """Scan the template once for placeholder paragraphs and item template rows"""
+        doc = self.document
+        body_paragraphs = [paragraph._p for paragraph in doc.paragraphs]
+        
+        for table_index, table in enumerate(doc.tables):
+            template_row_index = -1
+            for row_index, row in enumerate(table.rows):
+                row_text = ' '.join(cell.text for cell in row.cells)
+                if '{{item_' in row_text:
+                    template_row_index = row_index
+                    break
+            
+            if template_row_index >= 0:
+                # Items table, expanded per invoice by process_table_rows
+                self.item_tables.append((table_index, template_row_index,
+                                         ItemRowTemplate(table._tbl.tr_lst[template_row_index])))
+            else:
+                # Regular table, only its cell paragraphs need replacement
+                for row in table.rows:
+                    for cell in row.cells:
+                        body_paragraphs.extend(paragraph._p for paragraph in cell.paragraphs)
+        
+        self._add_part(doc.part, body_paragraphs)
+        
+        # Only headers and footers with their own definition; touching a linked one would add a part
+        seen_parts = set()
+        for section in doc.sections:
+            for header_footer in (section.header, section.footer):
+                if header_footer.is_linked_to_previous:
+                    continue
+                part = header_footer.part
+                if id(part) in seen_parts:
+                    continue
+                seen_parts.add(id(part))
+                self._add_part(part, [paragraph._p for paragraph in header_footer.paragraphs])
+    
+    def _add_part(self, part, paragraph_elements):
+        """Compile the placeholder text nodes of one part"""
+        root = part.element
+        compiled = []
+        seen = set()
+        for p in paragraph_elements:
+            # Merged cells repeat the same paragraphs
+            if id(p) in seen:
+                continue
+            seen.add(id(p))
+            for t, segments in compile_paragraph(p):
+                compiled.append((element_path(root, t), segments))
+        if compiled:
+            self.text_index.append((part, compiled))
+    
+    @contextmanager
+    def checkout(self):
+        """Yield a fresh copy of the template document, restoring the cached XML afterwards
+        
+        Only the XML of parts holding placeholders is deep-copied; the rest of the
+        package (styles, media, relationships) is shared with the cached document.
+        """
+        parts = {id(part): part for part, _ in self.text_index}
+        parts[id(self.document.part)] = self.document.part
+        
+        with self.lock:
+            pristine = [(part, part._element) for part in parts.values()]
+            for part, element in pristine:
+                part._element = copy.deepcopy(element)
+            try:
+                yield self.document.part.document
+            finally:
+                for part, element in pristine:
+                    part._element = element
+    
+    def fill_placeholders(self, data: Dict[str, Any]):
+        """Substitute data into the indexed text nodes of the checked-out document, leaving other runs untouched"""
+        for part, compiled in self.text_index:
+            root = part.element
+            # Resolve every node before writing, since line breaks insert siblings
+            targets = [(resolve_element_path(root, path), segments) for path, segments in compiled]
+            for t, segments in targets:
+                write_text_node(t, render_segments(segments, data))
+
+class TemplateCache:
+    """Size-bounded LRU cache of parsed templates, keyed by path and invalidated on mtime/size change"""
+    
+    def __init__(self, max_templates: int = 32):
+        self.max_templates = max_templates
+        self._templates: "OrderedDict[str, CachedTemplate]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, template_path: Path) -> CachedTemplate:
+        """Return the cached template for a path, parsing it on a miss or after it changed"""
+        key = str(Path(template_path).resolve())
+        stat = os.stat(key)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        
+        with self._lock:
+            cached = self._templates.get(key)
+            if cached is not None and cached.stamp == stamp:
+                self._templates.move_to_end(key)
+                return cached
+        
+        # Parse outside the lock so other templates stay available
+        cached = CachedTemplate(Document(key), stamp)
+        
+        with self._lock:
+            self._templates[key] = cached
+            self._templates.move_to_end(key)
+            while len(self._templates) > self.max_templates:
+                self._templates.popitem(last=False)
+        
+        return cached
+    
+    def clear(self):
+        """Drop every cached template"""
+        with self._lock:
+            self._templates.clear()
+
+class PdfRenderer:
+    """Backend that turns invoice data into PDF bytes"""
+    
+    name = "base"
+    
+    # Whether independent processes may run this backend's conversion step at the same time
+    parallel_safe = True
+    
+    def render(self, processor: "InvoiceTemplateProcessor", invoice_data: Dict[str, Any], template_name: str) -> bytes:
+        """Render one invoice to PDF bytes"""
+        raise NotImplementedError
+    
+    def iter_pdfs(self, processor: "InvoiceTemplateProcessor", batch: Dict[Any, Dict[str, Any]],
+                  template_name: str) -> Iterator[Tuple[Any, Optional[bytes], Optional[str]]]:
+        """Render a batch, yielding (invoice_id, pdf, error); backends override this to amortize setup"""
+        for invoice_id, invoice_data in batch.items():
+            try:
+                yield invoice_id, self.render(processor, invoice_data, template_name), None
+            except Exception as e:
+                yield invoice_id, None, str(e)
+
+class ScratchPool:
+    """Reusable scratch directories for converter input/output, on tmpfs when the host has one
+    
+    Slots are created once and handed out one caller at a time, so renders overwrite the
+    same few files instead of creating and unlinking temp files for every invoice.
+    """
+    
+    def __init__(self, base_dir: Optional[str] = None):
+        self.base_dir = base_dir or os.getenv('PDF_SCRATCH_DIR') or self._default_base_dir()
+        self._root: Optional[Path] = None
+        self._free: List[Path] = []
+        self._slot_count = 0
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _default_base_dir() -> str:
+        shm = Path('/dev/shm')
+        if shm.is_dir() and os.access(shm, os.W_OK):
+            return str(shm)
+        return tempfile.gettempdir()
+    
+    @contextmanager
+    def slot(self) -> Iterator[Path]:
+        """Check out an empty scratch directory, returning it to the pool afterwards"""
+        with self._lock:
+            if self._root is None:
+                self._root = Path(tempfile.mkdtemp(prefix='invoice_scratch_', dir=self.base_dir))
+                atexit.register(shutil.rmtree, str(self._root), True)
+            if self._free:
+                slot_dir = self._free.pop()
+            else:
+                self._slot_count += 1
+                slot_dir = self._root / f"slot_{self._slot_count}"
+                slot_dir.mkdir()
+        
+        try:
+            yield slot_dir
+        finally:
+            # Leave nothing behind for the next user of the slot
+            for entry in slot_dir.iterdir():
+                if entry.is_dir():
+                    shutil.rmtree(entry, ignore_errors=True)
+                else:
+                    entry.unlink()
+            with self._lock:
+                self._free.append(slot_dir)
+
+class Docx2PdfRenderer(PdfRenderer):
+    """Fills the Word template and converts it with docx2pdf (requires a Word engine)"""
+    
+    name = "docx2pdf"
+    
+    # Word automation does not tolerate concurrent conversions
+    parallel_safe = False
+    
+    def __init__(self, scratch_pool: Optional[ScratchPool] = None, convert_lock=None):
+        self.scratch_pool = scratch_pool or ScratchPool()
+        # Optional lock (e.g. a multiprocessing.Lock) held around every converter call
+        self.convert_lock = convert_lock
+    
+    def _convert(self, source: Path, target: Path):
+        if self.convert_lock is None:
+            convert(str(source), str(target))
+            return
+        with self.convert_lock:
+            convert(str(source), str(target))
+    
+    def _require_converter(self):
+        if convert is None:
+            raise RuntimeError("docx2pdf is not installed; use the native PDF backend instead")
+    
+    def render(self, processor: "InvoiceTemplateProcessor", invoice_data: Dict[str, Any], template_name: str) -> bytes:
+        """Generate PDF invoice from template and data"""
+        
+        self._require_converter()
+        template_path = processor.resolve_template(template_name)
+        
+        # docx2pdf only accepts paths, so both files live in a reused scratch slot
+        with self.scratch_pool.slot() as slot_dir:
+            docx_path = slot_dir / 'invoice.docx'
+            pdf_path = slot_dir / 'invoice.pdf'
+            
+            # Process the document
+            processor.process_document(template_path, invoice_data, docx_path)
+            
+            # Convert to PDF
+            self._convert(docx_path, pdf_path)
+            
+            return pdf_path.read_bytes()
+    
+    def iter_pdfs(self, processor: "InvoiceTemplateProcessor", batch: Dict[Any, Dict[str, Any]],
+                  template_name: str) -> Iterator[Tuple[Any, Optional[bytes], Optional[str]]]:
+        """Render a batch of invoices with a single converter run, yielding (invoice_id, pdf, error)"""
+        
+        self._require_converter()
+        template_path = processor.resolve_template(template_name)
+        
+        with self.scratch_pool.slot() as slot_dir:
+            docx_dir = slot_dir / 'docx'
+            pdf_dir = slot_dir / 'pdf'
+            docx_dir.mkdir()
+            pdf_dir.mkdir()
+            
+            # Render every invoice into the scratch directory under a safe sequential name
+            rendered = []
+            failed = []
+            for position, (invoice_id, invoice_data) in enumerate(batch.items()):
+                file_stem = f"invoice_{position:06d}"
+                try:
+                    processor.process_document(template_path, invoice_data, docx_dir / f"{file_stem}.docx")
+                    rendered.append((invoice_id, file_stem))
+                except Exception as e:
+                    failed.append((invoice_id, str(e)))
+            
+            for invoice_id, error in failed:
+                yield invoice_id, None, error
+            
+            if not rendered:
+                return
+            
+            # One converter start for the whole directory
+            self._convert(docx_dir, pdf_dir)
+            
+            for invoice_id, file_stem in rendered:
+                pdf_path = pdf_dir / f"{file_stem}.pdf"
+                if not pdf_path.exists():
+                    yield invoice_id, None, "PDF conversion produced no output"
+                    continue
+                
+                pdf_content = pdf_path.read_bytes()
+                pdf_path.unlink()
+                
+                yield invoice_id, pdf_content, None
+
+class NativeInvoiceLayout:
+    """Page layout state for one invoice rendered by NativePdfRenderer"""
+    
+    margin = 54
+    leading = 13
+    
+    # Items table columns: (heading, width, right aligned)
+    columns = [
+        ("Item", 120, False),
+        ("Description", 214, False),
+        ("Rate", 70, True),
+        ("Qty", 40, True),
+        ("Amount", 60, True),
+    ]
+    
+    def __init__(self, processor: "InvoiceTemplateProcessor", invoice_data: Dict[str, Any]):
+        self.processor = processor
+        self.invoice_data = invoice_data
+        self.pdf = PdfDocument()
+        self.page = self.pdf.add_page()
+        self.y = PAGE_HEIGHT - self.margin
+    
+    def build(self) -> bytes:
+        """Lay out every section in order and serialize the PDF"""
+        data = self.processor.build_replacement_data(self.invoice_data)
+        
+        self._draw_header(data)
+        self._draw_bill_to(data)
+        self._draw_items(self.invoice_data.get('items', []))
+        self._draw_summary(data)
+        self._draw_footer(data)
+        
+        return self.pdf.to_bytes()
+    
+    @property
+    def _right(self) -> float:
+        return PAGE_WIDTH - self.margin
+    
+    def _ensure_space(self, height: float) -> bool:
+        """Start a new page when height does not fit; returns True if a page was added"""
+        if self.y - height >= self.margin:
+            return False
+        self.page = self.pdf.add_page()
+        self.y = PAGE_HEIGHT - self.margin
+        return True
+    
+    def _draw_header(self, data: Dict[str, Any]):
+        page = self.page
+        top = self.y
+        
+        # Company information (left side)
+        page.text(self.margin, top - 18, data['company_name'], BOLD, 18)
+        company_lines = [data['company_address']]
+        if data['company_phone']:
+            company_lines.append(f"Phone: {data['company_phone']}")
+        if data['company_email']:
+            company_lines.append(f"Email: {data['company_email']}")
+        if data['company_website']:
+            company_lines.append(f"Website: {data['company_website']}")
+        
+        y = top - 18 - self.leading
+        for line in company_lines:
+            for wrapped in wrap_text(line, REGULAR, 10, 280):
+                if wrapped:
+                    page.text(self.margin, y, wrapped)
+                    y -= self.leading
+        
+        # Invoice title and details (right side)
+        page.text_right(self._right, top - 24, "INVOICE", BOLD, 24)
+        detail_y = top - 24 - self.leading - 4
+        for line in (f"Invoice #: {data['invoice_number']}",
+                     f"Date: {data['invoice_date']}",
+                     f"Due Date: {data['due_date']}"):
+            page.text_right(self._right, detail_y, line)
+            detail_y -= self.leading
+        
+        self.y = min(y, detail_y) - self.leading
+    
+    def _draw_bill_to(self, data: Dict[str, Any]):
+        page = self.page
+        self.y -= 14
+        page.text(self.margin, self.y, "Bill To:", BOLD, 14)
+        self.y -= self.leading + 4
+        
+        for line in (data['client_name'], data['client_address'],
+                     f"Email: {data['client_email']}" if data['client_email'] else ''):
+            for wrapped in wrap_text(line, REGULAR, 10, self._right - self.margin):
+                if wrapped:
+                    page.text(self.margin, self.y, wrapped)
+                    self.y -= self.leading
+        
+        self.y -= self.leading
+    
+    def _draw_items_header(self):
+        page = self.page
+        page.fill_rect(self.margin, self.y - 5, self._right - self.margin, self.leading + 6)
+        x = self.margin
+        for heading, width, right_aligned in self.columns:
+            if right_aligned:
+                page.text_right(x + width - 4, self.y, heading, BOLD)
+            else:
+                page.text(x + 4, self.y, heading, BOLD)
+            x += width
+        self.y -= self.leading + 6
+    
+    def _draw_items(self, items: List[Dict[str, Any]]):
+        self._draw_items_header()
+        
+        for item in items:
+            item_data = self.processor.build_item_data(item)
+            values = (item_data['item_name'], item_data['item_description'], item_data['item_rate'],
+                      item_data['item_quantity'], item_data['item_amount'])
+            
+            cells = [wrap_text(value, REGULAR, 10, width - 8) for value, (_, width, _) in zip(values, self.columns)]
+            row_height = max(len(lines) for lines in cells) * self.leading + 4
+            
+            # Repeat the table header on every page the table spans
+            if self._ensure_space(row_height):
+                self._draw_items_header()
+            
+            page = self.page
+            x = self.margin
+            for lines, (_, width, right_aligned) in zip(cells, self.columns):
+                y = self.y
+                for line in lines:
+                    if right_aligned:
+                        page.text_right(x + width - 4, y, line)
+                    else:
+                        page.text(x + 4, y, line)
+                    y -= self.leading
+                x += width
+            
+            self.y -= row_height
+            page.line(self.margin, self.y + self.leading - 2, self._right, self.y + self.leading - 2, 0.25)
+        
+        self.y -= self.leading
+    
+    def _draw_summary(self, data: Dict[str, Any]):
+        rows = [("Subtotal:", data['subtotal'], REGULAR)]
+        if data['discount_amount'] != "$0.00":
+            rows.append(("Discount:", f"-{data['discount_amount']}", REGULAR))
+        rows.append((f"VAT ({data['vat_rate']}%):", data['vat_amount'], REGULAR))
+        if data['deposit_amount'] != "$0.00":
+            rows.append(("Deposit:", f"-{data['deposit_amount']}", REGULAR))
+        rows.append(("Total:", data['total'], BOLD))
+        
+        self._ensure_space(len(rows) * self.leading + 8)
+        page = self.page
+        label_x = self._right - 160
+        for label, value, font in rows:
+            if font == BOLD:
+                page.line(label_x, self.y + self.leading - 2, self._right, self.y + self.leading - 2)
+            page.text(label_x, self.y, label, font)
+            page.text_right(self._right, self.y, value, font)
+            self.y -= self.leading
+        
+        self.y -= self.leading
+    
+    def _draw_footer(self, data: Dict[str, Any]):
+        blocks = []
+        if data['notes']:
+            blocks.append(("Notes:", data['notes']))
+        if data['payment_terms']:
+            blocks.append(("Payment Terms:", data['payment_terms']))
+        
+        for heading, text in blocks:
+            lines = wrap_text(text, REGULAR, 10, self._right - self.margin)
+            self._ensure_space((len(lines) + 2) * self.leading)
+            self.page.text(self.margin, self.y, heading, BOLD)
+            self.y -= self.leading
+            for line in lines:
+                self.page.text(self.margin, self.y, line)
+                self.y -= self.leading
+            self.y -= self.leading / 2
+        
+        self._ensure_space(2 * self.leading)
+        self.y -= self.leading
+        self.page.text_center(PAGE_WIDTH / 2, self.y, data['thank_you_message'], ITALIC)
+
+class NativePdfRenderer(PdfRenderer):
+    """Lays out the default invoice template straight to PDF bytes, in-process and without temp files"""
+    
+    name = "native"
+    
+    def render(self, processor: "InvoiceTemplateProcessor", invoice_data: Dict[str, Any], template_name: str) -> bytes:
+        """Render the invoice model (header, bill-to, items table, summary) to PDF bytes"""
+        if template_name != DEFAULT_TEMPLATE:
+            raise ValueError(f"The native PDF backend only lays out {DEFAULT_TEMPLATE}, not {template_name}")
+        
+        return NativeInvoiceLayout(processor, invoice_data).build()
+
+PDF_RENDERERS = {
+    Docx2PdfRenderer.name: Docx2PdfRenderer,
+    NativePdfRenderer.name: NativePdfRenderer,
+}
+
 class InvoiceTemplateProcessor:
-    def __init__(self, templates_dir="templates"):
+    def __init__(self, templates_dir="templates", template_cache_size: int = 32,
+                 renderer: Optional["PdfRenderer"] = None, pdf_cache: Optional[PdfCache] = None):
         self.templates_dir = Path(templates_dir)
         self.templates_dir.mkdir(exist_ok=True)
+        self.template_cache = TemplateCache(template_cache_size)
+        self.renderer = renderer or Docx2PdfRenderer()
+        self.pdf_cache = pdf_cache
+        
+        # template path -> ((mtime_ns, size), sha256 of the template bytes)
+        self._template_fingerprints: Dict[str, Tuple[Tuple[int, int], str]] = {}
+        self._fingerprint_lock = threading.Lock()
         
     def replace_template_variables(self, text: str, data: Dict[str, Any]) -> str:
         """Replace template variables in text with actual data"""
@@ -33,49 +674,45 @@ class InvoiceTemplateProcessor:
         
         return re.sub(r'\{\{(\w+)\}\}', replace_var, text)
     
-    def process_table_rows(self, table: Table, invoice_items: List[Dict[str, Any]], template_row_index: int = 1):
-        """Process table rows for invoice items"""
-        if not invoice_items or template_row_index >= len(table.rows):
+    def process_table_rows(self, table: Table, invoice_items: List[Dict[str, Any]], template_row_index: int = 1,
+                           row_template: Optional[ItemRowTemplate] = None):
+        """Replace the template row with one row per invoice item
+        
+        Each item row is a clone of the template row's XML with the item data
+        substituted, and all rows are spliced into the table in one operation.
+        """
+        tbl = table._tbl
+        trs = tbl.tr_lst
+        if template_row_index >= len(trs):
             return
-            
+        
         # Get the template row
-        template_row = table.rows[template_row_index]
+        template_tr = trs[template_row_index]
+        if row_template is None:
+            row_template = ItemRowTemplate(template_tr)
         
         # Remove existing data rows (keep header and template)
-        rows_to_remove = []
-        for i in range(template_row_index + 1, len(table.rows)):
-            rows_to_remove.append(i)
-        
-        # Remove from bottom to top to maintain indices
-        for row_index in reversed(rows_to_remove):
-            table._element.remove(table.rows[row_index]._element)
-        
-        # Add rows for each invoice item
-        for item in invoice_items:
-            # Create new row by copying template row
-            new_row = table.add_row()
-            
-            # Copy cell content and replace variables
-            for i, cell in enumerate(template_row.cells):
-                if i < len(new_row.cells):
-                    template_text = cell.text
-                    new_text = self.replace_template_variables(template_text, {
-                        'item_name': item.get('name', ''),
-                        'item_description': item.get('description', ''),
-                        'item_quantity': str(item.get('quantity', 1)),
-                        'item_rate': f"${float(item.get('rate', 0)):.2f}",
-                        'item_amount': f"${float(item.get('amount', 0)):.2f}"
-                    })
-                    new_row.cells[i].text = new_text
-    
-    def process_document(self, template_path: Path, invoice_data: Dict[str, Any]) -> Path:
-        """Process a Word document template with invoice data"""
+        for tr in trs[template_row_index + 1:]:
+            tbl.remove(tr)
         
-        # Open the template document
-        doc = Document(template_path)
-        
-        # Prepare data for replacement
-        replacement_data = {
+        # Build every item row first, then swap them in for the template row at once
+        new_rows = [row_template.render(self.build_item_data(item)) for item in invoice_items]
+        position = tbl.index(template_tr)
+        tbl[position:position + 1] = new_rows
+    
+    def build_item_data(self, item: Dict[str, Any]) -> Dict[str, str]:
+        """Map one invoice item onto the item template variable names"""
+        return {
+            'item_name': item.get('name', ''),
+            'item_description': item.get('description', ''),
+            'item_quantity': str(item.get('quantity', 1)),
+            'item_rate': f"${float(item.get('rate', 0)):.2f}",
+            'item_amount': f"${float(item.get('amount', 0)):.2f}"
+        }
+    
+    def build_replacement_data(self, invoice_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Map invoice data onto the template variable names"""
+        return {
             # Company information
             'company_name': invoice_data.get('companyName', 'Your Company'),
             'company_address': invoice_data.get('companyAddress', ''),
@@ -109,117 +746,422 @@ class InvoiceTemplateProcessor:
             'payment_terms': invoice_data.get('paymentTerms', 'Net 30 days'),
             'thank_you_message': 'Thank you for your business!'
         }
+    
+    def process_document(self, template_path: Path, invoice_data: Dict[str, Any],
+                         output_path: Optional[Path] = None) -> Path:
+        """Process a Word document template with invoice data"""
         
-        # Process paragraphs
-        for paragraph in doc.paragraphs:
-            if paragraph.text:
-                paragraph.text = self.replace_template_variables(paragraph.text, replacement_data)
-        
-        # Process tables
+        # Prepare data for replacement
+        replacement_data = self.build_replacement_data(invoice_data)
         invoice_items = invoice_data.get('items', [])
-        for table in doc.tables:
-            # Check if this table contains item template codes
-            has_item_templates = False
-            template_row_index = -1
+        
+        # Parsed template and placeholder index come from the cache
+        cached_template = self.template_cache.get(template_path)
+        
+        with cached_template.checkout() as doc:
+            # Process paragraphs in the body, regular tables, headers and footers
+            cached_template.fill_placeholders(replacement_data)
             
-            for row_index, row in enumerate(table.rows):
-                row_text = ' '.join(cell.text for cell in row.cells)
-                if '{{item_' in row_text:
-                    has_item_templates = True
-                    template_row_index = row_index
-                    break
+            # Process items tables
+            if cached_template.item_tables:
+                tables = doc.tables
+                for table_index, template_row_index, row_template in cached_template.item_tables:
+                    self.process_table_rows(tables[table_index], invoice_items, template_row_index, row_template)
             
-            if has_item_templates and template_row_index >= 0:
-                # This is an items table
-                self.process_table_rows(table, invoice_items, template_row_index)
-            else:
-                # Regular table, just replace variables
-                for row in table.rows:
-                    for cell in row.cells:
-                        if cell.text:
-                            cell.text = self.replace_template_variables(cell.text, replacement_data)
-        
-        # Process headers and footers
-        for section in doc.sections:
-            # Header
-            if section.header:
-                for paragraph in section.header.paragraphs:
-                    if paragraph.text:
-                        paragraph.text = self.replace_template_variables(paragraph.text, replacement_data)
-            
-            # Footer
-            if section.footer:
-                for paragraph in section.footer.paragraphs:
-                    if paragraph.text:
-                        paragraph.text = self.replace_template_variables(paragraph.text, replacement_data)
-        
-        # Save processed document to temporary file
-        temp_docx = tempfile.NamedTemporaryFile(delete=False, suffix='.docx')
-        doc.save(temp_docx.name)
-        temp_docx.close()
+            if output_path is not None:
+                doc.save(str(output_path))
+                return Path(output_path)
+            
+            # Save processed document to temporary file
+            temp_docx = tempfile.NamedTemporaryFile(delete=False, suffix='.docx')
+            doc.save(temp_docx.name)
+            temp_docx.close()
         
         return Path(temp_docx.name)
     
-    def generate_invoice_pdf(self, invoice_data: Dict[str, Any], template_name: str = "default_invoice.docx") -> bytes:
-        """Generate PDF invoice from template and data"""
-        
+    def resolve_template(self, template_name: str) -> Path:
+        """Return the path of a template, raising if it does not exist"""
         template_path = self.templates_dir / template_name
         
         # Check if template exists
         if not template_path.exists():
             raise FileNotFoundError(f"Template {template_name} not found in {self.templates_dir}")
         
-        # Process the document
-        processed_docx = self.process_document(template_path, invoice_data)
-        
+        return template_path
+    
+    def template_fingerprint(self, template_name: str) -> str:
+        """Hash of the template file, recomputed only when its mtime or size changes"""
+        template_path = str(self.templates_dir / template_name)
         try:
-            # Convert to PDF
-            temp_pdf = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
-            temp_pdf.close()
-            
-            convert(str(processed_docx), temp_pdf.name)
+            stat = os.stat(template_path)
+        except FileNotFoundError:
+            # Nothing on disk to invalidate against (native backend without the .docx)
+            return hashlib.sha256(f"missing:{template_name}".encode('utf-8')).hexdigest()
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        
+        with self._fingerprint_lock:
+            known = self._template_fingerprints.get(template_path)
+            if known is not None and known[0] == stamp:
+                return known[1]
+        
+        with open(template_path, 'rb') as f:
+            fingerprint = hashlib.sha256(f.read()).hexdigest()
+        
+        with self._fingerprint_lock:
+            self._template_fingerprints[template_path] = (stamp, fingerprint)
+        
+        # The template changed, so PDFs rendered from the old version are stale
+        if known is not None and known[1] != fingerprint and self.pdf_cache is not None:
+            self.pdf_cache.invalidate(known[1])
+        
+        return fingerprint
+    
+    def pdf_cache_key(self, invoice_data: Dict[str, Any], template_name: str) -> str:
+        """Stable hash of everything that ends up on the rendered PDF"""
+        canonical = json.dumps({
+            'renderer': self.renderer.name,
+            'template': template_name,
+            'data': self.build_replacement_data(invoice_data),
+            'items': [self.build_item_data(item) for item in invoice_data.get('items', [])]
+        }, sort_keys=True, separators=(',', ':'), default=str)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+    
+    def generate_invoice_pdf(self, invoice_data: Dict[str, Any], template_name: str = DEFAULT_TEMPLATE) -> bytes:
+        """Generate PDF invoice from template and data"""
+        if self.pdf_cache is None:
+            return self.renderer.render(self, invoice_data, template_name)
+        
+        # Repeat downloads of an unchanged invoice are served from the cache
+        fingerprint = self.template_fingerprint(template_name)
+        cache_key = self.pdf_cache_key(invoice_data, template_name)
+        
+        pdf_content = self.pdf_cache.get(fingerprint, cache_key)
+        if pdf_content is None:
+            pdf_content = self.renderer.render(self, invoice_data, template_name)
+            self.pdf_cache.put(fingerprint, cache_key, pdf_content)
+        
+        return pdf_content
+    
+    def iter_invoice_pdfs(self, batch: Dict[Any, Dict[str, Any]],
+                          template_name: str = DEFAULT_TEMPLATE) -> Iterator[Tuple[Any, Optional[bytes], Optional[str]]]:
+        """Render a batch of invoices, yielding (invoice_id, pdf, error) as results become available"""
+        if self.pdf_cache is None:
+            yield from self.renderer.iter_pdfs(self, batch, template_name)
+            return
+        
+        fingerprint = self.template_fingerprint(template_name)
+        
+        # Serve cached PDFs straight away and only render the misses
+        misses = {}
+        cache_keys = {}
+        for invoice_id, invoice_data in batch.items():
+            try:
+                cache_key = self.pdf_cache_key(invoice_data, template_name)
+            except Exception as e:
+                yield invoice_id, None, str(e)
+                continue
             
-            # Read PDF content
-            with open(temp_pdf.name, 'rb') as f:
-                pdf_content = f.read()
+            pdf_content = self.pdf_cache.get(fingerprint, cache_key)
+            if pdf_content is not None:
+                yield invoice_id, pdf_content, None
+            else:
+                misses[invoice_id] = invoice_data
+                cache_keys[invoice_id] = cache_key
+        
+        if not misses:
+            return
+        
+        for invoice_id, pdf_content, error in self.renderer.iter_pdfs(self, misses, template_name):
+            if error is None:
+                self.pdf_cache.put(fingerprint, cache_keys[invoice_id], pdf_content)
+            yield invoice_id, pdf_content, error
+    
+    def generate_invoice_pdfs(self, batch: Dict[Any, Dict[str, Any]],
+                              template_name: str = DEFAULT_TEMPLATE) -> Dict[Any, bytes]:
+        """Generate PDFs for a batch of invoices keyed by invoice id, converting them in one run"""
+        pdfs = {}
+        for invoice_id, pdf_content, error in self.iter_invoice_pdfs(batch, template_name):
+            if error is not None:
+                raise RuntimeError(f"Failed to generate PDF for invoice {invoice_id}: {error}")
+            pdfs[invoice_id] = pdf_content
+        return pdfs
+
+# Binary frame prefix: JSON header length, payload length (both unsigned 32-bit big-endian)
+FRAME_PREFIX = struct.Struct('>II')
+
+class JsonResultWriter:
+    """Writes each result as a line of JSON with the PDF base64 encoded"""
+    
+    def __init__(self, stream, tag_ids: bool = True):
+        self.stream = stream
+        self.tag_ids = tag_ids
+    
+    def write(self, job_id: Any, pdf_content: Optional[bytes] = None, error: Optional[str] = None):
+        if error is None:
+            result = {
+                "success": True,
+                "pdf_base64": base64.b64encode(pdf_content).decode('utf-8'),
+                "message": "PDF generated successfully"
+            }
+        else:
+            result = {
+                "success": False,
+                "error": error,
+                "message": "Failed to generate PDF"
+            }
+        
+        # Tag every result with the id of the job it answers
+        if self.tag_ids:
+            result["id"] = job_id
+        
+        self.stream.write(json.dumps(result) + "\n")
+        self.stream.flush()
+
+class FrameResultWriter:
+    """Writes each result as a length-prefixed binary frame carrying the raw PDF bytes
+    
+    Frame layout: FRAME_PREFIX (header length, payload length), the UTF-8 JSON header
+    ({"id", "success", "message"/"error"}), then the PDF bytes (empty on failure).
+    """
+    
+    def __init__(self, stream):
+        self.stream = stream
+    
+    def write(self, job_id: Any, pdf_content: Optional[bytes] = None, error: Optional[str] = None):
+        if error is None:
+            header = {"id": job_id, "success": True, "message": "PDF generated successfully"}
+            payload = pdf_content
+        else:
+            header = {"id": job_id, "success": False, "error": error, "message": "Failed to generate PDF"}
+            payload = b''
+        
+        header_bytes = json.dumps(header).encode('utf-8')
+        self.stream.write(FRAME_PREFIX.pack(len(header_bytes), len(payload)))
+        self.stream.write(header_bytes)
+        self.stream.write(payload)
+        self.stream.flush()
+
+def run_job(processor: InvoiceTemplateProcessor, job: Dict[str, Any]) -> bytes:
+    """Render a single PDF job"""
+    template_name = job.get('template_name') or job.get('template') or DEFAULT_TEMPLATE
+    invoice_data = job.get('invoice_data', {})
+    
+    return processor.generate_invoice_pdf(invoice_data, template_name)
+
+# Per-process state of render_many pool workers
+_pool_processor: Optional[InvoiceTemplateProcessor] = None
+
+def _init_render_worker(templates_dir: str, backend: str, convert_lock, warm_templates: Tuple[str, ...],
+                        use_pdf_cache: bool):
+    """Build the long-lived processor of a pool worker and pre-parse the given templates"""
+    global _pool_processor
+    
+    renderer = PDF_RENDERERS[backend]()
+    if not renderer.parallel_safe:
+        renderer.convert_lock = convert_lock
+    
+    pdf_cache = PdfCache.from_env() if use_pdf_cache else None
+    _pool_processor = InvoiceTemplateProcessor(templates_dir, renderer=renderer, pdf_cache=pdf_cache)
+    
+    for template_name in warm_templates:
+        try:
+            _pool_processor.template_cache.get(_pool_processor.resolve_template(template_name))
+        except Exception:
+            # A missing template is reported by the jobs that use it
+            pass
+
+def _render_pool_job(job: Dict[str, Any]) -> Tuple[Any, Optional[bytes], Optional[str]]:
+    try:
+        return job.get('id'), run_job(_pool_processor, job), None
+    except Exception as e:
+        return job.get('id'), None, str(e)
+
+# End of the job iterable, distinct from any job it may hold
+_NO_JOB = object()
+
+def render_many(jobs: Iterable[Dict[str, Any]], workers: Optional[int] = None, ordered: bool = True,
+                max_in_flight: Optional[int] = None, templates_dir: str = "templates", backend: str = "docx2pdf",
+                warm_templates: Tuple[str, ...] = (DEFAULT_TEMPLATE,),
+                use_pdf_cache: bool = True) -> Iterator[Tuple[Any, Optional[bytes], Optional[str]]]:
+    """Render {"id", "template_name", "invoice_data"} jobs across a process pool, yielding (id, pdf, error)
+    
+    Each worker keeps its own warm template cache for the life of the pool and shares the
+    disk tier of the PDF cache when PDF_CACHE_DIR is set. At most max_in_flight jobs
+    (default: twice the worker count) are queued at once, which bounds memory held by
+    pending results. Results come back in job order, or as they finish when ordered=False;
+    every job gets one, including jobs that are not objects.
+    Backends that cannot convert concurrently render in parallel but convert one at a time.
+    """
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = max(max_in_flight or workers * 2, 1)
+    
+    convert_lock = multiprocessing.Lock()
+    job_iter = iter(jobs)
+    
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_render_worker,
+                             initargs=(templates_dir, backend, convert_lock, tuple(warm_templates), use_pdf_cache)) as executor:
+        pending = deque()
+        
+        def top_up():
+            while len(pending) < max_in_flight:
+                job = next(job_iter, _NO_JOB)
+                if job is _NO_JOB:
+                    return
+                if isinstance(job, dict):
+                    pending.append(executor.submit(_render_pool_job, job))
+                    continue
+                # A malformed job still gets its result, so outputs stay paired with inputs
+                future = Future()
+                future.set_result((None, None, f"Job must be an object, not {type(job).__name__}"))
+                pending.append(future)
+        
+        top_up()
+        while pending:
+            if ordered:
+                future = pending.popleft()
+            else:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                future = done.pop()
+                pending.remove(future)
             
-            return pdf_content
+            result = future.result()
+            top_up()
+            yield result
+
+def serve_jobs(processor: InvoiceTemplateProcessor, input_stream, writer, lock: Optional[threading.Lock] = None):
+    """Process newline-delimited JSON jobs until EOF, writing one result per job"""
+    for line in input_stream:
+        line = line.strip()
+        if not line:
+            continue
+        
+        job_id = None
+        try:
+            job = json.loads(line)
+            job_id = job.get('id')
             
+            if lock:
+                with lock:
+                    pdf_content = run_job(processor, job)
+            else:
+                pdf_content = run_job(processor, job)
+        except Exception as e:
+            writer.write(job_id, error=str(e))
+            continue
+        
+        writer.write(job_id, pdf_content)
+
+def serve_batch(processor: InvoiceTemplateProcessor, input_data: Dict[str, Any], writer, workers: int = 1):
+    """Render a batch request and stream one result per invoice as PDFs become available"""
+    template_name = input_data.get('template_name') or input_data.get('template') or DEFAULT_TEMPLATE
+    
+    if workers > 1:
+        # Spread the batch across processes, reporting invoices as they finish; entries that are
+        # not objects pass through unchanged and come back as render_many's per-job errors
+        jobs = (
+            {'id': job.get('id'), 'template_name': template_name, 'invoice_data': job.get('invoice_data', {})}
+            if isinstance(job, dict) else job
+            for job in input_data.get('invoices', [])
+        )
+        results = render_many(jobs, workers=workers, ordered=False, templates_dir=str(processor.templates_dir),
+                              backend=processor.renderer.name, warm_templates=(template_name,),
+                              use_pdf_cache=processor.pdf_cache is not None)
+    else:
+        batch = {}
+        for job in input_data.get('invoices', []):
+            if isinstance(job, dict):
+                batch[job.get('id')] = job.get('invoice_data', {})
+            else:
+                writer.write(None, error=f"Job must be an object, not {type(job).__name__}")
+        results = processor.iter_invoice_pdfs(batch, template_name)
+    
+    for invoice_id, pdf_content, error in results:
+        writer.write(invoice_id, pdf_content, error)
+
+def serve_socket(processor: InvoiceTemplateProcessor, socket_path: str, framed: bool = False):
+    """Accept NDJSON jobs on a local Unix socket, sharing one warm processor across connections"""
+    render_lock = threading.Lock()
+    
+    class JobHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            input_stream = io.TextIOWrapper(self.rfile, encoding='utf-8')
+            if framed:
+                writer = FrameResultWriter(self.wfile)
+            else:
+                writer = JsonResultWriter(io.TextIOWrapper(self.wfile, encoding='utf-8', write_through=True))
+            serve_jobs(processor, input_stream, writer, render_lock)
+    
+    # Remove a stale socket left behind by a previous worker
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    
+    with socketserver.ThreadingUnixStreamServer(socket_path, JobHandler) as server:
+        try:
+            server.serve_forever()
         finally:
-            # Clean up temporary files
-            if processed_docx.exists():
-                processed_docx.unlink()
-            if Path(temp_pdf.name).exists():
-                Path(temp_pdf.name).unlink()
+            os.unlink(socket_path)
 
 def main():
     """Command line interface for template processing"""
+    parser = argparse.ArgumentParser(description="Generate invoice PDFs from Word templates")
+    parser.add_argument('--worker', action='store_true',
+                        help="Stay alive and process newline-delimited JSON jobs from stdin")
+    parser.add_argument('--socket', metavar='PATH',
+                        help="Stay alive and process newline-delimited JSON jobs on a Unix socket")
+    parser.add_argument('--batch', action='store_true',
+                        help="Render {\"invoices\": [{\"id\", \"invoice_data\"}, ...]} from stdin with one converter run")
+    parser.add_argument('--backend', choices=sorted(PDF_RENDERERS), default=os.getenv('PDF_BACKEND', 'docx2pdf'),
+                        help="PDF backend: fill the Word template and convert it, or lay out the PDF natively")
+    parser.add_argument('--frame', action='store_true',
+                        help="Write length-prefixed binary frames with raw PDF bytes instead of base64 JSON")
+    parser.add_argument('--fd', type=int, metavar='N',
+                        help="Write framed output to file descriptor N instead of stdout (implies --frame)")
+    parser.add_argument('--workers', type=int, default=1, metavar='N',
+                        help="Render --batch invoices across N processes")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Always render, bypassing the rendered-PDF cache")
+    args = parser.parse_args()
+    renderer = PDF_RENDERERS[args.backend]()
+    pdf_cache = None if args.no_cache else PdfCache.from_env()
+    
+    framed = args.frame or args.fd is not None
+    if args.fd is not None:
+        frame_writer = FrameResultWriter(os.fdopen(args.fd, 'wb', closefd=False))
+    elif framed:
+        frame_writer = FrameResultWriter(sys.stdout.buffer)
+    
+    if args.worker or args.socket:
+        # Long-lived worker: imports and processor state stay warm across jobs
+        processor = InvoiceTemplateProcessor(renderer=renderer, pdf_cache=pdf_cache)
+        if args.socket:
+            serve_socket(processor, args.socket, framed)
+        else:
+            serve_jobs(processor, sys.stdin, frame_writer if framed else JsonResultWriter(sys.stdout))
+        return
+    
     try:
         # Read JSON input from stdin
         input_data = json.loads(sys.stdin.read())
         
         # Create processor
-        processor = InvoiceTemplateProcessor()
-        
-        # Generate PDF
-        template_name = input_data.get('template', 'default_invoice.docx')
-        invoice_data = input_data.get('invoice_data', {})
-        
-        pdf_content = processor.generate_invoice_pdf(invoice_data, template_name)
+        processor = InvoiceTemplateProcessor(renderer=renderer, pdf_cache=pdf_cache)
         
-        # Output base64 encoded PDF
-        import base64
-        pdf_base64 = base64.b64encode(pdf_content).decode('utf-8')
+        if args.batch:
+            # One result per invoice
+            serve_batch(processor, input_data, frame_writer if framed else JsonResultWriter(sys.stdout), args.workers)
+            return
         
-        result = {
-            "success": True,
-            "pdf_base64": pdf_base64,
-            "message": "PDF generated successfully"
-        }
+        # Generate PDF
+        pdf_content = run_job(processor, input_data)
         
-        print(json.dumps(result))
+        if framed:
+            frame_writer.write(input_data.get('id'), pdf_content)
+        else:
+            JsonResultWriter(sys.stdout, tag_ids=False).write(None, pdf_content)
         
     except Exception as e:
+        if framed:
+            frame_writer.write(None, error=str(e))
         error_result = {
             "success": False,
             "error": str(e),
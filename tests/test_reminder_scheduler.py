@@ -0,0 +1,71 @@
+import os
+import sys
+import tempfile
+import unittest
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "server"))
+
+from message_factory import MessageFactory
+from reminder_ledger import ReminderLedger
+from reminder_scheduler import ReminderScheduler
+from reminder_service import ReminderService
+
+class RecordingEmailService:
+    """Stands in for SMTPEmailService, recording what it is asked to send"""
+
+    def __init__(self):
+        self.from_email = 'billing@example.com'
+        self.messages = MessageFactory(self.from_email)
+        self.sent = []
+
+    def send_many(self, messages, workers=None, rate_limiter=None, max_retries=3, backoff=1.0):
+        for message in messages:
+            self.sent.append(message)
+            yield {'id': message['id'], 'to_email': message['to_email'], 'success': True, 'attempts': 1}
+
+INVOICE = {
+    'id': 7,
+    'invoiceNumber': 'INV-0000007',
+    'clientName': 'Acme',
+    'clientEmail': 'ap@acme.example',
+    'total': '120.00',
+    'status': 'pending',
+    'dueDate': '2025-01-01T00:00:00Z',
+}
+
+class RunDueLedgerTest(unittest.TestCase):
+    def setUp(self):
+        self.scratch = tempfile.TemporaryDirectory()
+        self.ledger = ReminderLedger(os.path.join(self.scratch.name, 'ledger.db'))
+        self.email_service = RecordingEmailService()
+        self.now = datetime(2025, 1, 5)
+        service = ReminderService(self.email_service, self.ledger)
+        self.scheduler = ReminderScheduler(os.path.join(self.scratch.name, 'schedule.db'), service,
+                                           clock=lambda: self.now)
+
+    def tearDown(self):
+        self.scheduler.close()
+        self.ledger.close()
+        self.scratch.cleanup()
+
+    def test_tier_in_ledger_is_not_sent_again(self):
+        self.ledger.record('INV-0000007', 'gentle', datetime(2025, 1, 3))
+        self.scheduler.upsert(INVOICE)
+
+        self.assertEqual(list(self.scheduler.run_due()), [])
+        self.assertEqual(self.email_service.sent, [])
+        # The next transition is urgent, 8 days after the due date
+        self.assertEqual(self.scheduler.next_due(), datetime(2025, 1, 9))
+
+    def test_tier_not_in_ledger_is_sent_and_recorded(self):
+        self.scheduler.upsert(INVOICE)
+
+        results = list(self.scheduler.run_due())
+        self.assertEqual([result['status'] for result in results], ['sent'])
+        self.assertEqual(len(self.email_service.sent), 1)
+        self.assertEqual(self.ledger.last_sent('INV-0000007', 'gentle'), self.now)
+
+if __name__ == '__main__':
+    unittest.main()